@@ -0,0 +1,108 @@
+"""
+An ASGI app serving the same routes as main.py, using the async handlers from src/aio.py
+where there are some and running the rest in a thread pool.
+
+Run with any ASGI server, ie.
+    uvicorn --factory asgi:create_app --workers 4
+"""
+import asyncio
+import inspect
+import json
+import logging
+
+from main import serverless_functions, load_handler
+
+logger = logging.getLogger(__name__)
+
+
+def in_thread(aws_lambda):
+    async def run(event, context):
+        return await asyncio.get_event_loop().run_in_executor(None, aws_lambda, event, context)
+    return run
+
+
+async def read_body(receive):
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+    return body
+
+
+async def respond(send, status, body):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json')]})
+    await send({'type': 'http.response.body', 'body': json.dumps(body, default=str).encode('utf-8')})
+
+
+async def stream(send, status, docs):
+    """
+    Sends a generator body (ie. from read_info with "stream") as one JSON document per line, as it's read
+    """
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/x-ndjson')]})
+    if inspect.isasyncgen(docs):
+        async for doc in docs:
+            await send({'type': 'http.response.body', 'body': json.dumps(doc, default=str).encode('utf-8') + b'\n',
+                        'more_body': True})
+    else:
+        # a synchronous handler's cursor would block the loop, so it's read in the thread pool
+        done = object()
+        loop = asyncio.get_event_loop()
+        while True:
+            doc = await loop.run_in_executor(None, next, docs, done)
+            if doc is done:
+                break
+            await send({'type': 'http.response.body', 'body': json.dumps(doc, default=str).encode('utf-8') + b'\n',
+                        'more_body': True})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+def create_app(path='serverless.yml'):
+    from src import aio, util, invalidation
+
+    routes = dict()
+    for handler_path, http_config in serverless_functions(path):
+        handler = aio.HANDLERS.get(handler_path) or in_thread(load_handler(handler_path))
+        routes[(http_config['method'].upper(), '/' + http_config['path'])] = handler
+
+    async def pool(event, context):
+        # this worker's connection pool counters, for tuning DB_CLIENT_OPTIONS
+        return {'statusCode': 200, 'body': util.pool_metrics()}
+    routes[('GET', '/_pool')] = pool
+
+    async def app(scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    invalidation.start()
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    invalidation.bus.stop()
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+        if scope['type'] != 'http':
+            return
+
+        handler = routes.get((scope['method'], scope['path']))
+        if handler is None:
+            return await respond(send, 404, 'Not found')
+        try:
+            event = json.loads(await read_body(receive) or b'{}')
+        except ValueError:
+            return await respond(send, 400, 'Error in JSON: could not parse the body')
+        try:
+            aws_val = await handler(event, None)
+        except Exception:
+            # like Flask does for main.py, rather than dropping the connection without an answer
+            logger.exception('%s %s failed', scope['method'], scope['path'])
+            return await respond(send, 500, 'Internal server error')
+        body = aws_val.get('body', aws_val)
+        if inspect.isasyncgen(body) or inspect.isgenerator(body):
+            return await stream(send, aws_val.get('statusCode', 200), body)
+        await respond(send, aws_val.get('statusCode', 200), aws_val.get('body', aws_val))
+
+    return app
@@ -0,0 +1,95 @@
+"""
+Benchmark for attend_event's check-in: the old read-check-update (two or three round trips)
+against the single conditional find_one_and_update.
+
+Reports the latency of each, and how many of a burst of concurrent scans of the same badge
+get checked in (only one should). Runs against the configured database, on a scratch
+collection it drops afterwards.
+
+Run from the repository root with a config.py present:
+    python -m benchmarks.bench_checkin [users] [concurrent scans]
+"""
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pymongo
+
+from src import util
+from src.qrscan import checkin_update, checkin_result
+
+SCRATCH = 'benchCheckins'
+
+
+def old_attend(users, qr, event, again=False):
+    user = users.find_one({'email': qr})
+    if user is None:
+        user = users.find_one({'qrcode': qr})
+    if user is None:
+        return {'statusCode': 404, 'body': 'user not found'}
+    if not again and user.get('day_of', {}).get(event, 0) > 0:
+        return {'statusCode': 402, 'body': 'user already checked into event'}
+    new_user = users.find_one_and_update({'email': user['email']}, {'$inc': {'day_of.' + event: 1}},
+                                         return_document=pymongo.ReturnDocument.AFTER)
+    return {'statusCode': 200, 'body': {'email': user['email'], 'new_count': new_user['day_of'][event]}}
+
+
+def new_attend(users, qr, event, again=False):
+    identity, match, update, projection = checkin_update(qr, event, again)
+    new_user = users.find_one_and_update(match, update, projection=projection,
+                                         return_document=pymongo.ReturnDocument.AFTER)
+    already_in = new_user is None and not again and users.find_one(identity, {'_id': True}) is not None
+    return checkin_result(new_user, event, already_in)
+
+
+def reset(users, count):
+    users.delete_many({})
+    users.insert_many([{'email': 'hacker{}@hackru.org'.format(i), 'qrcode': ['qr-{}'.format(i)], 'day_of': {}}
+                       for i in range(count)])
+    users.create_index('email', unique=True)
+    users.create_index('qrcode')
+
+
+def percentile(times, p):
+    ordered = sorted(times)
+    return 1000 * ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+
+def latency(users, attend, count, event):
+    # scanning by QR code is the old version's slow path (it looks the email up first)
+    times = []
+    for i in range(count):
+        start = time.perf_counter()
+        assert attend(users, 'qr-{}'.format(i), event)['statusCode'] == 200
+        times.append(time.perf_counter() - start)
+    return percentile(times, 0.5), percentile(times, 0.99)
+
+
+def duplicates(users, attend, scans, event, trials=20):
+    """
+    The most check-ins a burst of concurrent scans of one badge got through, over a few bursts.
+    """
+    worst = 0
+    with ThreadPoolExecutor(max_workers=scans) as pool:
+        for trial in range(trials):
+            qr = 'qr-{}'.format(trial)
+            results = list(pool.map(lambda _: attend(users, qr, event)['statusCode'], range(scans)))
+            worst = max(worst, results.count(200))
+    return worst
+
+
+def bench(count, scans):
+    users = util.get_db()[SCRATCH]
+    try:
+        print("{:<22} {:>10} {:>10} {:>22}".format("check-in", "p50", "p99", "checked in per burst"))
+        for name, attend in (("read, check, update", old_attend), ("conditional update", new_attend)):
+            reset(users, count)
+            p50, p99 = latency(users, attend, count, 'lunch')
+            worst = duplicates(users, attend, scans, 'dinner')
+            print("{:<22} {:>8.2f}ms {:>8.2f}ms {:>19}/{}".format(name, p50, p99, worst, 1))
+    finally:
+        users.drop()
+
+
+if __name__ == "__main__":
+    bench(int(sys.argv[1]) if len(sys.argv) > 1 else 500, int(sys.argv[2]) if len(sys.argv) > 2 else 16)
@@ -0,0 +1,59 @@
+"""
+Reports how long each lambda in serverless.yml takes to import, ie. the part of its
+cold start that is down to us, and which packages that time goes to.
+
+Each handler is imported in a fresh interpreter (as a cold lambda would). On python 3.7+
+the time is broken down by top-level package using -X importtime.
+
+Run from the repository root with a config.py present:
+    python -m benchmarks.import_audit [serverless.yml] [number of packages to list]
+"""
+import subprocess
+import sys
+from collections import defaultdict
+
+from main import serverless_functions
+
+TIMER = """
+import time
+start = time.perf_counter()
+from {module} import {fn}
+print('wall', time.perf_counter() - start)
+"""
+
+
+def audit_handler(handler_path):
+    """
+    The wall time to import the handler, and the import time (in us) of each top-level package.
+    """
+    import_path, fn_name = handler_path.split('.')
+    module = import_path.replace('/', '.')
+    flags = ['-X', 'importtime'] if sys.version_info >= (3, 7) else []
+    done = subprocess.run([sys.executable] + flags + ['-c', TIMER.format(module=module, fn=fn_name)],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    wall = float(done.stdout.split()[-1])
+
+    packages = defaultdict(int)
+    for line in done.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        own, _, name = line[len('import time:'):].split('|')
+        # a module's own time, so nothing is counted twice when packages import each other
+        packages[name.strip().split('.')[0]] += int(own)
+    return wall, packages
+
+
+def main(argv):
+    path = argv[1] if len(argv) > 1 else 'serverless.yml'
+    top = int(argv[2]) if len(argv) > 2 else 5
+    for handler_path, http_config in serverless_functions(path):
+        wall, packages = audit_handler(handler_path)
+        heaviest = sorted(packages.items(), key=lambda item: -item[1])[:top]
+        print('{:<26} {:>8.1f}ms  {}'.format(
+            '/' + http_config['path'], 1000 * wall,
+            ', '.join('{} {:.1f}ms'.format(name, us / 1000) for name, us in heaviest)))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -7,9 +7,110 @@ DB_PASSWORD = "dat boi's secret"
 DB_COLLECTIONS = {
     "users": "users",
     "magic links": "magicLinks",
-    "events": "events"
+    "events": "events",
+    "revoked tokens": "revokedTokens",
+    "tokens": "tokens",
+    "stats": "publicStats",
+    "check ins": "checkIns",
+    "qr codes": "qrCodes",
+    "attendance": "attendance",
+    "distances": "distances",
+    "watermarks": "watermarks",
+    "exports": "exports"
 }
 
 # Json webtoken
 JWT_SECRET = "D9E8A570628A0FC66D267B115BCA343EC31070D68124EA8003494B8676FE32A0"
 JWT_ALGO = "HS256"
+# trust a token's signature (and a cache of revoked tokens) instead of looking its user up on every request
+JWT_STATELESS = False
+# how often, in seconds, the cache of revoked tokens is refreshed from the DB
+REVOCATION_REFRESH_SECONDS = 60
+# where issued tokens are kept: "user" (an array on the user) or "collection" (hashes in their own collection)
+TOKEN_STORE = "user"
+# the most tokens (ie. simultaneous logins) a user can have, the oldest are dropped first
+MAX_TOKENS_PER_USER = 10
+# bcrypt cost for password hashes, if unset it is calibrated to take about BCRYPT_TARGET_MS per hash
+# (stored hashes with a lower cost are rehashed when their user logs in). Pin it when deployed, since
+# every process calibrates on its own.
+BCRYPT_ROUNDS = None
+BCRYPT_TARGET_MS = 100
+# when self-hosting, hash passwords in this many worker processes (0 hashes on the request thread)
+BCRYPT_POOL_WORKERS = 0
+# how many hashes may wait for a worker before logins are turned away with a 429
+BCRYPT_POOL_QUEUE = 8
+# how long, in seconds, a public read's counts are cached in memory
+PUBLIC_STATS_TTL = 30
+# limits on the arbitrary queries read_info runs: server-side time (ms) and results (bigger reads have to be paged)
+QUERY_MAX_TIME_MS = 5000
+QUERY_MAX_RESULTS = 10000
+# queries on collections at least this big are explained first, and a full collection scan is
+# "reject"ed or only logged ("warn")
+QUERY_EXPLAIN_MIN_DOCS = 10000
+QUERY_COLLSCAN_ACTION = "reject"
+# where exports are written: an S3 location (ie. "s3://bucket/exports") or, only when self-hosted, a local
+# directory, with an optional endpoint for S3-compatible stores and how long (in seconds) the returned links
+# work. Export jobs (and so their status) are kept for EXPORT_JOB_TTL_HOURS
+EXPORT_LOCATION = "s3://lcs-exports/exports"
+EXPORT_S3_ENDPOINT = None
+EXPORT_URL_EXPIRES = 3600
+EXPORT_JOB_TTL_HOURS = 24
+# how many users are read and written at a time
+EXPORT_CHUNK_SIZE = 1000
+# where each workload's reads go (anything not listed reads from the primary), ie.
+# {"analytics": {"mode": "secondaryPreferred", "max_staleness": 90}} sends read_info, public reads
+# and exports to a secondary at most 90 seconds behind; "events" covers find_events
+READ_PREFERENCES = {
+    "analytics": {"mode": "secondaryPreferred", "max_staleness": 90},
+    "events": {"mode": "secondaryPreferred", "max_staleness": 90},
+}
+# the database to use and the MongoClient's pool options. Every concurrent lambda (or server worker) has its
+# own pool, so maxPoolSize times the concurrency has to fit in the cluster's connection limit.
+# zstd and snappy compression need the zstandard and python-snappy packages (ie. "zstd,snappy,zlib").
+# GET /_pool on the self-hosted servers shows the pool counters.
+DB_NAME = "test"
+DB_CLIENT_OPTIONS = {
+    "maxPoolSize": 10,
+    "minPoolSize": 0,
+    "maxIdleTimeMS": 60000,
+    "serverSelectionTimeoutMS": 5000,
+    "compressors": "zlib",
+}
+# send the lambdas' database operations through the data-access proxy (python -m src.dbproxy) at this
+# address, ie. "tcp://10.0.0.5:27100", so they share its pool of DB_PROXY_POOL_SIZE connections.
+# The secret, if set, has to match on both ends; the proxy won't bind to anything but loopback without one.
+DB_PROXY_URL = None
+DB_PROXY_POOL_SIZE = 50
+DB_PROXY_SECRET = None
+DB_PROXY_TIMEOUT = 30
+# how long, in seconds, the proxy keeps a quiet connection open (a frozen lambda's would otherwise hold a
+# thread); the lambdas send again on a fresh connection when they find theirs closed
+DB_PROXY_IDLE_TIMEOUT = 60
+# how long, in hours, the keys of batched check-ins are kept, ie. how late a scanner may replay its queue
+CHECKIN_KEY_TTL_HOURS = 72
+# how long, in seconds, a batch of check-ins may go unanswered before a replay drives it again (ie. its
+# request died), and how many of the batches' marks each user keeps to tell what already landed
+CHECKIN_LEASE_SECONDS = 60
+CHECKIN_MARKS_KEPT = 20
+# how many QR codes' users are kept in memory, and for how long (in seconds) they're trusted
+QR_CACHE_SIZE = 10000
+QR_CACHE_TTL = 300
+# how long, in seconds, the attendance counts are cached for the live dashboards
+ATTENDANCE_TTL = 2
+# let the self-hosted servers' caches follow the database's change stream. A standalone mongod has
+# none; INVALIDATION_POLL makes them poll its dbHash every INVALIDATION_POLL_SECONDS instead, which
+# rereads the watched collections each time, so it's only meant for tests
+INVALIDATION_BUS = True
+INVALIDATION_POLL = False
+INVALIDATION_POLL_SECONDS = 2
+# where distances fetched for reimbursements are cached: "mongo" (the distances collection), a JSON file or None
+DISTANCE_CACHE = "mongo"
+# the Distance Matrix API (ie. a local stub, see tests/maps_stub.py), and how hard it's used: concurrent requests,
+# requests per second, and retries (backing off exponentially from MAPS_BACKOFF_SECONDS) when it's busy
+MAPS_API_URL = "https://maps.googleapis.com/maps/api/distancematrix/json"
+MAPS_CONCURRENCY = 4
+MAPS_REQUESTS_PER_SECOND = 10
+MAPS_RETRIES = 4
+MAPS_BACKOFF_SECONDS = 0.5
+# how many users a reimbursement run reads, looks up and writes at a time
+REIMBURSE_CHUNK_SIZE = 500
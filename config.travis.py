@@ -9,7 +9,16 @@ DB_URI = DB_URI_LOCAL
 DB_COLLECTIONS = {
     "users": "users",
     "magic links": "magicLinks",
-    "slack messages": "slackMessages"
+    "slack messages": "slackMessages",
+    "revoked tokens": "revokedTokens",
+    "tokens": "tokens",
+    "stats": "publicStats",
+    "check ins": "checkIns",
+    "qr codes": "qrCodes",
+    "attendance": "attendance",
+    "distances": "distances",
+    "watermarks": "watermarks",
+    "exports": "exports"
 }
 
 SPARKPOST_KEY = os.getenv("TRAVIS_SPARKPOST_KEY", "")
@@ -62,3 +71,6 @@ WAIVER_BUCKET = "waivert"
 # Json webtoken
 JWT_SECRET = os.getenv("TRAVIS_JWT_SECRET", "")
 JWT_ALGO = os.getenv("TRAVIS_JWT_ALGO", "")
+
+# the CI mongod is standalone, so the caches poll it for changes
+INVALIDATION_POLL = True
@@ -8,7 +8,16 @@ DB_URI = DB_URI_LOCAL
 DB_COLLECTIONS = {
     "users": "users",
     "magic links": "magicLinks",
-    "slack messages": "slackMessages"
+    "slack messages": "slackMessages",
+    "revoked tokens": "revokedTokens",
+    "tokens": "tokens",
+    "stats": "publicStats",
+    "check ins": "checkIns",
+    "qr codes": "qrCodes",
+    "attendance": "attendance",
+    "distances": "distances",
+    "watermarks": "watermarks",
+    "exports": "exports"
 }
 
 SPARKPOST_KEY = os.getenv("DEVELOP_SPARKPOST_KEY", "")
@@ -59,3 +68,6 @@ WAIVER_BUCKET = os.getenv("DEVELOP_WAIVER_BUCKET", "")
 # Json webtoken
 JWT_SECRET = os.getenv("DEVELOP_JWT_SECRET", "")
 JWT_ALGO = os.getenv("DEVELOP_JWT_ALGO", "")
+
+# bcrypt cost of password hashes, pinned so every lambda agrees on it (see src/passwords.py)
+BCRYPT_ROUNDS = 8
@@ -9,7 +9,16 @@ DB_URI = os.getenv("PRODUCTION_DB_URI", "")
 DB_COLLECTIONS = {
     "users": "users",
     "magic links": "magicLinks",
-    "slack messages": "slackMessages"
+    "slack messages": "slackMessages",
+    "revoked tokens": "revokedTokens",
+    "tokens": "tokens",
+    "stats": "publicStats",
+    "check ins": "checkIns",
+    "qr codes": "qrCodes",
+    "attendance": "attendance",
+    "distances": "distances",
+    "watermarks": "watermarks",
+    "exports": "exports"
 }
 
 SPARKPOST_KEY = os.getenv("PRODUCTION_SPARKPOST_KEY", "")
@@ -61,3 +70,6 @@ WAIVER_BUCKET = os.getenv("PRODUCTION_WAIVER_BUCKET", "")
 # Json webtoken
 JWT_SECRET = os.getenv("PRODUCTION_JWT_SECRET", "")
 JWT_ALGO = os.getenv("PRODUCTION_JWT_ALGO", "")
+
+# bcrypt cost of password hashes, pinned so every lambda agrees on it (see src/passwords.py)
+BCRYPT_ROUNDS = 8
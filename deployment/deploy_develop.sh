@@ -5,6 +5,9 @@ echo "Copying config"
 #Copy the config
 cp ./deployment/config.dev.py config.py
 
+echo "Ensuring DB indexes"
+python -m src.indexes ensure || { echo "Could not ensure indexes, see above or run python -m src.indexes verify"; exit 1; }
+
 #Exporting necessary environment variables
 echo "Setting up environment variables for permissions"
 
@@ -0,0 +1,182 @@
+"""
+Builds a slim deployment zip per function in serverless.yml, holding only the src modules the
+handler can import and the requirements those modules use (rather than all of src and the whole
+requirements.txt). Reports each zip's size and how long the handler takes to import from it.
+
+Run from the repository root with a config.py present:
+    python deployment/package_functions.py [--out build/functions] [--only authorize,read]
+
+Each artifact can then be deployed with `package: {individually: true}` and an `artifact:` per function.
+For artifacts that run on Lambda (rather than this machine), pass pip the Lambda platform, ie.
+    --pip-args="--platform manylinux2014_x86_64 --python-version 3.6 --only-binary=:all:"
+"""
+import argparse
+import ast
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import zipfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+
+from main import serverless_functions
+
+# modules that don't share their name with the requirement providing them
+IMPORT_TO_REQUIREMENT = {
+    'jwt': 'PyJWT',
+    'yaml': 'PyYAML',
+    'bson': 'pymongo',
+    'gridfs': 'pymongo',
+    'flask': 'Flask',
+    'dateutil': 'python-dateutil',
+    'googleapiclient': 'google-api-python-client',
+}
+# our own top-level modules, which are copied rather than installed
+LOCAL_MODULES = {'src', 'config'}
+
+
+def module_path(module):
+    return os.path.join(ROOT, *module.split('.')) + '.py'
+
+
+def imports_of(module):
+    """
+    Every module name the (local) module imports, including imports made lazily inside functions,
+    since those still have to be there when the function runs.
+    """
+    with open(module_path(module)) as source:
+        tree = ast.parse(source.read())
+    found = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            found.update(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module is not None:
+            found.add(node.module)
+            # from src import util imports the src.util module
+            found.update(node.module + '.' + alias.name for alias in node.names
+                         if os.path.exists(module_path(node.module + '.' + alias.name)))
+    return found
+
+
+def import_closure(module):
+    """
+    The local modules and third party top-level packages the module needs, transitively.
+    """
+    local, external = set(), set()
+    pending = [module]
+    while pending:
+        current = pending.pop()
+        if current in local:
+            continue
+        local.add(current)
+        for name in imports_of(current):
+            if name.split('.')[0] not in LOCAL_MODULES:
+                external.add(name.split('.')[0])
+            elif os.path.exists(module_path(name)):
+                pending.append(name)
+    return local, external
+
+
+def is_stdlib(name):
+    if name in sys.builtin_module_names:
+        return True
+    if hasattr(sys, 'stdlib_module_names'):
+        return name in sys.stdlib_module_names
+    import importlib.util
+    spec = importlib.util.find_spec(name)
+    if spec is None or spec.origin is None:
+        return False
+    return 'site-packages' not in spec.origin and 'dist-packages' not in spec.origin
+
+
+def pinned_requirements(path=os.path.join(ROOT, 'requirements.txt')):
+    with open(path) as reqs:
+        lines = [line.strip() for line in reqs if line.strip() and not line.startswith('#')]
+    return {line.split('==')[0].lower(): line for line in lines}
+
+
+def requirements_for(external, pinned):
+    needed = set()
+    for name in external:
+        if is_stdlib(name):
+            continue
+        requirement = IMPORT_TO_REQUIREMENT.get(name, name).lower()
+        needed.add(pinned.get(requirement, requirement))
+    return sorted(needed)
+
+
+def build(function, handler_path, out, pinned, pip_args):
+    """
+    Builds the function's zip, returning its path and the requirements that went in it.
+    """
+    module = handler_path.split('.')[0].replace('/', '.')
+    local, external = import_closure(module)
+    requirements = requirements_for(external, pinned)
+
+    staging = os.path.join(out, function)
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+    if requirements:
+        subprocess.run([sys.executable, '-m', 'pip', 'install', '--quiet', '--target', staging]
+                       + pip_args + requirements, check=True)
+    for local_module in sorted(local | {'src', 'config'}):
+        source = module_path(local_module) if local_module != 'src' else os.path.join(ROOT, 'src', '__init__.py')
+        destination = os.path.join(staging, os.path.relpath(source, ROOT))
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        shutil.copy(source, destination)
+
+    artifact = staging + '.zip'
+    with zipfile.ZipFile(artifact, 'w', zipfile.ZIP_DEFLATED) as zipped:
+        for directory, _, files in os.walk(staging):
+            for name in files:
+                if name.endswith('.pyc'):
+                    continue
+                full = os.path.join(directory, name)
+                zipped.write(full, os.path.relpath(full, staging))
+    return staging, artifact, requirements
+
+
+def measure_init(staging, handler_path, runs=3):
+    """
+    The fastest of a few cold imports of the handler from its staged artifact, in seconds.
+    """
+    module, fn = handler_path.split('.')
+    timer = ("import time; start = time.perf_counter(); from {} import {}; "
+             "print(time.perf_counter() - start)").format(module.replace('/', '.'), fn)
+    env = dict(os.environ, PYTHONPATH=staging)
+    times = []
+    for _ in range(runs):
+        done = subprocess.run([sys.executable, '-S', '-c', 'import sys; sys.path.insert(0, "."); ' + timer],
+                              cwd=staging, env=env, stdout=subprocess.PIPE, universal_newlines=True, check=True)
+        times.append(float(done.stdout.split()[-1]))
+    return min(times)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Build a slim deployment zip per lambda.")
+    parser.add_argument('--config', default=os.path.join(ROOT, 'serverless.yml'))
+    parser.add_argument('--out', default=os.path.join(ROOT, 'build', 'functions'))
+    parser.add_argument('--only', help="comma separated handler paths or routes to build, ie. validate,read")
+    parser.add_argument('--pip-args', default='', help="extra arguments for pip install")
+    parser.add_argument('--no-measure', action='store_true', help="skip timing the imports")
+    args = parser.parse_args(argv)
+
+    pinned = pinned_requirements()
+    only = set(args.only.split(',')) if args.only else None
+    print('{:<20} {:>10} {:>10}  {}'.format('function', 'zip', 'init', 'requirements'))
+    for handler_path, http_config in serverless_functions(args.config, workers=True):
+        function = http_config['path'] if http_config else handler_path.split('.')[-1]
+        if only is not None and function not in only and handler_path not in only:
+            continue
+        staging, artifact, requirements = build(function, handler_path, args.out, pinned,
+                                                shlex.split(args.pip_args))
+        init = 'n/a' if args.no_measure else '{:.1f}ms'.format(1000 * measure_init(staging, handler_path))
+        print('{:<20} {:>8.1f}KB {:>10}  {}'.format(function, os.path.getsize(artifact) / 1024, init,
+                                                   ', '.join(requirements)))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
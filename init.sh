@@ -19,4 +19,5 @@ kill $MONGO_PID;
 
 echo "Everything looks OK."
 echo "Run 'mongod' and 'python main.py' in separate shells to start a flask server."
+echo "('python main.py --serve --workers N' runs a multi-worker production server instead.)"
 # or fork, if you roll that way.
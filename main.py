@@ -1,9 +1,13 @@
 import sys
+import json
+import types
+import argparse
 import importlib
+import multiprocessing
 
 import yaml
 
-from flask import jsonify, Flask
+from flask import jsonify, request, stream_with_context, Flask, Response
 
 class GenSym:
     def __init__(self):
@@ -24,24 +28,118 @@ def add_aws_lambda_to_flask(aws_lambda, yml_config, flask_app, sym):
     def handler():
         event = request.get_json()
         aws_val = aws_lambda(event, None)
-        return jsonify(aws_val.get('body', aws_val)), aws_val.get('statusCode', 200)
+        body = aws_val.get('body', aws_val)
+        if isinstance(body, types.GeneratorType):
+            return Response(stream_with_context(ndjson_lines(body)), status=aws_val.get('statusCode', 200),
+                            mimetype='application/x-ndjson')
+        return jsonify(body), aws_val.get('statusCode', 200)
+
+
+def ndjson_lines(docs):
+    """
+    Streams a generator body (ie. from read_info with "stream") as one JSON document per line
+    """
+    for doc in docs:
+        yield json.dumps(doc, default=str) + '\n'
     
 
-def read_serverless_yml(path, flask_app):
-    g = GenSym()
+def serverless_functions(path, workers=False):
+    """
+    The handler path (ie. src/read.read_info) and http config of every function in the serverless config.
+    Functions without an http event (ie. export-worker, which only lambdas invoke) aren't served, unless
+    workers is set, in which case their http config is None.
+    """
     with open(path) as yml_config:
         parsed = yaml.load(yml_config, Loader=yaml.SafeLoader)
     for function in parsed['functions']:
-        handler_path = parsed['functions'][function]['handler']
-        import_path, fn_name = handler_path.split('.')
-        import_path = import_path.replace('/', '.')
-        print('from {} import {}'.format(import_path, fn_name))
-        aws_lambda = getattr(importlib.import_module(import_path), fn_name)
-        http_config = parsed['functions'][function]['events'][0]['http']
-        add_aws_lambda_to_flask(aws_lambda, http_config, flask_app, g)
+        events = parsed['functions'][function].get('events') or [{}]
+        if 'http' in events[0] or workers:
+            yield parsed['functions'][function]['handler'], events[0].get('http')
 
 
-if __name__ == "__main__":
+def load_handler(handler_path):
+    import_path, fn_name = handler_path.split('.')
+    import_path = import_path.replace('/', '.')
+    print('from {} import {}'.format(import_path, fn_name))
+    return getattr(importlib.import_module(import_path), fn_name)
+
+
+def read_serverless_yml(path, flask_app):
+    g = GenSym()
+    for handler_path, http_config in serverless_functions(path):
+        add_aws_lambda_to_flask(load_handler(handler_path), http_config, flask_app, g)
+
+
+def create_app(path='serverless.yml'):
+    """
+    The flask app serving every lambda in the serverless config. This is also the
+    WSGI entry point for any server, ie. gunicorn 'main:create_app()'
+    """
+    from src import invalidation
+
     app = Flask(__name__)
-    read_serverless_yml('serverless.yml', app)
-    app.run()
+    read_serverless_yml(path, app)
+    # the caches in this process follow the database's changes
+    invalidation.start()
+
+    @app.route('/_pool', methods=('GET',))
+    def pool():
+        # this worker's connection pool counters, for tuning DB_CLIENT_OPTIONS
+        from src import util
+        return jsonify(util.pool_metrics())
+    return app
+
+
+def post_fork(server, worker):
+    # a MongoClient is not fork-safe, so each worker has to open its own pool
+    from src import util
+    util.reset_db()
+
+
+def serve(options, path='serverless.yml'):
+    """
+    Runs the app under gunicorn: pre-forked workers, each with its own Mongo client,
+    kept-alive connections and graceful reloads (send the master a SIGHUP).
+    """
+    from gunicorn.app.base import BaseApplication
+
+    class LCSApplication(BaseApplication):
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+            self.cfg.set('post_fork', post_fork)
+
+        def load(self):
+            return create_app(path)
+
+    LCSApplication().run()
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Serve the LCS lambdas over HTTP.")
+    parser.add_argument('--config', default='serverless.yml', help="the serverless config to read the routes from")
+    parser.add_argument('--serve', action='store_true',
+                        help="run a multi-worker production server instead of the flask dev server")
+    parser.add_argument('--bind', default='127.0.0.1:8000')
+    parser.add_argument('--workers', type=int, default=2 * multiprocessing.cpu_count() + 1)
+    parser.add_argument('--threads', type=int, default=4, help="threads per worker")
+    parser.add_argument('--keep-alive', type=int, default=5, help="seconds to hold idle connections open")
+    parser.add_argument('--timeout', type=int, default=30, help="seconds before a stuck worker is restarted")
+    parser.add_argument('--graceful-timeout', type=int, default=30,
+                        help="seconds workers get to finish their requests on reload or shutdown")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    if args.serve:
+        serve({
+            'bind': args.bind,
+            'workers': args.workers,
+            'threads': args.threads,
+            'keepalive': args.keep_alive,
+            'timeout': args.timeout,
+            'graceful_timeout': args.graceful_timeout,
+        }, args.config)
+    else:
+        create_app(args.config).run()
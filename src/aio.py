@@ -0,0 +1,410 @@
+"""
+Asyncio versions of the hot endpoints, for the self-hosted ASGI server (see asgi.py).
+
+They use motor instead of pymongo so a single process can wait on thousands of
+DB round trips at once. The validation, queries and responses are shared with the
+synchronous handlers, which stay the source of truth; endpoints without an async
+version are run by the ASGI server in a thread pool.
+"""
+import asyncio
+import inspect
+import time
+from functools import wraps
+from datetime import datetime
+
+import jsonschema as js
+import jwt
+import pymongo
+from motor.motor_asyncio import AsyncIOMotorClient
+
+import config
+from src import util, tokens, passwords, stats, querycost, qrcodes, attendance
+from src import authorize as authorize_lambdas, qrscan as qrscan_lambdas, read as read_lambdas
+from src import event as event_lambdas
+from src.schemas import compiled_validator, user_projection, has_roles
+
+_cached = None
+def get_db():
+    """
+    The motor counterpart of util.get_db, also cached so connections are pooled.
+    """
+    global _cached
+    if _cached is None:
+        _cached = AsyncIOMotorClient(util.db_uri(), **util.client_options())[util.db_name()]
+    return _cached
+
+
+def coll(collname, workload=None):
+    """
+    The motor counterpart of util.coll, routing the workload's reads the same way
+    """
+    if workload is None:
+        return get_db()[config.DB_COLLECTIONS[collname]]
+    return get_db().get_collection(config.DB_COLLECTIONS[collname], read_preference=util.read_preference(workload))
+
+
+async def _resolve(value):
+    # failure handlers may be plain functions or coroutines
+    if inspect.isawaitable(value):
+        return await value
+    return value
+
+
+def _in_thread(fn, *args):
+    return asyncio.get_event_loop().run_in_executor(None, fn, *args)
+
+
+def ensure_schema(schema, on_failure=lambda e, c, err: {"statusCode": 400, "body": "Error in JSON: {}".format(err)}):
+    """
+    Async version of schemas.ensure_schema, sharing its compiled validators
+    """
+    validator = compiled_validator(schema)
+    def wrap(fn):
+        @wraps(fn)
+        async def wrapt(event, context, *extras):
+            try:
+                validator.validate(event)
+            except js.exceptions.ValidationError as e:
+                return util.add_cors_headers(await _resolve(on_failure(event, context, e)))
+            return util.add_cors_headers(await fn(event, context, *extras))
+        wrapt.validator = validator
+        return wrapt
+    return wrap
+
+
+async def find_token_owner(email, token, projection=None):
+    """
+    Async version of tokens.find_token_owner
+    """
+    users = coll('users')
+    if tokens.uses_token_collection():
+        found = await coll('tokens').find_one({'hash': tokens.token_hash(token), 'email': email,
+                                               'expires': {'$gt': datetime.utcnow()}})
+        if found is None:
+            return None
+        return await users.find_one({'email': email}, projection)
+    return await users.find_one({'email': email, 'token': token}, projection)
+
+
+async def record_revocations(entries):
+    """
+    Async version of tokens.record_revocations
+    """
+    entries = [entry for entry in entries if entry is not None]
+    if entries:
+        await coll('revoked tokens').insert_many(entries)
+        for entry in entries:
+            tokens.revocations.revoked[entry['hash']] = entry['expires']
+
+
+async def store_token(email, token, expires):
+    """
+    Async version of tokens.store_token
+    """
+    max_tokens = getattr(config, 'MAX_TOKENS_PER_USER', 10)
+    if tokens.uses_token_collection():
+        tokens_coll = coll('tokens')
+        await tokens_coll.insert_one({'hash': tokens.token_hash(token), 'email': email, 'expires': expires})
+        newest_first = tokens_coll.find({'email': email}, {'hash': True, 'expires': True}).sort('expires', -1)
+        extra = [doc async for doc in newest_first.skip(max_tokens)]
+        if extra:
+            await tokens_coll.delete_many({'_id': {'$in': [doc['_id'] for doc in extra]}})
+            now = datetime.utcnow()
+            await record_revocations([{'hash': doc['hash'], 'email': email, 'expires': doc['expires']}
+                                      for doc in extra if doc['expires'] > now])
+        return
+
+    users = coll('users')
+    before = await users.find_one_and_update({'email': email},
+                                             {'$push': {'token': {'$each': [token], '$slice': -max_tokens}}},
+                                             projection={'_id': False, 'token': True})
+    stored = (before.get('token', []) if before is not None else []) + [token]
+    await record_revocations([tokens.revocation(email, dropped) for dropped in stored[:-max_tokens]])
+    expired = tokens.expired_tokens(stored[-max_tokens:])
+    if expired:
+        await users.update_one({'email': email}, {'$pull': {'token': {'$in': expired}}})
+
+
+def ensure_logged_in_user(token_key='token', on_failure=lambda e, c, m, *a: {"statusCode": 403, "body": m},
+                          fields=None):
+    """
+    Async version of schemas.ensure_logged_in_user. In the stateless mode, the user is only
+    fetched if the handler needs more than their email.
+    """
+    projection = user_projection(fields)
+    def rapper(fn):
+        @wraps(fn)
+        async def wrapt(event, context, *args):
+            token = event[token_key]
+            try:
+                decoded_payload = jwt.decode(token, config.JWT_SECRET, algorithms=[config.JWT_ALGO])
+            except jwt.exceptions.InvalidTokenError as err:
+                return await _resolve(on_failure(event, context, str(err), *args))
+
+            email = decoded_payload["email"]
+            if getattr(config, 'JWT_STATELESS', False):
+                if tokens.revocations.is_revoked(token):
+                    return await _resolve(on_failure(event, context, 'Unauthorized token', *args))
+                if fields == ['email']:
+                    return await fn(event, context, {'email': email}, *args)
+                user = await coll('users').find_one({'email': email}, projection)
+            else:
+                user = await find_token_owner(email, token, projection)
+            if user is None:
+                return await _resolve(on_failure(event, context, 'Unauthorized token', *args))
+            return await fn(event, context, user, *args)
+        return wrapt
+    return rapper
+
+
+def ensure_admin_user(on_failure=lambda e, c, u, *a: {"statusCode": 403, "body": "User does not have privileges."}):
+    """
+    Async version of schemas.ensure_admin_user
+    """
+    def ensure_auth_user(fn):
+        @wraps(fn)
+        async def wrapt(event, context, user, *args):
+            if user.get('is_admin', False):
+                return await fn(event, context, user, *args)
+            return await _resolve(on_failure(event, context, user, *args))
+        return wrapt
+    return ensure_auth_user
+
+
+def ensure_role(roles, on_failure=lambda e, c, u, *a: {"statusCode": 403, "body": "User does not have privileges."}):
+    """
+    Async version of schemas.ensure_role
+    """
+    def ensure_user_roles(fn):
+        @wraps(fn)
+        async def wrapt(event, context, user, *args):
+            if has_roles(user, roles):
+                return await fn(event, context, user, *args)
+            return await _resolve(on_failure(event, context, user, *args))
+        return wrapt
+    return ensure_user_roles
+
+
+@ensure_schema(authorize_lambdas.authorize.validator.schema)
+async def authorize(event, context):
+    """
+    Async version of authorize.authorize. The password is checked in a thread (or the hashing
+    pool) so the event loop keeps serving other requests.
+    """
+    email = event['email'].lower()
+    pass_ = event['password']
+
+    user_coll = coll('users')
+    checkhash = await user_coll.find_one({"email": email})
+    if checkhash is None:
+        return {"statusCode": 403, "body": "invalid email,hash combo"}
+    try:
+        if not await _in_thread(passwords.check_password, pass_, checkhash['password']):
+            return {"statusCode": 403, "body": "Wrong Password"}
+    except passwords.PoolFull:
+        return authorize_lambdas.too_many_logins()
+    if passwords.needs_rehash(checkhash['password']):
+        try:
+            rehashed = await _in_thread(passwords.hash_password, pass_)
+            await user_coll.update_one({"email": email}, {"$set": {"password": rehashed}})
+        except passwords.PoolFull:
+            pass
+
+    token, expires = authorize_lambdas.issue_token(email)
+    await store_token(email, token, expires)
+    return {
+        "statusCode": 200,
+        "isBase64Encoded": False,
+        "headers": {"Content-Type": "application/json"},
+        "body": {"token": token}
+    }
+
+
+@ensure_schema(qrscan_lambdas.qr_match.validator.schema)
+@ensure_logged_in_user(fields=qrscan_lambdas.CHECKIN_FIELDS)
+@ensure_role(qrscan_lambdas.CHECKIN_ROLES)
+async def qr_match(event, context, user=None):
+    """
+    Async version of qrscan.qr_match
+    """
+    result = await coll('users').update_one({'email': event["link_email"]}, {'$push': {'qrcode': event["qr_code"]}})
+    if result.matched_count == 1:
+        await coll('qr codes').update_one({'_id': event["qr_code"]}, {'$set': {'email': event["link_email"]}},
+                                          upsert=True)
+        qrcodes.forget(event["qr_code"])
+        return {"statusCode": 200, "body": "success"}
+    return {"statusCode": 404, "body": "User not found"}
+
+
+async def resolve_qr(qr):
+    """
+    Async version of qrcodes.resolve
+    """
+    email = qrcodes.cached(qr)
+    if email is None:
+        found = await coll('qr codes').find_one({'_id': qr})
+        if found is None:
+            return None
+        email = found['email']
+        qrcodes.remember(qr, email)
+    return email
+
+
+@ensure_schema(qrscan_lambdas.attend_event.validator.schema)
+@ensure_logged_in_user(fields=qrscan_lambdas.CHECKIN_FIELDS)
+@ensure_role(qrscan_lambdas.CHECKIN_ROLES)
+async def attend_event(aws_event, context, user=None):
+    """
+    Async version of qrscan.attend_event
+    """
+    users = coll('users')
+    event = aws_event['event']
+    again = aws_event.get('again', False)
+    identity, match, update, projection = qrscan_lambdas.checkin_update(aws_event['qr'], event, again,
+                                                                         await resolve_qr(aws_event['qr']))
+
+    new_user = await users.find_one_and_update(match, update, projection=projection,
+                                               return_document=pymongo.ReturnDocument.AFTER)
+    if new_user is not None:
+        await coll('attendance').update_one(*attendance.rollup_update(
+            event, 1, 1 if new_user['day_of'][event] == 1 else 0), upsert=True)
+    already_in = new_user is None and not again and await users.find_one(identity, {'_id': True}) is not None
+    return qrscan_lambdas.checkin_result(new_user, event, already_in)
+
+
+async def public_read(event, context):
+    """
+    Async version of read.public_read
+    """
+    # a cache hit is a dict lookup, and a miss only groups the small stats collection
+    return {"statusCode": 200, "body": await _in_thread(stats.public_stats, event)}
+
+
+async def user_read(event, context, user):
+    if event.get('aggregate', False):
+        return await public_read(event, context)
+    return read_lambdas.user_read(event, context, user)
+
+
+async def admit(users, query, pipeline=False, sort=None, limit=None):
+    """
+    Async version of querycost.admit_find (and admit_aggregate)
+    """
+    if not querycost.needs_explain(await users.estimated_document_count()):
+        return []
+    if pipeline:
+        explained = await get_db().command('aggregate', users.name, pipeline=query, explain=True)
+    else:
+        cursor = users.find(query)
+        if sort is not None:
+            cursor = cursor.sort(sort)
+        if limit is not None:
+            cursor = cursor.limit(limit)
+        explained = await cursor.explain()
+    return querycost.check_plan(users.name, query, explained)
+
+
+async def guarded(kind, users, query, stages, results):
+    started = time.perf_counter()
+    try:
+        found = await results.to_list(None)
+    except pymongo.errors.ExecutionTimeout:
+        raise querycost.timed_out(kind, users.name, query, stages, started)
+    querycost.log_query(kind, users.name, query, stages, started, len(found))
+    return querycost.over_cap(found)
+
+
+async def _stream(users, query, stages, cursor):
+    started = time.perf_counter()
+    count = 0
+    try:
+        async for doc in cursor:
+            count += 1
+            yield doc
+    except pymongo.errors.ExecutionTimeout:
+        querycost.log_query('stream', users.name, query, stages, started, count, timed_out=True)
+        yield querycost.stream_timed_out(count)
+        return
+    querycost.log_query('stream', users.name, query, stages, started, count)
+
+
+async def find_results(users, event):
+    """
+    Async version of read.find_results. The ASGI server can always stream.
+    """
+    try:
+        if 'limit' in event or 'after' in event:
+            query, projection, limit = read_lambdas.page_request(event)
+        else:
+            query, projection, limit = event['query'], read_lambdas.read_projection(event), None
+        cursor = users.find(query, projection).max_time_ms(querycost.max_time_ms())
+        if event.get('stream', False):
+            stages = await admit(users, query, sort=querycost.ID_ORDER)
+            return {"statusCode": 200, "body": _stream(users, query, stages, cursor.sort(querycost.ID_ORDER))}
+        if limit is None:
+            limit = querycost.max_results() + 1
+            stages = await admit(users, query, limit=limit)
+            return {"statusCode": 200, "body": await guarded('find', users, query, stages, cursor.limit(limit))}
+        stages = await admit(users, query, sort=querycost.ID_ORDER, limit=limit)
+        docs = await guarded('find', users, query, stages, cursor.sort(querycost.ID_ORDER).limit(limit))
+        return {"statusCode": 200, "body": read_lambdas.page_body(event, docs, limit)}
+    except querycost.QueryRejected as err:
+        return {"statusCode": err.status, "body": str(err)}
+    except read_lambdas.InvalidContinuation:
+        return {"statusCode": 400, "body": "invalid continuation"}
+
+
+@ensure_admin_user(on_failure=user_read)
+async def organizer_read(event, context, user):
+    """
+    Async version of read.organizer_read
+    """
+    if event.get('aggregate', False):
+        return await public_read(event, context)
+    return await find_results(coll('users', 'analytics'), event)
+
+
+@ensure_schema(read_lambdas.read_info.validator.schema)
+@ensure_logged_in_user(on_failure=lambda e, c, u, *a: public_read(e, c))
+@ensure_admin_user(on_failure=organizer_read)
+async def read_info(event, context, user=None):
+    """
+    Async version of read.read_info
+    """
+    users = coll('users', 'analytics')
+    if event.get('aggregate', False):
+        pipeline = event['query']
+        try:
+            stages = await admit(users, pipeline, pipeline=True)
+            found = users.aggregate(querycost.capped_pipeline(pipeline), maxTimeMS=querycost.max_time_ms())
+            return {"statusCode": 200, "body": await guarded('aggregate', users, pipeline, stages, found)}
+        except querycost.QueryRejected as err:
+            return {"statusCode": err.status, "body": str(err)}
+    return await find_results(users, event)
+
+
+@ensure_schema(event_lambdas.find_events.validator.schema)
+@ensure_logged_in_user(fields=["email"])
+async def find_events(event, context, user):
+    """
+    Async version of event.find_events
+    """
+    try:
+        parsed_start, parsed_end = event_lambdas.validate_times_in_dict(event)
+    except Exception as e:
+        return {"statusCode": 400, "body": str(e)}
+    found = coll('events', 'events').find(event_lambdas.events_query(user, parsed_start, parsed_end))
+    relevant = [event_lambdas.prepare_event_for_output(e) async for e in found]
+    if not relevant:
+        return {"statusCode": 404, "body": "No events found for the user in the given time frame"}
+    return {"statusCode": 200, "body": relevant}
+
+
+# the async handlers, by the handler path serverless.yml gives their synchronous versions
+HANDLERS = {
+    'src/authorize.authorize': authorize,
+    'src/qrscan.qr_match': qr_match,
+    'src/qrscan.attend_event': attend_event,
+    'src/read.read_info': read_info,
+    'src/event.find_events': find_events,
+}
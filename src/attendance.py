@@ -0,0 +1,119 @@
+"""
+Live attendance counts per day-of event.
+
+Check-ins are stored as day_of.<event> counters on each user, so counting who has had lunch
+means aggregating over every user. Instead, each successful check-in also bumps a rollup
+document per event of {_id: event, attendees, checkins, updated_at}: attendees counts the users
+checked in at least once and checkins every scan let through. Dashboards read those few
+documents (through a cache of ATTENDANCE_TTL seconds) with read_attendance.
+
+A rollup is bumped separately from the check-in it counts, so a check-in whose request dies in between
+is never counted. rebuild is how that drift is reconciled: it recounts every rollup from the users,
+and runs every few minutes as the attendance-rebuild lambda (self-hosted, schedule
+    python -m src.attendance rebuild
+instead). It's also how rollups are first made for check-ins from before they existed.
+"""
+import sys
+import threading
+from datetime import datetime
+
+from cachetools import TTLCache
+from pymongo import UpdateOne
+
+import config
+from src import util
+from src.schemas import ensure_schema, ensure_logged_in_user, ensure_admin_user
+
+_cache = TTLCache(maxsize=64, ttl=getattr(config, 'ATTENDANCE_TTL', 2))
+_cache_lock = threading.Lock()
+
+
+def rollup_update(event, checkins, attendees):
+    """
+    The filter and update adding the check-ins (and newly attending users) to the event's rollup.
+    """
+    return {'_id': event}, {'$inc': {'checkins': checkins, 'attendees': attendees},
+                            '$set': {'updated_at': datetime.utcnow()}}
+
+
+def record(event, checkins=1, attendees=0):
+    util.coll('attendance').update_one(*rollup_update(event, checkins, attendees), upsert=True)
+
+
+def record_many(increments):
+    """
+    Adds up a batch of check-ins, given as {event: (checkins, attendees)}, in one write.
+    """
+    ops = [UpdateOne(*rollup_update(event, checkins, attendees), upsert=True)
+           for event, (checkins, attendees) in increments.items()]
+    if ops:
+        util.coll('attendance').bulk_write(ops, ordered=False)
+
+
+def rebuild():
+    """
+    Recounts every event's rollup from the users' day_of counters. The counts are written to a new
+    collection that then replaces the rollups in one go ($out), so they're never seen half rebuilt.
+    """
+    pipeline = [
+        {'$match': {'day_of': {'$type': 'object'}}},
+        {'$project': {'day_of': {'$objectToArray': '$day_of'}}},
+        {'$unwind': '$day_of'},
+        {'$match': {'day_of.v': {'$gt': 0}}},
+        {'$group': {'_id': '$day_of.k', 'attendees': {'$sum': 1}, 'checkins': {'$sum': '$day_of.v'}}},
+        {'$addFields': {'updated_at': {'$literal': datetime.utcnow()}}},
+        {'$out': config.DB_COLLECTIONS['attendance']},
+    ]
+    list(util.coll('users').aggregate(pipeline))
+    with _cache_lock:
+        _cache.clear()
+    return util.coll('attendance').count_documents({})
+
+
+def rebuild_rollups(event, context):
+    """
+    The scheduled attendance-rebuild lambda, reconciling the rollups with the check-ins
+    """
+    return {"statusCode": 200, "body": {"events": rebuild()}}
+
+
+def counts(events=None):
+    """
+    The rollups of the given events (or all of them), by event.
+    """
+    cache_key = tuple(sorted(events)) if events is not None else None
+    with _cache_lock:
+        found = _cache.get(cache_key)
+    if found is None:
+        query = {'_id': {'$in': list(events)}} if events is not None else {}
+        found = dict()
+        for rollup in util.coll('attendance').find(query):
+            found[rollup['_id']] = {'attendees': rollup['attendees'], 'checkins': rollup['checkins'],
+                                    'updated_at': rollup['updated_at'].isoformat() + 'Z'}
+        with _cache_lock:
+            _cache[cache_key] = found
+    return found
+
+
+@ensure_schema({
+    "type": "object",
+    "properties": {
+        "token": {"type": "string"},
+        "events": {"type": "array", "items": {"type": "string"}, "uniqueItems": True}
+    },
+    "required": ["token"]
+})
+@ensure_logged_in_user(fields=["email", "is_admin"])
+@ensure_admin_user()
+def read_attendance(event, context, user=None):
+    """
+    Function used to get how many users have checked into each day-of event (and how many scans there were)
+    """
+    return {"statusCode": 200, "body": counts(event.get('events'))}
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ['rebuild']:
+        print('{} events counted'.format(rebuild()))
+    else:
+        print(__doc__)
@@ -1,9 +1,33 @@
 import json
 from datetime import datetime, timedelta
-import bcrypt
 import jwt
 from src.schemas import *
-from src import util, consume
+from src import util, consume, tokens, passwords, stats
+
+def too_many_logins():
+    """
+    The response when too many passwords are already waiting to be hashed (a new dict each time,
+    since the CORS headers are added to it).
+    """
+    return {"statusCode": 429, "body": "Too many logins at once, please try again shortly"}
+
+
+def issue_token(email):
+    """
+    Builds a new auth token for the user, returning it with its (UTC) expiry time.
+    """
+    # Build a JWT to use as an authentication token, put embedded within its payload the email
+    # along with an expiration timestamp in the format of a js NumericDate (as that is what is required
+    # for JWT's authentication scheme
+    exp = datetime.now() + timedelta(days=3)
+    payload = {
+        "email": email,
+        "exp": int(exp.timestamp()),
+    }
+
+    encoded_jwt = jwt.encode(payload, config.JWT_SECRET, algorithm=config.JWT_ALGO)
+    # Encoded jwt is type bytes, json does not like raw bytes so convert to string
+    return encoded_jwt.decode("utf-8"), datetime.utcfromtimestamp(payload["exp"])
 
 
 @ensure_schema({
@@ -34,27 +58,28 @@ def authorize(event, context):
     # if the data was found, then password is verified
     if checkhash is not None:
         # if the hash of the given and stored password are different, then it's the wrong password
-        if not bcrypt.checkpw(pass_.encode('utf-8'), checkhash['password']):
-            return util.add_cors_headers({"statusCode": 403, "body": "Wrong Password"})
+        try:
+            if not passwords.check_password(pass_, checkhash['password']):
+                return util.add_cors_headers({"statusCode": 403, "body": "Wrong Password"})
+        except passwords.PoolFull:
+            return util.add_cors_headers(too_many_logins())
+        # the password is right, so this is our chance to bring its hash up to the current policy
+        if passwords.needs_rehash(checkhash['password']):
+            try:
+                user_coll.update_one({"email": email}, {"$set": {"password": passwords.hash_password(pass_)}})
+            except passwords.PoolFull:
+                # the upgrade can wait for another login, the user shouldn't
+                pass
     # if no data is found associated with the given email, error is returned
     else:
         return util.add_cors_headers({"statusCode": 403, "body": "invalid email,hash combo"})
-    # Build a JWT to use as an authentication token, put embedded within its payload the email
-    # along with an expiration timestamp in the format of a js NumericDate (as that is what is required
-    # for JWT's authentication scheme
-    exp = datetime.now() + timedelta(days=3)
-    payload = {
-        "email": email,
-        "exp": int(exp.timestamp()),
-    }
-
-    encoded_jwt = jwt.encode(payload, config.JWT_SECRET, algorithm=config.JWT_ALGO)
+    token, expires = issue_token(email)
     update_val = {
-        "token": encoded_jwt.decode("utf-8"), # Encoded jwt is type bytes, json does not like raw bytes so convert to string
+        "token": token,
     }
 
-    # appends the newly generated token to the list of auth tokens associated with this user
-    user_coll.update_one({"email": email}, {"$push": update_val})
+    # stores the newly generated token with the user's other auth tokens, dropping the stale ones
+    tokens.store_token(email, token, expires)
 
     # return the value pushed, that is, auth token with expiry time.
     ret_val = {
@@ -66,6 +91,23 @@ def authorize(event, context):
     return util.add_cors_headers(ret_val)
 
 
+@ensure_schema({
+    "type": "object",
+    "properties": {
+        "token": {"type": "string"}
+    },
+    "required": ["token"]
+})
+@ensure_logged_in_user(fields=["email"])
+def logout(event, context, user=None):
+    """
+    The logout endpoint. Revokes the given token, so it can't be used again even
+    though its signature is still good.
+    """
+    tokens.revoke_token(user['email'], event['token'])
+    return util.add_cors_headers({"statusCode": 200, "body": "Logged out"})
+
+
 # NOT A LAMBDA
 def authorize_then_consume(event, context):
     rv = authorize(event, context)
@@ -101,7 +143,10 @@ def create_user(event, context):
     u_email = event['email'].lower()
     password = event['password']
     # password is hashed with a salt
-    password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=8))
+    try:
+        password = passwords.hash_password(password)
+    except passwords.PoolFull:
+        return util.add_cors_headers(too_many_logins())
 
     # the collection of users is fetched
     user_coll = util.coll('users')
@@ -132,6 +177,7 @@ def create_user(event, context):
 
     # inserts the newly created user into the collection
     user_coll.insert_one(doc)
+    stats.record_change(None, doc)
 
     # calls the function to also consume any links provided
     return authorize_then_consume(event, context)
@@ -1,7 +1,5 @@
 from src.schemas import *
-from src import util
-
-import bcrypt
+from src import util, passwords
 
 
 @ensure_schema({
@@ -11,7 +9,7 @@ import bcrypt
     },
     "required": ["token"]
 })
-@ensure_logged_in_user()
+@ensure_logged_in_user(fields=["email"])
 def promotion_link(event, maglinkobj, user=None):
     """
     Function used to update an user based on a magic link
@@ -35,7 +33,10 @@ def forgot_password_link(event, user_coll, maglinkobj):
     """
     # the new password is fetched from the given object and then hashed with a salt
     pass_ = event['password']
-    pass_ = bcrypt.hashpw(pass_.encode('utf-8'), bcrypt.gensalt(rounds=8))
+    try:
+        pass_ = passwords.hash_password(pass_)
+    except passwords.PoolFull:
+        return {"statusCode": 429, "body": "Too many requests at once, please try again shortly"}
     # verifies that the user exists (and complain if they don't)
     user_data = user_coll.find_one({"email": maglinkobj['email']})
     if user_data is None:
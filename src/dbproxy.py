@@ -0,0 +1,494 @@
+"""
+An optional data-access proxy, so a registration rush of lambdas doesn't exhaust the cluster's connections.
+
+Each warm lambda keeps its own connection pool, so hundreds of concurrent containers mean hundreds of
+pools. With config.DB_PROXY_URL set (ie. "tcp://10.0.0.5:27100"), util.coll hands out collections that
+send their operations to this proxy instead, which runs them over one pool of DB_PROXY_POOL_SIZE
+connections. Run it somewhere the lambdas can reach (or locally, for tests) with
+    python -m src.dbproxy [--bind 127.0.0.1:27100]
+
+The protocol is BSON documents over TCP (a BSON document starts with its own length, so that's the
+framing). A request is {auth, coll, workload, op, args}; the reply is {ok: true, result} or, for the
+reads that return many documents, a series of {ok: true, batch, more} frames ending with more: false.
+Failures come back as {ok: false, error, message, code, details} and are raised again on the client
+as the same pymongo error. Only the operations the handlers use are supported.
+"""
+import argparse
+import hmac
+import ipaddress
+import socket
+import socketserver
+import threading
+import urllib.parse
+from types import SimpleNamespace
+
+import bson
+from bson import ObjectId
+from pymongo import errors, InsertOne, UpdateOne, UpdateMany, DeleteOne, DeleteMany, ReplaceOne
+
+import config
+
+BATCH_SIZE = 500
+_HEADER = 4
+
+
+class ProxyError(errors.PyMongoError):
+    """
+    Raised for a failure of the proxy itself (rather than of the operation it ran).
+    """
+
+
+def send_doc(sock, doc):
+    sock.sendall(bson.encode(doc))
+
+
+def _read_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data.extend(chunk)
+    return bytes(data)
+
+
+def recv_doc(sock):
+    """
+    The next document on the socket, or None if the other end hung up.
+    """
+    header = _read_exactly(sock, _HEADER)
+    if header is None:
+        return None
+    rest = _read_exactly(sock, int.from_bytes(header, 'little') - _HEADER)
+    if rest is None:
+        return None
+    return bson.decode(header + rest)
+
+
+def error_reply(err):
+    return {'ok': False, 'error': type(err).__name__, 'message': str(err),
+            'code': getattr(err, 'code', None), 'details': getattr(err, 'details', None)}
+
+
+def raise_reply(reply):
+    """
+    Raises the error in a failed reply as the pymongo error it was on the proxy.
+    """
+    cls = getattr(errors, reply['error'], None)
+    if not isinstance(cls, type) or not issubclass(cls, errors.PyMongoError):
+        raise ProxyError('{}: {}'.format(reply['error'], reply['message']))
+    if issubclass(cls, errors.BulkWriteError):
+        raise cls(reply['details'])
+    if issubclass(cls, errors.OperationFailure):
+        raise cls(reply['message'], reply['code'], reply['details'])
+    raise cls(reply['message'])
+
+
+# bulk operations as sent over the wire, by their pymongo class
+_BULK_OPS = {'InsertOne': InsertOne, 'UpdateOne': UpdateOne, 'UpdateMany': UpdateMany,
+             'DeleteOne': DeleteOne, 'DeleteMany': DeleteMany, 'ReplaceOne': ReplaceOne}
+
+
+def encode_bulk_op(op):
+    fields = {'type': type(op).__name__}
+    for wire, attribute in (('document', '_doc'), ('filter', '_filter'), ('upsert', '_upsert')):
+        if hasattr(op, attribute):
+            fields[wire] = getattr(op, attribute)
+    return fields
+
+
+def decode_bulk_op(fields):
+    cls = _BULK_OPS[fields['type']]
+    if cls is InsertOne:
+        return InsertOne(fields['document'])
+    if cls in (DeleteOne, DeleteMany):
+        return cls(fields['filter'])
+    return cls(fields['filter'], fields['document'], upsert=fields.get('upsert', False))
+
+
+# the proxy's side
+
+def write_result(result):
+    fields = {}
+    for name in ('inserted_id', 'inserted_ids', 'matched_count', 'modified_count', 'upserted_id', 'deleted_count',
+                 'inserted_count', 'upserted_count', 'upserted_ids'):
+        if hasattr(result, name):
+            value = getattr(result, name)
+            # bulk results key their upserted ids by the operation's index, which BSON needs as a string
+            fields[name] = {str(k): v for k, v in value.items()} if isinstance(value, dict) else value
+    return fields
+
+
+def run_find(coll, args):
+    cursor = coll.find(args.get('filter'), args.get('projection'))
+    if args.get('sort'):
+        cursor = cursor.sort([tuple(key) for key in args['sort']])
+    for option in ('skip', 'limit', 'max_time_ms', 'batch_size'):
+        if args.get(option) is not None:
+            cursor = getattr(cursor, option)(args[option])
+    return cursor
+
+
+# what each op runs against the collection; ones returning a cursor are streamed back in batches
+OPERATIONS = {
+    'find': run_find,
+    'explain': lambda coll, args: run_find(coll, args).explain(),
+    'find_one': lambda coll, args: coll.find_one(args.get('filter'), args.get('projection')),
+    'find_one_and_update': lambda coll, args: coll.find_one_and_update(
+        args['filter'], args['update'], projection=args.get('projection'),
+        return_document=args.get('return_document', False), upsert=args.get('upsert', False)),
+    'insert_one': lambda coll, args: write_result(coll.insert_one(args['document'])),
+    'insert_many': lambda coll, args: write_result(coll.insert_many(args['documents'],
+                                                                    ordered=args.get('ordered', True))),
+    'update_one': lambda coll, args: write_result(coll.update_one(args['filter'], args['update'],
+                                                                  upsert=args.get('upsert', False))),
+    'update_many': lambda coll, args: write_result(coll.update_many(args['filter'], args['update'],
+                                                                    upsert=args.get('upsert', False))),
+    'delete_one': lambda coll, args: write_result(coll.delete_one(args['filter'])),
+    'delete_many': lambda coll, args: write_result(coll.delete_many(args['filter'])),
+    'bulk_write': lambda coll, args: write_result(coll.bulk_write(
+        [decode_bulk_op(op) for op in args['requests']], ordered=args.get('ordered', True))),
+    'aggregate': lambda coll, args: coll.aggregate(args['pipeline'], **args.get('options', {})),
+    'count_documents': lambda coll, args: coll.count_documents(args.get('filter', {})),
+    'estimated_document_count': lambda coll, args: coll.estimated_document_count(),
+    'distinct': lambda coll, args: coll.distinct(args['key'], args.get('filter')),
+    'remove': lambda coll, args: write_result(coll.delete_many(args['filter']) if args.get('multi', True)
+                                              else coll.delete_one(args['filter'])),
+    'index_information': lambda coll, args: coll.index_information(),
+    'create_index': lambda coll, args: coll.create_index([tuple(key) for key in args['keys']],
+                                                         **args.get('options', {})),
+    'command': lambda coll, args: run_command(coll, args),
+}
+
+
+def run_command(coll, args):
+    """
+    Runs a database command for the client. The only one it needs is explaining an aggregation (see
+    querycost), and passing others through would let any peer drop the database, so nothing else is run.
+    """
+    options = args.get('options', {})
+    if args.get('command') != 'aggregate' or args.get('value') != coll.name or options.get('explain') is not True:
+        raise ProxyError('Only explaining an aggregation on the collection is supported')
+    return coll.database.command('aggregate', coll.name, pipeline=options.get('pipeline', []), explain=True)
+
+
+def is_loopback(host):
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def backing_collection(name, workload):
+    """
+    The real collection an op runs on, with the workload's read preference.
+    """
+    from src import util
+    if workload is None:
+        return util.get_db()[name]
+    return util.get_db().get_collection(name, read_preference=util.read_preference(workload))
+
+
+class ProxyHandler(socketserver.BaseRequestHandler):
+    """
+    Serves one client connection, one request at a time, until it hangs up or goes quiet for
+    DB_PROXY_IDLE_TIMEOUT seconds (ie. its lambda was frozen or dropped), so it doesn't hold a thread.
+    """
+    def handle(self):
+        secret = getattr(config, 'DB_PROXY_SECRET', None)
+        self.request.settimeout(getattr(config, 'DB_PROXY_IDLE_TIMEOUT', 60))
+        while True:
+            try:
+                request = recv_doc(self.request)
+            except OSError:
+                return
+            if request is None:
+                return
+            auth = request.get('auth')
+            if secret and not (isinstance(auth, str) and hmac.compare_digest(auth, secret)):
+                send_doc(self.request, error_reply(ProxyError('Bad proxy secret')))
+                return
+            try:
+                if request['op'] not in OPERATIONS:
+                    raise ProxyError('Unsupported operation {}'.format(request['op']))
+                coll = backing_collection(request['coll'], request.get('workload'))
+                result = OPERATIONS[request['op']](coll, request.get('args', {}))
+                if request['op'] in ('find', 'aggregate'):
+                    self.stream(result)
+                else:
+                    send_doc(self.request, {'ok': True, 'result': result})
+            except OSError:
+                # the client went away, ie. stopped reading a stream part way
+                return
+            except Exception as err:
+                send_doc(self.request, error_reply(err))
+
+    def stream(self, cursor):
+        batch = []
+        for doc in cursor:
+            batch.append(doc)
+            if len(batch) == BATCH_SIZE:
+                send_doc(self.request, {'ok': True, 'batch': batch, 'more': True})
+                batch = []
+        send_doc(self.request, {'ok': True, 'batch': batch, 'more': False})
+
+
+class ProxyServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def serve(bind):
+    host, _, port = bind.rpartition(':')
+    host = host or '0.0.0.0'
+    if not getattr(config, 'DB_PROXY_SECRET', None) and not is_loopback(host):
+        raise SystemExit('Set DB_PROXY_SECRET before binding the proxy to anything but loopback')
+    # every client connection shares the one pool, whatever the number of lambdas
+    config.DB_CLIENT_OPTIONS = dict(getattr(config, 'DB_CLIENT_OPTIONS', {}),
+                                    maxPoolSize=getattr(config, 'DB_PROXY_POOL_SIZE', 50))
+    server = ProxyServer((host, int(port)), ProxyHandler)
+    print('proxying on {}'.format(bind))
+    server.serve_forever()
+
+
+# the handlers' side
+
+class ProxyClient:
+    """
+    Sends operations to the proxy, over a few reused sockets.
+    """
+    def __init__(self, url):
+        parsed = urllib.parse.urlparse(url)
+        self.address = (parsed.hostname, parsed.port)
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def open(self):
+        return socket.create_connection(self.address, timeout=getattr(config, 'DB_PROXY_TIMEOUT', 30))
+
+    def connect(self):
+        """
+        An idle socket (and True, since it's reused) or a new one (and False).
+        """
+        with self.lock:
+            if self.idle:
+                return self.idle.pop(), True
+        return self.open(), False
+
+    def release(self, sock):
+        with self.lock:
+            self.idle.append(sock)
+
+    def request(self, coll, workload, op, args):
+        return {'auth': getattr(config, 'DB_PROXY_SECRET', None), 'coll': coll, 'workload': workload,
+                'op': op, 'args': args}
+
+    def send(self, request):
+        """
+        Sends the request, returning the socket its reply comes on. An idle socket may have been closed
+        by the proxy since (ie. after DB_PROXY_IDLE_TIMEOUT), which shows as a failure before any reply
+        arrives, so then the request is sent once more on a fresh socket.
+        """
+        sock, reused = self.connect()
+        try:
+            send_doc(sock, request)
+            # only peeks, so the reply is still read whole
+            if not reused or sock.recv(1, socket.MSG_PEEK):
+                return sock
+        except socket.timeout:
+            # the proxy is still there, just slow, and may be running the request
+            sock.close()
+            raise
+        except OSError:
+            if not reused:
+                sock.close()
+                raise
+        sock.close()
+        sock = self.open()
+        try:
+            send_doc(sock, request)
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
+    def call(self, coll, workload, op, args):
+        sock = self.send(self.request(coll, workload, op, args))
+        try:
+            reply = recv_doc(sock)
+        except Exception:
+            sock.close()
+            raise
+        if reply is None:
+            sock.close()
+            raise ProxyError('The proxy hung up')
+        self.release(sock)
+        if not reply['ok']:
+            raise_reply(reply)
+        return reply['result']
+
+    def stream(self, coll, workload, op, args):
+        """
+        The documents a find or aggregate returns, read a batch at a time.
+        """
+        sock = self.send(self.request(coll, workload, op, args))
+        done = False
+        try:
+            while True:
+                reply = recv_doc(sock)
+                if reply is None:
+                    raise ProxyError('The proxy hung up')
+                if not reply['ok']:
+                    done = True
+                    raise_reply(reply)
+                yield from reply['batch']
+                if not reply['more']:
+                    done = True
+                    return
+        finally:
+            # a socket left mid-stream still has batches coming, so it can't be reused
+            if done:
+                self.release(sock)
+            else:
+                sock.close()
+
+
+class ProxyCursor:
+    """
+    The part of a pymongo Cursor the handlers use. Nothing is sent until it's iterated.
+    """
+    def __init__(self, collection, filter=None, projection=None, **options):
+        self.collection = collection
+        self.args = dict(filter=filter or {}, projection=projection, **options)
+
+    def sort(self, key_or_list, direction=None):
+        self.args['sort'] = [[key_or_list, direction or 1]] if isinstance(key_or_list, str) else \
+            [list(key) for key in key_or_list]
+        return self
+
+    def skip(self, skip):
+        self.args['skip'] = skip
+        return self
+
+    def limit(self, limit):
+        self.args['limit'] = limit
+        return self
+
+    def max_time_ms(self, max_time_ms):
+        self.args['max_time_ms'] = max_time_ms
+        return self
+
+    def batch_size(self, batch_size):
+        self.args['batch_size'] = batch_size
+        return self
+
+    def explain(self):
+        return self.collection.call('explain', self.args)
+
+    def __iter__(self):
+        return self.collection.client.stream(self.collection.name, self.collection.workload, 'find', self.args)
+
+
+class ProxyDatabase:
+    def __init__(self, collection):
+        self.collection = collection
+
+    def command(self, command, value=1, **options):
+        return self.collection.call('command', {'command': command, 'value': value, 'options': options})
+
+
+class ProxyCollection:
+    """
+    The part of a pymongo Collection the handlers use, run by the proxy.
+    """
+    def __init__(self, client, name, workload=None):
+        self.client = client
+        self.name = name
+        self.workload = workload
+        self.database = ProxyDatabase(self)
+
+    def call(self, op, args):
+        return self.client.call(self.name, self.workload, op, args)
+
+    def find(self, filter=None, projection=None, **options):
+        return ProxyCursor(self, filter, projection, **options)
+
+    def find_one(self, filter=None, projection=None):
+        return self.call('find_one', {'filter': filter or {}, 'projection': projection})
+
+    def find_one_and_update(self, filter, update, projection=None, return_document=False, upsert=False):
+        return self.call('find_one_and_update', {'filter': filter, 'update': update, 'projection': projection,
+                                                 'return_document': bool(return_document), 'upsert': upsert})
+
+    def insert_one(self, document):
+        # like pymongo, the document gets its _id here, so the caller sees it too
+        document.setdefault('_id', ObjectId())
+        return SimpleNamespace(acknowledged=True, **self.call('insert_one', {'document': document}))
+
+    def insert_many(self, documents, ordered=True):
+        for document in documents:
+            document.setdefault('_id', ObjectId())
+        return SimpleNamespace(acknowledged=True, **self.call('insert_many', {'documents': list(documents),
+                                                                             'ordered': ordered}))
+
+    def update_one(self, filter, update, upsert=False):
+        return SimpleNamespace(acknowledged=True, **self.call('update_one', {'filter': filter, 'update': update,
+                                                                            'upsert': upsert}))
+
+    def update_many(self, filter, update, upsert=False):
+        return SimpleNamespace(acknowledged=True, **self.call('update_many', {'filter': filter, 'update': update,
+                                                                             'upsert': upsert}))
+
+    def delete_one(self, filter):
+        return SimpleNamespace(acknowledged=True, **self.call('delete_one', {'filter': filter}))
+
+    def delete_many(self, filter):
+        return SimpleNamespace(acknowledged=True, **self.call('delete_many', {'filter': filter}))
+
+    def bulk_write(self, requests, ordered=True):
+        return SimpleNamespace(acknowledged=True, **self.call('bulk_write', {
+            'requests': [encode_bulk_op(op) for op in requests], 'ordered': ordered}))
+
+    def aggregate(self, pipeline, **options):
+        return self.client.stream(self.name, self.workload, 'aggregate', {'pipeline': pipeline, 'options': options})
+
+    def count_documents(self, filter):
+        return self.call('count_documents', {'filter': filter})
+
+    def estimated_document_count(self):
+        return self.call('estimated_document_count', {})
+
+    def distinct(self, key, filter=None):
+        return self.call('distinct', {'key': key, 'filter': filter})
+
+    def remove(self, spec_or_id=None, multi=True):
+        # pymongo 3's legacy remove, which consume_url uses; it answers with the server's {n, ok}
+        spec = spec_or_id if isinstance(spec_or_id, dict) or spec_or_id is None else {'_id': spec_or_id}
+        result = self.call('remove', {'filter': spec or {}, 'multi': multi})
+        return {'n': result['deleted_count'], 'ok': 1.0}
+
+    def index_information(self):
+        return self.call('index_information', {})
+
+    def create_index(self, keys, **options):
+        keys = [[keys, 1]] if isinstance(keys, str) else [list(key) for key in keys]
+        return self.call('create_index', {'keys': keys, 'options': options})
+
+
+_client = None
+def collection(name, workload=None):
+    """
+    The named collection, with its operations run by the proxy at config.DB_PROXY_URL.
+    """
+    global _client
+    if _client is None:
+        _client = ProxyClient(config.DB_PROXY_URL)
+    return ProxyCollection(_client, name, workload)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the data-access proxy.")
+    parser.add_argument('--bind', default='127.0.0.1:27100')
+    serve(parser.parse_args().bind)
@@ -37,6 +37,15 @@ def prepare_event_for_output(event):
     print(output)
     return output
 
+def events_query(user, parsed_start, parsed_end):
+    """
+    The events the user can see (public ones or ones they attend) within the time frame
+    """
+    return {"$and": [{"$or": [{"type": "public"},
+                              {"attendees": {"$elemMatch": {"attendee": user["email"]}}}]},
+                     {"start_date": {"$gt": parsed_start}},
+                     {"end_date": {"$lt": parsed_end}}]}
+
 @ensure_schema({
     "type": "object",
     "properties": {
@@ -46,18 +55,14 @@ def prepare_event_for_output(event):
     },
     "required": ["token", "start_date", "end_date"]
 })
-@ensure_logged_in_user()
+@ensure_logged_in_user(fields=["email"])
 def find_events(event, context, user):
     try:
         parsed_start, parsed_end = validate_times_in_dict(event)
     except Exception as e:
         return {"statusCode": 400, "body": str(e)}
-    events = util.coll('events')
-    query = {"$and": [{"$or": [{"type": "public"},
-                               {"attendees": {"$elemMatch": {"attendee": user["email"]}}}]},
-                      {"start_date": {"$gt": parsed_start}},
-                      {"end_date": {"$lt": parsed_end}}]}
-    relevant = [prepare_event_for_output(e) for e in events.find(query)]
+    events = util.coll('events', 'events')
+    relevant = [prepare_event_for_output(e) for e in events.find(events_query(user, parsed_start, parsed_end))]
     if not relevant:
         return {"statusCode": 404, "body": "No events found for the user in the given time frame"}
     return {"statusCode": 200, "body": relevant}
@@ -89,7 +94,7 @@ def ensure_event_with_id(id_key="event_id", kw_arg_key=None,
     },
     "required": ["token", "event_id", "invited"]
 })
-@ensure_logged_in_user()
+@ensure_logged_in_user(fields=["email"])
 @ensure_event_with_id()
 def invite_to_event(event, context, user, found_event):
     if not any(attn['attendee'] == user['email'] and attn['role'] == 'host' for attn in found_event['attendees']):
@@ -111,7 +116,7 @@ def invite_to_event(event, context, user, found_event):
   },
     "required": ["token", "name", "start_date", "end_date", "event_type"]
 })
-@ensure_logged_in_user()
+@ensure_logged_in_user(fields=["email", "is_admin"])
 @ensure_admin_user()
 def create_event(event, context, user):
     try:
@@ -169,7 +174,7 @@ def create_event(event, context, user):
     },
     "required": ["event_id", "token", "updates"]
 })
-@ensure_logged_in_user()
+@ensure_logged_in_user(fields=["email", "is_admin"])
 @ensure_admin_user()
 @ensure_event_with_id()
 def update_event(event, context, user, found_event):
@@ -0,0 +1,288 @@
+"""
+Bulk exports of the users, for resume drops, shirt counts and badge printing.
+
+Rather than returning every user in one JSON body, the export streams the (projected) users
+into a gzip'd CSV or a Parquet file, a chunk at a time so memory stays flat. That takes longer than
+API Gateway waits for a lambda, so export_users only queues a job and answers with its id; the job
+runs in the export-worker lambda (or a thread, self-hosted) and export_status says how it's going
+and, once it's done, where the file went. config.EXPORT_LOCATION is either a local directory (only
+when self-hosted, a lambda's /tmp doesn't outlive it) or an S3 location (s3://bucket/prefix), in
+which case a presigned link to the file is returned as well.
+Parquet needs pyarrow, which is not a requirement of the lambdas.
+"""
+import csv
+import gzip
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from src.schemas import *
+from src import querycost
+
+DEFAULT_FIELDS = ["email", "first_name", "last_name", "school", "major", "shirt_size",
+                  "dietary_restrictions", "registration_status"]
+FORMATS = {"csv": ".csv.gz", "parquet": ".parquet"}
+# never written to a file that may be handed out as a link
+PRIVATE_FIELDS = {"password", "token", "_id"}
+
+logger = logging.getLogger(__name__)
+
+
+def export_location():
+    return getattr(config, 'EXPORT_LOCATION', os.path.join(tempfile.gettempdir(), 'exports'))
+
+
+def on_lambda():
+    return 'AWS_LAMBDA_FUNCTION_NAME' in os.environ
+
+
+def chunk_size():
+    return getattr(config, 'EXPORT_CHUNK_SIZE', 1000)
+
+
+def cell(value):
+    # nested values (ie. travelling_from) are written as JSON so every column is flat
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, default=str)
+    return value
+
+
+def field_value(user, field):
+    """
+    The value of a (possibly dotted, ie. travelling_from.mode) field of the user, or None.
+    """
+    value = user
+    for part in field.split('.'):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+
+def export_projection(fields):
+    # mongo refuses a projection of both a field and one of its subfields, and the field has them anyway
+    return user_projection([field for field in fields
+                            if not any(field.startswith(other + '.') for other in fields)])
+
+
+def rows(users, fields):
+    """
+    The users as lists of cells, in chunks of at most chunk_size rows.
+    """
+    chunk = []
+    for user in users:
+        chunk.append([cell(field_value(user, field)) for field in fields])
+        if len(chunk) == chunk_size():
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def write_csv(path, fields, chunks):
+    count = 0
+    with gzip.open(path, 'wt', newline='') as out:
+        writer = csv.writer(out)
+        writer.writerow(fields)
+        for chunk in chunks:
+            writer.writerows(chunk)
+            count += len(chunk)
+    return count
+
+
+def write_parquet(path, fields, chunks):
+    """
+    Writes a row group per chunk. The columns are strings, since the users' fields aren't consistently typed.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([(field, pa.string()) for field in fields])
+    count = 0
+    with pq.ParquetWriter(path, schema, compression='snappy') as writer:
+        for chunk in chunks:
+            columns = [pa.array([None if row[i] is None else str(row[i]) for row in chunk], pa.string())
+                       for i in range(len(fields))]
+            writer.write_table(pa.Table.from_arrays(columns, schema=schema))
+            count += len(chunk)
+    return count
+
+
+def parquet_available():
+    try:
+        import pyarrow.parquet
+    except ImportError:
+        return False
+    return True
+
+
+def store(local_path, name):
+    """
+    Moves the written file to the export location, returning where it went.
+    """
+    location = export_location()
+    if not location.startswith('s3://'):
+        os.makedirs(location, exist_ok=True)
+        destination = os.path.join(location, name)
+        shutil.move(local_path, destination)
+        return destination
+
+    # only exports need boto3, so the other lambdas don't pay for importing it
+    import boto3
+    bucket, _, prefix = location[len('s3://'):].partition('/')
+    key = '/'.join(part for part in (prefix.strip('/'), name) if part)
+    s3 = boto3.client('s3', endpoint_url=getattr(config, 'EXPORT_S3_ENDPOINT', None))
+    try:
+        # upload_file sends big files in parts, so they're never read into memory whole
+        s3.upload_file(local_path, bucket, key)
+    finally:
+        os.remove(local_path)
+    return "s3://{}/{}".format(bucket, key)
+
+
+def link(location):
+    """
+    A presigned link to an export stored on S3, made whenever it's asked for so it hasn't expired.
+    """
+    import boto3
+    bucket, _, key = location[len('s3://'):].partition('/')
+    s3 = boto3.client('s3', endpoint_url=getattr(config, 'EXPORT_S3_ENDPOINT', None))
+    return s3.generate_presigned_url('get_object', Params={'Bucket': bucket, 'Key': key},
+                                     ExpiresIn=getattr(config, 'EXPORT_URL_EXPIRES', 3600))
+
+
+def write_export(query, fields, file_format):
+    """
+    Writes the users matching the query to a file at the export location, returning where it went
+    and how many users are in it.
+    """
+    # an export is meant to read everyone, so unlike read_info it may scan the collection and take its time
+    users_coll = util.coll('users', 'analytics')
+    users = users_coll.find(query, export_projection(fields), batch_size=chunk_size())
+    started = time.perf_counter()
+
+    name = 'users-{}-{}{}'.format(datetime.utcnow().strftime('%Y%m%dT%H%M%S'), uuid.uuid4().hex[:8],
+                                  FORMATS[file_format])
+    handle, local_path = tempfile.mkstemp(suffix=FORMATS[file_format])
+    os.close(handle)
+    try:
+        write = write_parquet if file_format == 'parquet' else write_csv
+        count = write(local_path, fields, rows(users, fields))
+        location = store(local_path, name)
+    finally:
+        if os.path.exists(local_path):
+            os.remove(local_path)
+    querycost.log_query('export', users_coll.name, query, [], started, count)
+    return location, count
+
+
+def run_job(job_id):
+    """
+    Runs a queued export job, unless something else already picked it up (ie. a retried invocation).
+    """
+    jobs = util.coll('exports')
+    job = jobs.find_one_and_update({'_id': job_id, 'status': 'queued'},
+                                   {'$set': {'status': 'running', 'started': datetime.utcnow()}})
+    if job is None:
+        return
+    try:
+        location, count = write_export(json.loads(job['query']), job['fields'], job['format'])
+    except Exception as err:
+        logger.exception('export %s failed', job_id)
+        jobs.update_one({'_id': job_id}, {'$set': {'status': 'failed', 'error': str(err),
+                                                   'finished': datetime.utcnow()}})
+        return
+    jobs.update_one({'_id': job_id}, {'$set': {'status': 'done', 'location': location, 'rows': count,
+                                               'finished': datetime.utcnow()}})
+
+
+def start(job_id, context):
+    """
+    Starts the job off the request: in the export-worker lambda when on one, otherwise in a thread.
+    """
+    if context is None:
+        threading.Thread(target=run_job, args=(job_id,), daemon=True).start()
+        return
+    import boto3
+    boto3.client('lambda').invoke(FunctionName=os.environ['EXPORT_WORKER'], InvocationType='Event',
+                                  Payload=json.dumps({'job': job_id}).encode('utf-8'))
+
+
+def run_export(event, context):
+    """
+    The export-worker lambda, invoked (asynchronously) with the id of the job to run
+    """
+    run_job(event['job'])
+
+
+@ensure_schema({
+    "type": "object",
+    "properties": {
+        "token": {"type": "string"},
+        "query": {"type": "object"},
+        "fields": {"type": "array", "items": {"type": "string"}, "minItems": 1, "uniqueItems": True},
+        "format": {"type": "string", "enum": list(FORMATS)}
+    },
+    "required": ["token"]
+})
+@ensure_logged_in_user(fields=["email", "is_admin"])
+@ensure_admin_user()
+def export_users(event, context, user=None):
+    """
+    Function used to queue an export of the users matching the query (all of them by default) with the
+    given fields (which may be dotted, ie. travelling_from.mode), answering with the job's id to poll
+    export_status with
+    """
+    fields = event.get('fields', DEFAULT_FIELDS)
+    private = {field for field in fields if field.split('.')[0] in PRIVATE_FIELDS}
+    if private:
+        return {"statusCode": 400, "body": "These fields can't be exported: {}".format(", ".join(sorted(private)))}
+    file_format = event.get('format', 'csv')
+    if file_format == 'parquet' and not parquet_available():
+        return {"statusCode": 400, "body": "Parquet exports need pyarrow installed, export as csv instead"}
+    if on_lambda() and not export_location().startswith('s3://'):
+        return {"statusCode": 500, "body": "Exports from a lambda need an s3:// EXPORT_LOCATION, "
+                                           "its local disk doesn't outlive it"}
+
+    now = datetime.utcnow()
+    job = {'_id': uuid.uuid4().hex, 'status': 'queued', 'requested_by': user['email'],
+           # kept as JSON, since a query's operators can't be the keys of a stored document
+           'query': json.dumps(event.get('query', {})), 'fields': fields, 'format': file_format,
+           'created': now, 'expires': now + timedelta(hours=getattr(config, 'EXPORT_JOB_TTL_HOURS', 24))}
+    util.coll('exports').insert_one(job)
+    start(job['_id'], context)
+    return {"statusCode": 202, "body": {"job": job['_id'], "status": job['status']}}
+
+
+@ensure_schema({
+    "type": "object",
+    "properties": {
+        "token": {"type": "string"},
+        "job": {"type": "string"}
+    },
+    "required": ["token", "job"]
+})
+@ensure_logged_in_user(fields=["email", "is_admin"])
+@ensure_admin_user()
+def export_status(event, context, user=None):
+    """
+    Function used to poll an export job, answering with its status and, once it's done, where the file is
+    (with a link to it, when it's on S3) and how many users are in it
+    """
+    job = util.coll('exports').find_one({'_id': event['job']})
+    if job is None:
+        return {"statusCode": 404, "body": "no such export"}
+    body = {"job": job['_id'], "status": job['status'], "format": job['format'], "fields": job['fields']}
+    if job['status'] == 'done':
+        body.update({"location": job['location'], "rows": job['rows']})
+        if job['location'].startswith('s3://'):
+            body['url'] = link(job['location'])
+    elif job['status'] == 'failed':
+        body['error'] = job['error']
+    return {"statusCode": 200, "body": body}
@@ -0,0 +1,204 @@
+"""
+The indexes every collection needs, and a small CLI to create and check them.
+
+Run from the repository root (with a config.py in place):
+    python -m src.indexes ensure    # create any missing indexes (safe to rerun), exits non-zero on conflicts
+    python -m src.indexes verify    # list the missing and conflicting indexes, exits non-zero if there are any
+    python -m src.indexes explain   # explain the queries the endpoints make, flagging collection scans
+"""
+import sys
+from datetime import datetime
+
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+
+import config
+from src import util
+
+# for each collection (by its key in config.DB_COLLECTIONS), the indexes as (keys, options)
+INDEXES = {
+    'users': [
+        # every authenticated request and login looks a user up by email
+        ([('email', ASCENDING)], {'unique': True}),
+        # attend_event resolves QR codes to users
+        ([('qrcode', ASCENDING)], {}),
+        # incremental reimbursement runs only read the users whose travel changed since the last one
+        ([('travelling_from_updated_at', ASCENDING)], {}),
+    ],
+    'magic links': [
+        ([('link', ASCENDING)], {'unique': True}),
+        # links are only good for a few hours, so mongo can clean them up for us
+        ([('valid_until', ASCENDING)], {'expireAfterSeconds': 0}),
+    ],
+    'events': [
+        # find_events matches public events or the ones the user attends, within a time frame
+        ([('type', ASCENDING), ('start_date', ASCENDING)], {}),
+        ([('attendees.attendee', ASCENDING), ('start_date', ASCENDING)], {}),
+        ([('start_date', ASCENDING), ('end_date', ASCENDING)], {}),
+    ],
+    'tokens': [
+        ([('hash', ASCENDING)], {'unique': True}),
+        ([('email', ASCENDING), ('expires', DESCENDING)], {}),
+        ([('expires', ASCENDING)], {'expireAfterSeconds': 0}),
+    ],
+    'revoked tokens': [
+        ([('hash', ASCENDING)], {}),
+        ([('expires', ASCENDING)], {'expireAfterSeconds': 0}),
+    ],
+    'distances': [
+        # reimbursements look every address up per mode, to the event's location
+        ([('destination', ASCENDING), ('mode', ASCENDING), ('addr', ASCENDING)], {'unique': True}),
+    ],
+    'check ins': [
+        # the idempotency keys are the _ids, and only need keeping while a scanner might replay them
+        ([('expires', ASCENDING)], {'expireAfterSeconds': 0}),
+    ],
+    'exports': [
+        # export jobs are looked up by _id, and only polled for a while
+        ([('expires', ASCENDING)], {'expireAfterSeconds': 0}),
+    ],
+}
+
+# the queries the endpoints make, as (collection, filter), used to check the indexes are actually picked
+SAMPLE_QUERIES = [
+    ('users', {'email': 'creep@radiohead.ed'}),
+    ('users', {'qrcode': 'some-qr-code'}),
+    # attend_event's check-in, which has to use both indexes
+    ('users', {'$and': [{'$or': [{'email': 'some-qr-code'}, {'qrcode': 'some-qr-code'}]},
+                        {'day_of.lunch': {'$not': {'$gt': 0}}}]}),
+    ('magic links', {'link': 'forgot-someverylongrandomstring'}),
+    ('events', {"$and": [{"$or": [{"type": "public"},
+                                  {"attendees": {"$elemMatch": {"attendee": 'creep@radiohead.ed'}}}]},
+                         {"start_date": {"$gt": datetime(2021, 8, 16)}},
+                         {"end_date": {"$lt": datetime(2021, 8, 17)}}]}),
+    ('tokens', {'hash': '0' * 64, 'email': 'creep@radiohead.ed'}),
+    ('revoked tokens', {'expires': {'$gt': datetime(2021, 8, 16)}}),
+]
+
+# the index options that make two indexes on the same keys different
+_RELEVANT_OPTIONS = ('unique', 'expireAfterSeconds')
+
+
+def declared_collections():
+    """
+    The collections with declared indexes that this deployment actually uses.
+    """
+    return [key for key in INDEXES if key in config.DB_COLLECTIONS]
+
+
+def same_keys(keys, info):
+    return [tuple(key) for key in info['key']] == [tuple(key) for key in keys]
+
+
+def same_options(options, info):
+    return all(info.get(option) == options.get(option) for option in _RELEVANT_OPTIONS)
+
+
+def missing_indexes(collkey):
+    """
+    The declared indexes on the collection that are absent, ie. no index has their keys.
+    """
+    existing = util.coll(collkey).index_information().values()
+    return [(keys, options) for keys, options in INDEXES[collkey]
+            if not any(same_keys(keys, info) for info in existing)]
+
+
+def conflicting_indexes(collkey):
+    """
+    The declared indexes on the collection whose keys are indexed with different options, as
+    (keys, options, name of the existing index, its options). Creating them would fail until the
+    existing index is dropped, which is left to whoever runs this.
+    """
+    existing = util.coll(collkey).index_information()
+    conflicts = []
+    for keys, options in INDEXES[collkey]:
+        same = [(name, info) for name, info in existing.items() if same_keys(keys, info)]
+        if same and not any(same_options(options, info) for _, info in same):
+            name, info = same[0]
+            conflicts.append((keys, options, name, {option: info[option] for option in _RELEVANT_OPTIONS
+                                                    if option in info}))
+    return conflicts
+
+
+def ensure_indexes():
+    """
+    Creates every missing index, returning those created and the conflicts (see conflicting_indexes)
+    that were skipped. create_index is a no-op for indexes that already exist, so this can be run on
+    every deploy.
+    """
+    created, conflicts = [], []
+    for collkey in declared_collections():
+        conflicts.extend((collkey,) + conflict for conflict in conflicting_indexes(collkey))
+        for keys, options in missing_indexes(collkey):
+            try:
+                created.append((collkey, util.coll(collkey).create_index(keys, **options)))
+            except OperationFailure as err:
+                # ie. another index already has the name this one would get
+                conflicts.append((collkey, keys, options, None, str(err)))
+    return created, conflicts
+
+
+def report_conflicts(conflicts):
+    for collkey, keys, options, name, existing in conflicts:
+        if name is None:
+            print('could not create {} {} on {}: {}'.format(keys, options, collkey, existing))
+        else:
+            print('conflict on {}: {} exists as {} {} instead of {}, drop it with db.{}.dropIndex("{}") '
+                  'and run ensure again'.format(collkey, keys, name, existing, options,
+                                                config.DB_COLLECTIONS[collkey], name))
+
+
+def plan_stages(plan):
+    """
+    All the stages in a (possibly nested) query plan.
+    """
+    stages = [plan.get('stage')]
+    for child in plan.get('inputStages', []) + [plan[key] for key in ('inputStage', 'queryPlan') if key in plan]:
+        stages.extend(plan_stages(child))
+    return stages
+
+
+def explain_queries():
+    """
+    Explains each of the sample queries, returning the collection, query, stages of the winning plan
+    and whether the query would scan the whole collection.
+    """
+    report = []
+    for collkey, query in SAMPLE_QUERIES:
+        if collkey not in config.DB_COLLECTIONS:
+            continue
+        explained = util.coll(collkey).find(query).explain()
+        stages = plan_stages(explained['queryPlanner']['winningPlan'])
+        report.append((collkey, query, stages, 'COLLSCAN' in stages))
+    return report
+
+
+def main(argv):
+    command = argv[1] if len(argv) > 1 else 'verify'
+    if command == 'ensure':
+        created, conflicts = ensure_indexes()
+        for collkey, name in created:
+            print('created {} on {}'.format(name, collkey))
+        report_conflicts(conflicts)
+        return 1 if conflicts else 0
+    if command == 'verify':
+        missing = [(collkey, keys, options) for collkey in declared_collections()
+                   for keys, options in missing_indexes(collkey)]
+        conflicts = [(collkey,) + conflict for collkey in declared_collections()
+                     for conflict in conflicting_indexes(collkey)]
+        for collkey, keys, options in missing:
+            print('missing on {}: {} {}'.format(collkey, keys, options))
+        report_conflicts(conflicts)
+        return 1 if missing or conflicts else 0
+    if command == 'explain':
+        slow = False
+        for collkey, query, stages, collscan in explain_queries():
+            slow = slow or collscan
+            print('{}{}: {} -> {}'.format('SLOW ' if collscan else '', collkey, query, ' <- '.join(stages)))
+        return 1 if slow else 0
+    print(__doc__)
+    return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
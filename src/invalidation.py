@@ -0,0 +1,152 @@
+"""
+Tells in-process caches when the documents behind them change.
+
+Caches subscribe a callback to a collection (by its key in config.DB_COLLECTIONS). Once started,
+a background thread tails a change stream over the configured collections and calls the
+subscribers with {collection, operation, id, document} for each change; the document is only
+there for inserts. Only collections with subscribers are watched. Change streams need a replica
+set; against a standalone mongod the caches are left to their TTLs, unless INVALIDATION_POLL is
+set (ie. in the tests), in which case the thread polls dbHash over the subscribed collections
+every INVALIDATION_POLL_SECONDS and sends a "reset" (with no id) for each one whose hash changed.
+Hashing means reading the whole collection, so polling is not meant for production. A "reset" is
+also sent for every collection when the stream had to be restarted without being able to resume,
+since changes may have been missed.
+
+Only the self-hosted servers start the thread (a frozen lambda can't tail anything), so caches
+still need their TTLs to bound staleness on Lambda.
+"""
+import logging
+import threading
+from collections import defaultdict
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+import config
+from src import util
+
+logger = logging.getLogger(__name__)
+
+# the errors mongod answers a change stream with when it isn't part of a replica set
+_NO_CHANGE_STREAMS = {40573, 40324}
+
+
+class InvalidationBus:
+    def __init__(self):
+        self.subscribers = defaultdict(list)
+        self.resume_token = None
+        self.thread = None
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+
+    def subscribe(self, collkey, callback):
+        with self.lock:
+            self.subscribers[collkey].append(callback)
+
+    def publish(self, collkey, operation, doc_id=None, document=None):
+        change = {'collection': collkey, 'operation': operation, 'id': doc_id, 'document': document}
+        with self.lock:
+            callbacks = list(self.subscribers.get(collkey, []))
+        for callback in callbacks:
+            try:
+                callback(change)
+            except Exception:
+                logger.exception('invalidating for a change to %s failed', collkey)
+
+    def reset_all(self):
+        for collkey in list(self.subscribers):
+            self.publish(collkey, 'reset')
+
+    def watched(self):
+        """
+        The keys of the collections with subscribers, by their names in the database.
+        """
+        with self.lock:
+            subscribed = [collkey for collkey, callbacks in self.subscribers.items() if callbacks]
+        return {config.DB_COLLECTIONS[collkey]: collkey for collkey in subscribed if collkey in config.DB_COLLECTIONS}
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self.run, name='invalidation', daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+
+    def run(self):
+        while not self.stopping.is_set():
+            try:
+                self.tail()
+            except OperationFailure as err:
+                if err.code in _NO_CHANGE_STREAMS:
+                    if not getattr(config, 'INVALIDATION_POLL', False):
+                        logger.info('no change streams on this deployment, caches will rely on their TTLs')
+                        return
+                    logger.info('no change streams on this deployment, polling dbHash instead')
+                    return self.poll()
+                self.restart(err)
+            except PyMongoError as err:
+                self.restart(err)
+
+    def restart(self, err):
+        logger.warning('the change stream failed (%s), restarting it', err)
+        if not self.stopping.wait(1):
+            self.resume_token = None
+            self.reset_all()
+
+    def tail(self):
+        names = self.watched()
+        pipeline = [{'$match': {'ns.coll': {'$in': list(names)}}}]
+        with util.get_db().watch(pipeline, resume_after=self.resume_token, max_await_time_ms=1000) as stream:
+            while not self.stopping.is_set() and stream.alive:
+                change = stream.try_next()
+                self.resume_token = stream.resume_token
+                if change is None:
+                    continue
+                collkey = names.get(change.get('ns', {}).get('coll'))
+                if collkey is None:
+                    continue
+                if change['operationType'] in ('insert', 'update', 'replace', 'delete'):
+                    self.publish(collkey, change['operationType'], change['documentKey']['_id'],
+                                 change.get('fullDocument'))
+                else:
+                    # drops, renames and invalidations leave nothing to go by
+                    self.publish(collkey, 'reset')
+
+    def poll(self):
+        names = self.watched()
+        hashes = None
+        while True:
+            try:
+                current = util.get_db().command('dbHash', collections=list(names))['collections']
+            except PyMongoError as err:
+                logger.warning('polling dbHash failed (%s)', err)
+                current = None
+            if current is not None:
+                if hashes is not None:
+                    for name in set(hashes) | set(current):
+                        if hashes.get(name) != current.get(name) and name in names:
+                            self.publish(names[name], 'reset')
+                hashes = current
+            if self.stopping.wait(getattr(config, 'INVALIDATION_POLL_SECONDS', 2)):
+                return
+
+
+bus = InvalidationBus()
+
+
+def subscribe(collkey, callback):
+    """
+    Calls callback with each change to the collection, once the bus is started.
+    """
+    bus.subscribe(collkey, callback)
+
+
+def start():
+    """
+    Starts following changes in the background, unless turned off with INVALIDATION_BUS = False.
+    """
+    if getattr(config, 'INVALIDATION_BUS', True):
+        bus.start()
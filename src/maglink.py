@@ -32,7 +32,7 @@ def forgot_user(event, magiclinks, user_coll):
         obj_to_insert = {'email': event['email'],
                          'link': magiclink,
                          'forgot': True,
-                         'valid_until': (datetime.now() + timedelta(hours=3)).isoformat()}
+                         'valid_until': datetime.utcnow() + timedelta(hours=3)}
         # add it to the collection of magic links
         magiclinks.insert_one(obj_to_insert)
         # creates the complete link using a provided link_base (default one is used if it's absent)
@@ -62,7 +62,7 @@ def director_link(magiclinks, num_links, event, user):
                          'email': event['emailsTo'][j],
                          'forgot': False,
                          'link': magiclink,
-                         "valid_until": (datetime.now() + timedelta(hours=3)).isoformat()}
+                         "valid_until": datetime.utcnow() + timedelta(hours=3)}
         # this object is stored in the collection of magic links in the database
         magiclinks.insert_one(obj_to_insert)
         # the complete link is then created using a given link_base (or a default if none is provided)
@@ -89,7 +89,7 @@ def director_link(magiclinks, num_links, event, user):
     },
     "required": ["token", "permissions", "emailsTo"]
 })
-@ensure_logged_in_user()
+@ensure_logged_in_user(fields=["email", "is_admin", "first_name"])
 @ensure_admin_user()
 def do_director_link(event, magiclinks, user=None):
     """
@@ -0,0 +1,165 @@
+"""
+The password hashing policy.
+
+The bcrypt cost is either pinned with config.BCRYPT_ROUNDS or calibrated so that a hash
+takes about config.BCRYPT_TARGET_MS on the machine (or Lambda size) we run on. Stored
+hashes with a lower cost are upgraded the next time their user logs in. Calibration is per
+process, so deployments with many containers should pin the cost; otherwise containers that
+calibrate differently would each upgrade hashes to their own cost.
+
+When self-hosted, hashing can be moved off the request threads into a pool of
+config.BCRYPT_POOL_WORKERS processes. At most BCRYPT_POOL_QUEUE hashes wait for
+a worker; past that PoolFull is raised so the endpoint can answer 429 straight away
+instead of piling up requests during a login storm. (Lambda can't run process
+pools, so the pool is off unless configured.)
+
+To see what the policy picks and how long hashing takes here:
+    python -m src.passwords [samples]
+"""
+import math
+import sys
+import threading
+import time
+from collections import deque
+
+import bcrypt
+
+import config
+
+DEFAULT_ROUNDS = 8
+MIN_ROUNDS = 4
+MAX_ROUNDS = 16
+
+# recent hashing/checking times in seconds, for the percentiles
+_timings = deque(maxlen=1000)
+_rounds = None
+_pool = None
+_pool_slots = None
+_pool_lock = threading.Lock()
+
+
+class PoolFull(Exception):
+    """
+    Raised when the hashing pool already has as many hashes waiting as it's allowed.
+    """
+
+
+def calibrate_rounds(target_ms, samples=3):
+    """
+    The highest cost whose hash takes at most target_ms here. Each extra round doubles the
+    work, so timing a cheap cost is enough to extrapolate.
+    """
+    base = MIN_ROUNDS + 2
+    fastest = None
+    for _ in range(samples):
+        start = time.perf_counter()
+        bcrypt.hashpw(b'calibration', bcrypt.gensalt(rounds=base))
+        took = (time.perf_counter() - start) * 1000
+        fastest = took if fastest is None else min(fastest, took)
+    rounds = base + math.floor(math.log2(target_ms / max(fastest, 1e-3)))
+    return max(MIN_ROUNDS, min(MAX_ROUNDS, rounds))
+
+
+def policy_rounds():
+    """
+    The cost new hashes should have, calibrated at most once per process.
+    """
+    global _rounds
+    if _rounds is None:
+        if getattr(config, 'BCRYPT_ROUNDS', None):
+            _rounds = config.BCRYPT_ROUNDS
+        elif getattr(config, 'BCRYPT_TARGET_MS', None):
+            _rounds = calibrate_rounds(config.BCRYPT_TARGET_MS)
+        else:
+            _rounds = DEFAULT_ROUNDS
+    return _rounds
+
+
+def rounds_of(hashed):
+    """
+    The cost a bcrypt hash (ie. $2b$08$...) was made with.
+    """
+    return int(hashed.split(b'$')[2])
+
+
+def needs_rehash(hashed):
+    # only ever upwards, so a container that calibrated lower doesn't undo another's upgrade
+    return rounds_of(hashed) < policy_rounds()
+
+
+def _timed(fn, *args):
+    start = time.perf_counter()
+    try:
+        return fn(*args)
+    finally:
+        _timings.append(time.perf_counter() - start)
+
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds=rounds))
+
+
+def _check(password, hashed):
+    return bcrypt.checkpw(password, hashed)
+
+
+def get_pool():
+    """
+    The hashing process pool, if one is configured.
+    """
+    global _pool, _pool_slots
+    workers = getattr(config, 'BCRYPT_POOL_WORKERS', 0)
+    if not workers:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            # only the self-hosted server ever has a pool, so lambdas needn't import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            _pool_slots = threading.BoundedSemaphore(workers + getattr(config, 'BCRYPT_POOL_QUEUE', 2 * workers))
+            _pool = ProcessPoolExecutor(max_workers=workers)
+    return _pool
+
+
+def _run(fn, *args):
+    pool = get_pool()
+    if pool is None:
+        return _timed(fn, *args)
+    if not _pool_slots.acquire(blocking=False):
+        raise PoolFull()
+    try:
+        # the time includes waiting for a worker, since that's what the caller sees
+        return _timed(lambda *a: pool.submit(fn, *a).result(), *args)
+    finally:
+        _pool_slots.release()
+
+
+def hash_password(password):
+    """
+    Hashes the (string) password under the current policy.
+    """
+    return _run(_hash, password.encode('utf-8'), policy_rounds())
+
+
+def check_password(password, hashed):
+    return _run(_check, password.encode('utf-8'), hashed)
+
+
+def timing_stats():
+    """
+    The median and 99th percentile time (in milliseconds) of the recent hashes and checks.
+    """
+    if not _timings:
+        return {'count': 0, 'p50_ms': None, 'p99_ms': None}
+    ordered = sorted(_timings)
+    def percentile(p):
+        return 1000 * ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+    return {'count': len(ordered), 'p50_ms': percentile(0.5), 'p99_ms': percentile(0.99)}
+
+
+if __name__ == "__main__":
+    samples = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    print('rounds: {}'.format(policy_rounds()))
+    for _ in range(samples):
+        hash_password('benchmark')
+    stats = timing_stats()
+    print('{count} hashes: p50 {p50_ms:.1f}ms, p99 {p99_ms:.1f}ms'.format(**stats))
@@ -0,0 +1,123 @@
+"""
+The QR code to user mapping behind check-ins.
+
+Codes used to live only in an array on their user, so every scan had to search the users for
+them. qr_match now also records each code in a small collection of {_id: code, email} (the _id
+being its unique index), and the emails codes resolve to are kept in an in-process LRU, so a
+scan is resolved from memory or with one lookup by _id. qr_match drops the code from the LRU of
+the process that relinked it; other processes hear of it through the invalidation bus (or, on
+Lambda, within QR_CACHE_TTL seconds).
+
+Codes linked before the mapping existed are copied over with
+    python -m src.qrcodes backfill
+until then they're still found through their users (see qrscan.checkin_update).
+"""
+import sys
+import threading
+
+from cachetools import TTLCache
+from pymongo import UpdateOne
+
+import config
+from src import util, invalidation
+
+_cache = TTLCache(maxsize=getattr(config, 'QR_CACHE_SIZE', 10000), ttl=getattr(config, 'QR_CACHE_TTL', 300))
+_cache_lock = threading.Lock()
+
+
+def cached(qr):
+    with _cache_lock:
+        return _cache.get(qr)
+
+
+def remember(qr, email):
+    with _cache_lock:
+        _cache[qr] = email
+
+
+def forget(qr=None):
+    """
+    Drops the code (or every code) from the LRU.
+    """
+    with _cache_lock:
+        if qr is None:
+            _cache.clear()
+        else:
+            _cache.pop(qr, None)
+
+
+def _on_change(change):
+    # the mapping's _ids are the codes
+    forget(change['id'] if change['operation'] != 'reset' else None)
+
+
+invalidation.subscribe('qr codes', _on_change)
+
+
+def resolve(qr):
+    """
+    The email of the user the code is linked to, or None if it's not in the mapping.
+    """
+    email = cached(qr)
+    if email is None:
+        found = util.coll('qr codes').find_one({'_id': qr})
+        if found is None:
+            return None
+        email = found['email']
+        remember(qr, email)
+    return email
+
+
+def resolve_many(qrs):
+    """
+    The emails of the codes that are in the mapping, by code, with at most one query.
+    """
+    emails, missing = dict(), []
+    for qr in qrs:
+        email = cached(qr)
+        if email is None:
+            missing.append(qr)
+        else:
+            emails[qr] = email
+    if missing:
+        for found in util.coll('qr codes').find({'_id': {'$in': missing}}):
+            emails[found['_id']] = found['email']
+            remember(found['_id'], found['email'])
+    return emails
+
+
+def link(qr, email):
+    """
+    Points the code at the user, replacing any earlier link.
+    """
+    util.coll('qr codes').update_one({'_id': qr}, {'$set': {'email': email}}, upsert=True)
+    forget(qr)
+
+
+def backfill(chunk=1000):
+    """
+    Adds every code in the users' qrcode arrays to the mapping, returning how many were written.
+    """
+    written = 0
+    ops = []
+    codes = util.coll('qr codes')
+    for user in util.coll('users').find({'qrcode': {'$exists': True, '$ne': []}}, {'_id': False, 'email': True,
+                                                                                  'qrcode': True}):
+        for qr in user['qrcode']:
+            ops.append(UpdateOne({'_id': qr}, {'$set': {'email': user['email']}}, upsert=True))
+        if len(ops) >= chunk:
+            codes.bulk_write(ops, ordered=False)
+            written += len(ops)
+            ops = []
+    if ops:
+        codes.bulk_write(ops, ordered=False)
+        written += len(ops)
+    forget()
+    return written
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ['backfill']:
+        print('{} codes written'.format(backfill()))
+    else:
+        print(__doc__)
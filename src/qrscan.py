@@ -1,6 +1,18 @@
+from datetime import datetime, timedelta, timezone
+
 from src.schemas import ensure_schema, ensure_logged_in_user, ensure_role
 import pymongo
+from bson import ObjectId
+from dateutil import parser
 from src.util import *
+from src import qrcodes, attendance
+import config
+
+# the most scans a scanner may send at once
+MAX_BATCH_SCANS = 500
+# who may link QR codes and check users in
+CHECKIN_ROLES = [['director', 'organizer', 'volunteer']]
+CHECKIN_FIELDS = ["email", "role"]
 
 def dbinfo():
     user_coll = coll("users")
@@ -18,8 +30,8 @@ def dbinfo():
     },
     "required": ["token", "link_email", "qr_code"]
 })
-@ensure_logged_in_user()
-@ensure_role([['director', 'organizer', 'volunteer']])
+@ensure_logged_in_user(fields=CHECKIN_FIELDS)
+@ensure_role(CHECKIN_ROLES)
 def qr_match(event, context, user=None):
     """
     Function used to associate a given QR code with the given email
@@ -28,11 +40,38 @@ def qr_match(event, context, user=None):
 
     result = user_coll.update_one({'email': event["link_email"]}, {'$push': {'qrcode': event["qr_code"]}})
     if result.matched_count == 1:
+        qrcodes.link(event["qr_code"], event["link_email"])
         return {"statusCode": 200, "body": "success"}
     else:
         return {"statusCode": 404, "body": "User not found"}
 
 
+def checkin_update(qr, event, again=False, email=None):
+    """
+    Function used to build the single conditional update that checks a user in: it matches the user by
+    email (if the code resolved to one) or by email or QR code and, unless the event can be re-attended,
+    only if they haven't checked in yet.
+    Returns the filter identifying the user, the filter for the update, the update and the projection
+    of the updated user
+    """
+    # TODO: revisit if it's valid for qr to be an email
+    identity = {'email': email} if email is not None else {'$or': [{'email': qr}, {'qrcode': qr}]}
+    match = identity if again else {'$and': [identity, {'day_of.' + event: {'$not': {'$gt': 0}}}]}
+    return identity, match, {'$inc': {'day_of.' + event: 1}}, {'_id': False, 'email': True, 'day_of.' + event: True}
+
+
+def checkin_result(new_user, event, already_in):
+    """
+    Function used to build attend_event's response from the updated user (None if nothing was updated),
+    already_in telling whether that was because the user was checked in already
+    """
+    if new_user is not None:
+        return {'statusCode': 200, 'body': {'email': new_user['email'], 'new_count': new_user['day_of'][event]}}
+    if already_in:
+        return {'statusCode': 402, 'body': 'user already checked into event'}
+    return {'statusCode': 404, 'body': 'user not found'}
+
+
 @ensure_schema({
     'type': 'object',
     'properties': {
@@ -43,36 +82,261 @@ def qr_match(event, context, user=None):
     },
     'required': ['token', 'qr', 'event']
 })
-@ensure_logged_in_user()
-@ensure_role([['director', 'organizer', 'volunteer']])
+@ensure_logged_in_user(fields=CHECKIN_FIELDS)
+@ensure_role(CHECKIN_ROLES)
 def attend_event(aws_event, context, user=None):
     """
-    Function used to mark that a user has attended an event
+    Function used to mark that a user has attended an event. The check and the increment are one atomic
+    update, so two scans of the same badge can't both get through
     """
     users = coll('users')
-    qr = aws_event['qr']
     event = aws_event['event']
     again = aws_event.get('again', False)
+    qr = aws_event['qr']
+    identity, match, update, projection = checkin_update(qr, event, again, qrcodes.resolve(qr))
 
-    def attend(user):
-        # if the user has already attended the event and is not an event that can be re-attended, complain
-        if not again and user['day_of'].get(event, 0) > 0:
-            return {'statusCode': 402, 'body': 'user already checked into event'}
-        # update the user data to reflect event attendance by incrementing the count of the event by 1
-        new_user = users.find_one_and_update({'email': user['email']},
-                                             {'$inc': {'day_of.' + event: 1}},
-                                             return_document=pymongo.ReturnDocument.AFTER)
+    new_user = users.find_one_and_update(match, update, projection=projection,
+                                         return_document=pymongo.ReturnDocument.AFTER)
+    if new_user is not None:
+        attendance.record(event, attendees=1 if new_user['day_of'][event] == 1 else 0)
+    # only a failed check-in needs a second look, to tell an unknown user from a repeat scan
+    already_in = new_user is None and not again and users.find_one(identity, {'_id': True}) is not None
+    return checkin_result(new_user, event, already_in)
 
-        return {'statusCode': 200, 'body': {'email': user['email'], 'new_count': new_user['day_of'][event]}}
 
-    # TODO: revisit if it's valid for qr to be an email
-    user = users.find_one({'email': qr})
-    if user is not None:
-        return attend(user)
+def resolve_qrs(users, qrs):
+    """
+    Function used to find the users behind many scanned QR codes (or emails) with a lookup in the
+    QR code mapping and a single query for the users
+    """
+    linked = qrcodes.resolve_many(qrs)
+    # codes missing from the mapping may be emails, or codes linked before it existed
+    unlinked = [qr for qr in qrs if qr not in linked]
+    found = users.find({'$or': [{'email': {'$in': list(set(linked.values()) | set(unlinked))}},
+                                {'qrcode': {'$in': unlinked}}]},
+                       {'_id': False, 'email': True, 'qrcode': True, 'day_of': True, 'checkin_marks': True})
+    by_email, by_qr = dict(), dict()
+    for user in found:
+        by_email[user['email']] = user
+        for code in user.get('qrcode', []):
+            by_qr[code] = user
+    # an email wins over a QR code, like in attend_event
+    return {qr: by_email.get(linked[qr]) if qr in linked else by_email.get(qr) or by_qr.get(qr) for qr in qrs}
 
-    # find the user using the QR code from the database
-    user = users.find_one({'qrcode': qr})
-    if user is not None:
-        return attend(user)
 
-    return {'statusCode': 404, 'body': 'user not found'}
+def checkin_mark(batch, event):
+    """
+    Function used to build the mark a batch's increment leaves on a user (in checkin_marks), so a batch
+    that's driven again after a failure can tell which of its increments already landed
+    """
+    return '{}/{}'.format(batch, event)
+
+
+def plan_checkins(scans, resolved):
+    """
+    Function used to work out the result of each scan, in order, and the increments they add up to per
+    user, event and batch. An increment is only guarded (so it can't double up with another scanner) if its
+    first scan expected the user to be new to the event. Scans whose batch already left its mark on the
+    user were applied by an earlier attempt, so they're only answered.
+    """
+    results, increments = dict(), dict()
+    counts = dict()
+    for scan in scans:
+        user = resolved.get(scan['qr'])
+        if user is None:
+            results[scan['key']] = {'statusCode': 404, 'body': 'user not found'}
+            continue
+        pair = (user['email'], scan['event'])
+        if pair not in counts:
+            counts[pair] = user.get('day_of', {}).get(scan['event'], 0)
+        if checkin_mark(scan['batch'], scan['event']) in user.get('checkin_marks', []):
+            results[scan['key']] = {'statusCode': 200, 'body': {'email': user['email'], 'new_count': counts[pair]}}
+            continue
+        if not scan.get('again', False) and counts[pair] > 0:
+            results[scan['key']] = {'statusCode': 402, 'body': 'user already checked into event'}
+            continue
+        increment_key = pair + (scan['batch'],)
+        if increment_key not in increments:
+            increments[increment_key] = {'by': 0, 'guarded': counts[pair] == 0 and not scan.get('again', False),
+                                         'keys': []}
+        counts[pair] += 1
+        increments[increment_key]['by'] += 1
+        increments[increment_key]['keys'].append(scan['key'])
+        increments[increment_key]['to'] = counts[pair]
+        results[scan['key']] = {'statusCode': 200, 'body': {'email': user['email'], 'new_count': counts[pair]}}
+    return results, increments
+
+
+def checkin_id(agent, key):
+    """
+    Function used to build the _id a scan is recorded under. Keys are only unique to the scanner that
+    picked them, so they're scoped by its email
+    """
+    return {'scanned_by': agent, 'key': key}
+
+
+def claim_keys(checkins, scans, agent, now):
+    """
+    Function used to record the scans' idempotency keys (with the batch they're applied in) before they're
+    applied, returning the keys another request claimed first (ie. a replay racing the original upload)
+    """
+    expires = now + timedelta(hours=getattr(config, 'CHECKIN_KEY_TTL_HOURS', 72))
+    claims = [{'_id': checkin_id(agent, scan['key']), 'qr': scan['qr'], 'event': scan['event'],
+               'again': scan.get('again', False), 'scanned_at': scan['scanned_at'], 'batch': scan['batch'],
+               'claimed_at': now, 'expires': expires} for scan in scans]
+    if not claims:
+        return set()
+    try:
+        checkins.insert_many(claims, ordered=False)
+    except pymongo.errors.BulkWriteError as err:
+        duplicates = [error['index'] for error in err.details['writeErrors'] if error['code'] == 11000]
+        if len(duplicates) != len(err.details['writeErrors']):
+            raise
+        return {claims[index]['_id']['key'] for index in duplicates}
+    return set()
+
+
+def take_over(checkins, claim, now):
+    """
+    Function used to take over a claim left without a result, once its lease is up (ie. the request that
+    made it died part way), so a replay drives its batch again. Returns whether this request got it
+    """
+    lease = timedelta(seconds=getattr(config, 'CHECKIN_LEASE_SECONDS', 60))
+    if claim['claimed_at'] > now - lease:
+        return False
+    taken = checkins.update_one({'_id': claim['_id'], 'claimed_at': claim['claimed_at'], 'result': {'$exists': False}},
+                                {'$set': {'claimed_at': now}})
+    return taken.modified_count == 1
+
+
+def apply_increments(users, increments):
+    """
+    Function used to write the planned increments in one bulk_write, returning the new count of each
+    increment that applied and None for those that didn't (ie. another scanner checked the user in since
+    they were read). Only if some didn't match are the users read again, to tell which
+    """
+    keep = getattr(config, 'CHECKIN_MARKS_KEPT', 20)
+    ops = []
+    for (email, event, batch), increment in increments.items():
+        mark = checkin_mark(batch, event)
+        match = {'email': email, 'checkin_marks': {'$ne': mark}}
+        if increment['guarded']:
+            match['day_of.' + event] = {'$not': {'$gt': 0}}
+        ops.append(pymongo.UpdateOne(match, {'$inc': {'day_of.' + event: increment['by']},
+                                             '$push': {'checkin_marks': {'$each': [mark], '$slice': -keep}}}))
+    if not ops:
+        return dict()
+    if users.bulk_write(ops, ordered=False).matched_count == len(ops):
+        return {increment_key: increment['to'] for increment_key, increment in increments.items()}
+
+    found = {user['email']: user for user in users.find({'email': {'$in': list({key[0] for key in increments})}},
+                                                        {'_id': False, 'email': True, 'day_of': True,
+                                                         'checkin_marks': True})}
+    outcomes = dict()
+    for email, event, batch in increments:
+        user = found.get(email, {})
+        applied = checkin_mark(batch, event) in user.get('checkin_marks', [])
+        outcomes[(email, event, batch)] = user.get('day_of', {}).get(event, 0) if applied else None
+    return outcomes
+
+
+def scan_time(scan):
+    """
+    When the scan happened (as naive UTC, like the rest of the database), or now if the scanner didn't say
+    """
+    if 'scanned_at' not in scan:
+        return datetime.utcnow()
+    parsed = parser.isoparse(scan['scanned_at'])
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+@ensure_schema({
+    'type': 'object',
+    'properties': {
+        'token': {'type': 'string'},
+        'scans': {
+            'type': 'array',
+            'maxItems': MAX_BATCH_SCANS,
+            'items': {
+                'type': 'object',
+                'properties': {
+                    'key': {'type': 'string', 'minLength': 1},
+                    'qr': {'type': 'string'},
+                    'event': {'type': 'string'},
+                    'scanned_at': {'type': 'string'},
+                    'again': {'type': 'boolean'}
+                },
+                'required': ['key', 'qr', 'event']
+            }
+        }
+    },
+    'required': ['token', 'scans']
+})
+@ensure_logged_in_user(fields=CHECKIN_FIELDS)
+@ensure_role(CHECKIN_ROLES)
+def attend_events(aws_event, context, user=None):
+    """
+    Function used to check in a batch of scans, ie. a scanner's offline queue. Each scan carries a key
+    of the scanner's choosing; a scan whose key was already seen is not applied again, but answered
+    with its original result, so a queue can be replayed until the upload gets through. A scan whose
+    request died before answering is driven again by the first replay after CHECKIN_LEASE_SECONDS.
+    """
+    users = coll('users')
+    checkins = coll('check ins')
+    scans = aws_event['scans']
+    now = datetime.utcnow()
+
+    results, claimed = dict(), dict()
+    ids = [checkin_id(user['email'], key) for key in {scan['key'] for scan in scans}]
+    for done in checkins.find({'_id': {'$in': ids}}):
+        key = done['_id']['key']
+        if 'result' in done:
+            results[key] = dict(done['result'], replayed=True)
+        elif take_over(checkins, done, now):
+            claimed[key] = {'key': key, 'qr': done['qr'], 'event': done['event'], 'again': done.get('again', False),
+                            'scanned_at': done['scanned_at'], 'batch': done['batch']}
+        else:
+            results[key] = {'statusCode': 409, 'body': 'scan is still being processed', 'replayed': True}
+
+    fresh, batch = [], str(ObjectId())
+    for scan in scans:
+        if scan['key'] in results or scan['key'] in claimed or any(scan['key'] == other['key'] for other in fresh):
+            continue
+        try:
+            fresh.append(dict(scan, scanned_at=scan_time(scan), batch=batch))
+        except ValueError:
+            results[scan['key']] = {'statusCode': 400, 'body': 'scanned_at is not an ISO 8601 time'}
+
+    taken = claim_keys(checkins, fresh, user['email'], now)
+    for key in taken:
+        results[key] = {'statusCode': 409, 'body': 'scan is still being processed', 'replayed': True}
+    claimed.update((scan['key'], scan) for scan in fresh if scan['key'] not in taken)
+    # planned in the order they were scanned in, whichever attempt they're from
+    ordered = [claimed.pop(scan['key']) for scan in scans if scan['key'] in claimed]
+
+    planned, increments = plan_checkins(ordered, resolve_qrs(users, list({scan['qr'] for scan in ordered})))
+    outcomes = apply_increments(users, increments)
+    rollups = dict()
+    for increment_key, increment in increments.items():
+        new_count = outcomes[increment_key]
+        if new_count is None:
+            for key in increment['keys']:
+                planned[key] = {'statusCode': 402, 'body': 'user already checked into event'}
+            continue
+        # the counts were planned from what was read, so they follow what the write left
+        for i, key in enumerate(increment['keys']):
+            planned[key]['body']['new_count'] = new_count - increment['by'] + i + 1
+        # the rollups only count what was applied, and the user is new to the event if the write took them from 0
+        event = increment_key[1]
+        added, attendees = rollups.get(event, (0, 0))
+        rollups[event] = (added + increment['by'], attendees + (1 if new_count == increment['by'] else 0))
+    attendance.record_many(rollups)
+    if planned:
+        checkins.bulk_write([pymongo.UpdateOne({'_id': checkin_id(user['email'], key)},
+                                               {'$set': {'result': result}})
+                             for key, result in planned.items()], ordered=False)
+    results.update(planned)
+
+    return {'statusCode': 200, 'body': [dict(results[scan['key']], key=scan['key']) for scan in scans]}
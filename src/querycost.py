@@ -0,0 +1,233 @@
+"""
+Admission control for the arbitrary queries organizers and directors run through read_info.
+
+On a collection big enough for it to matter, a query is explained before it runs, and a plan
+that scans the whole collection is rejected (or only logged, with QUERY_COLLSCAN_ACTION = 'warn').
+Queries that do run get a server-side time limit (QUERY_MAX_TIME_MS) and may return at most
+QUERY_MAX_RESULTS results; bigger reads have to be paged or streamed. A stream that runs out of time
+ends with an {"error": "timed out", "count": n} record, as its 200 has already been sent. The shape of every query
+(its fields and operators, without the values), its plan and how long it took are logged, so one
+careless query can't hold up check-in traffic and the slow ones can be found afterwards.
+"""
+import logging
+import time
+
+from pymongo.errors import ExecutionTimeout
+
+import config
+from src.indexes import plan_stages
+
+logger = logging.getLogger(__name__)
+
+# pages and streams walk the _id index, so dumping every user is admitted rather than seen as a scan;
+# a filter on anything else that can only walk it is still a scan, it just comes back in order
+ID_ORDER = [('_id', 1)]
+LOGICAL_OPERATORS = ('$and', '$or', '$nor')
+
+
+class QueryRejected(Exception):
+    """
+    Raised when a query is refused, with the status code the endpoint should answer with.
+    """
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def max_time_ms():
+    return getattr(config, 'QUERY_MAX_TIME_MS', 5000)
+
+
+def max_results():
+    return getattr(config, 'QUERY_MAX_RESULTS', 10000)
+
+
+def needs_explain(document_count):
+    # scanning a small collection is cheaper than asking the planner about it
+    return document_count >= getattr(config, 'QUERY_EXPLAIN_MIN_DOCS', 10000)
+
+
+def query_shape(query):
+    """
+    The query with its values blanked out, ie. {"email": {"$in": "?"}}, so it can be logged safely.
+    """
+    if isinstance(query, dict):
+        return {key: query_shape(value) for key, value in query.items()}
+    if isinstance(query, list) and any(isinstance(value, (dict, list)) for value in query):
+        return [query_shape(value) for value in query]
+    return '?'
+
+
+def winning_plans(explained):
+    """
+    The winning plans in a find's or an aggregation's explain output (which nests them deeper).
+    """
+    if isinstance(explained, dict):
+        for key, value in explained.items():
+            if key == 'winningPlan':
+                yield value
+            else:
+                yield from winning_plans(value)
+    elif isinstance(explained, list):
+        for value in explained:
+            yield from winning_plans(value)
+
+
+def plan_indexes(plan):
+    """
+    The names of the indexes a (possibly nested) query plan reads.
+    """
+    names = [plan['indexName']] if 'indexName' in plan else []
+    for child in plan.get('inputStages', []) + [plan[key] for key in ('inputStage', 'queryPlan') if key in plan]:
+        names.extend(plan_indexes(child))
+    return names
+
+
+def filters_on(query):
+    """
+    The fields (and operators like $expr) a find's query or an aggregation's $match stages filter on.
+    """
+    if isinstance(query, list):
+        return {field for stage in query if isinstance(stage, dict) for field in filters_on(stage.get('$match', {}))}
+    fields = set()
+    for key, value in query.items():
+        if key in LOGICAL_OPERATORS:
+            fields.update(field for clause in value for field in filters_on(clause))
+        else:
+            fields.add(key)
+    return fields
+
+
+def scans_by_id(query, plans):
+    """
+    Whether the plans only walk the _id index (as a sort on _id lets them) to filter on something else,
+    ie. read the whole collection just the same as a COLLSCAN would.
+    """
+    indexes = {name for plan in plans for name in plan_indexes(plan)}
+    return indexes == {'_id_'} and bool(filters_on(query) - {'_id'})
+
+
+def check_plan(collection_name, query, explained):
+    """
+    Returns the stages of the explained plan, raising QueryRejected if it scans the whole collection
+    (unless the configured action is to only warn about it).
+    """
+    plans = list(winning_plans(explained))
+    stages = [stage for plan in plans for stage in plan_stages(plan)]
+    if 'COLLSCAN' in stages or scans_by_id(query, plans):
+        reject = getattr(config, 'QUERY_COLLSCAN_ACTION', 'reject') == 'reject'
+        logger.warning('%s collection scan on %s: %s', 'rejected' if reject else 'allowed',
+                       collection_name, query_shape(query))
+        if reject:
+            raise QueryRejected("The query would scan the whole collection; "
+                                "add a condition on an indexed field (ie. email), or page through it with limit")
+    return stages
+
+
+def log_query(kind, collection_name, query, stages, started, count, timed_out=False):
+    logger.info('%s on %s %s: %d results in %.1fms%s (plan: %s)', kind, collection_name, query_shape(query),
+                count, 1000 * (time.perf_counter() - started), ' before timing out' if timed_out else '',
+                ' <- '.join(stage for stage in stages if stage) or 'not explained')
+
+
+def timed_out(kind, collection_name, query, stages, started):
+    log_query(kind, collection_name, query, stages, started, 0, timed_out=True)
+    return QueryRejected("The query took longer than {}ms".format(max_time_ms()), 408)
+
+
+def over_cap(results):
+    if len(results) > max_results():
+        raise QueryRejected("The query matched more than {} results; page through them with limit and after "
+                            "or stream them".format(max_results()), 413)
+    return results
+
+
+def capped_pipeline(pipeline):
+    return list(pipeline) + [{'$limit': max_results() + 1}]
+
+
+def admit_find(collection, query, sort=None, limit=None):
+    """
+    Explains the find as it will run, since a sort on _id (as pages and streams use) and a limit
+    can let it walk the _id index instead of scanning the collection.
+    """
+    if not needs_explain(collection.estimated_document_count()):
+        return []
+    cursor = collection.find(query)
+    if sort is not None:
+        cursor = cursor.sort(sort)
+    if limit is not None:
+        cursor = cursor.limit(limit)
+    return check_plan(collection.name, query, cursor.explain())
+
+
+def admit_aggregate(collection, pipeline):
+    if not needs_explain(collection.estimated_document_count()):
+        return []
+    explained = collection.database.command('aggregate', collection.name, pipeline=pipeline, explain=True)
+    return check_plan(collection.name, pipeline, explained)
+
+
+def find(collection, query, projection, sort=None, limit=None):
+    """
+    The results of an admitted find. Without a limit, at most max_results are allowed.
+    """
+    limit = limit if limit is not None else max_results() + 1
+    stages = admit_find(collection, query, sort, limit)
+    cursor = collection.find(query, projection).max_time_ms(max_time_ms())
+    if sort is not None:
+        cursor = cursor.sort(sort)
+    cursor = cursor.limit(limit)
+    started = time.perf_counter()
+    try:
+        results = list(cursor)
+    except ExecutionTimeout:
+        raise timed_out('find', collection.name, query, stages, started)
+    log_query('find', collection.name, query, stages, started, len(results))
+    return over_cap(results)
+
+
+def stream(collection, query, projection):
+    """
+    An admitted find whose results are yielded as they're read (in _id order), so they aren't capped.
+    If it runs out of time, it ends with a stream_timed_out record instead.
+    """
+    stages = admit_find(collection, query, ID_ORDER)
+    cursor = collection.find(query, projection).max_time_ms(max_time_ms()).sort(ID_ORDER)
+    return _streamed(collection, query, stages, cursor)
+
+
+def stream_timed_out(count):
+    """
+    The last record of a stream that ran out of time: the response has already started with a 200,
+    so this is how the reader tells a cut-short stream from a complete one.
+    """
+    return {'error': 'timed out', 'count': count}
+
+
+def _streamed(collection, query, stages, cursor):
+    started = time.perf_counter()
+    count = 0
+    try:
+        for doc in cursor:
+            count += 1
+            yield doc
+    except ExecutionTimeout:
+        log_query('stream', collection.name, query, stages, started, count, timed_out=True)
+        yield stream_timed_out(count)
+        return
+    log_query('stream', collection.name, query, stages, started, count)
+
+
+def aggregate(collection, pipeline):
+    """
+    The results of an admitted aggregation, of which at most max_results are allowed.
+    """
+    stages = admit_aggregate(collection, pipeline)
+    started = time.perf_counter()
+    try:
+        results = list(collection.aggregate(capped_pipeline(pipeline), maxTimeMS=max_time_ms()))
+    except ExecutionTimeout:
+        raise timed_out('aggregate', collection.name, pipeline, stages, started)
+    log_query('aggregate', collection.name, pipeline, stages, started, len(results))
+    return over_cap(results)
@@ -1,13 +1,104 @@
+import base64
+
+import bson
+import bson.errors
+
 from src.schemas import *
+from src import stats, querycost
+
+# the page size when a continuation token is given without a limit
+DEFAULT_PAGE_SIZE = 500
+
+
+def read_projection(event):
+    """
+    Function used to build the projection for a read, so that the DB only sends back what is needed
+    (and never the password). The caller may ask for a subset of the fields by listing them in "projection".
+    """
+    if 'projection' in event:
+        return user_projection(event['projection'])
+    return USER_PROJECTION
+
+def public_pipeline(event):
+    """
+    Function used to build the aggregation behind a public read
+    """
+    # the fields to be aggregated
+    fields = event['fields']
+    # filter based on the just_here boolean indicating whether or not to aggregate on checked-in users
+    match = {"$match": {"registration_status": ("checked-in" if event.get('just_here', False) else {"$ne": "unregistered"})}}
+    # group by is performed using each of the fields requested
+    group = {"$group": {"_id": {field: "$" + field for field in fields}, "total": {"$sum": 1}}}
+    return [match, group]
+
+
+class InvalidContinuation(Exception):
+    """
+    Raised for an "after" token that wasn't made by encode_continuation
+    """
+
+
+def encode_continuation(last_id):
+    """
+    Function used to make the opaque token a caller passes back as "after" to get the next page
+    """
+    return base64.urlsafe_b64encode(bson.BSON.encode({'after': last_id})).decode('ascii')
+
+
+def decode_continuation(token):
+    """
+    Function used to read the _id back out of a continuation token, raising InvalidContinuation if it isn't one of ours
+    """
+    try:
+        return bson.BSON(base64.urlsafe_b64decode(token.encode('ascii'))).decode()['after']
+    except (ValueError, TypeError, KeyError, IndexError, bson.errors.BSONError) as err:
+        raise InvalidContinuation() from err
+
+
+def page_request(event):
+    """
+    Function used to build the query, projection and page size of a paginated read. Pages are
+    walked in _id order, so the _id is always fetched (page_body drops it again unless asked for).
+    """
+    query = event['query']
+    if 'after' in event:
+        query = {'$and': [query, {'_id': {'$gt': decode_continuation(event['after'])}}]}
+    projection = dict(read_projection(event), _id=True)
+    return query, projection, min(event.get('limit', DEFAULT_PAGE_SIZE), querycost.max_results())
+
 
-def tidy_results(res):
+def page_body(event, docs, limit):
     """
-    Function used to clean up read results before returning to the user
+    Function used to build the body of a paginated read, with the token for the next page (if there might be one)
     """
-    for i in res:
-        del i['_id']
-        del i['password']
-    return res
+    next_token = encode_continuation(docs[-1]['_id']) if len(docs) == limit else None
+    if '_id' not in event.get('projection', []):
+        for doc in docs:
+            del doc['_id']
+    return {"results": docs, "next": next_token}
+
+
+def find_results(user_coll, event, context):
+    """
+    Function used to run an organizer's find. The results may be paged (with "limit" and "after") or, when
+    self-hosted, streamed (with "stream") so that dumping every user doesn't need them all in memory.
+    """
+    try:
+        if event.get('stream', False):
+            # lambdas have to return their whole response at once
+            if context is not None:
+                return {"statusCode": 400, "body": "Streaming is only supported by the self-hosted server"}
+            return {"statusCode": 200, "body": querycost.stream(user_coll, event['query'], read_projection(event))}
+        if 'limit' not in event and 'after' not in event:
+            return {"statusCode": 200, "body": querycost.find(user_coll, event['query'], read_projection(event))}
+        query, projection, limit = page_request(event)
+        docs = querycost.find(user_coll, query, projection, sort=querycost.ID_ORDER, limit=limit)
+        return {"statusCode": 200, "body": page_body(event, docs, limit)}
+    except querycost.QueryRejected as err:
+        return {"statusCode": err.status, "body": str(err)}
+    except InvalidContinuation:
+        return {"statusCode": 400, "body": "invalid continuation"}
+
 
 @ensure_schema({
     "type": "object",
@@ -19,8 +110,7 @@ def tidy_results(res):
                     "type": "array",
                     "items": {
                         "type": "string",
-                        "enum": ["major", "shirt_size", "dietary_restrictions", "school", "grad_year",
-                                 "gender", "level_of_study", "ethnicity"]
+                        "enum": stats.STAT_FIELDS
                     },
                     "uniqueItems": True
                 },
@@ -36,15 +126,8 @@ def public_read(event, context):
     """
     Function responsible for performing a public read (can be requested by anyone)
     """
-    # the fields to be aggregated
-    fields = event['fields']
-    # filter based on the just_here boolean indicating whether or not to aggregate on checked-in users
-    match = {"$match": {"registration_status": ("checked-in" if event.get('just_here', False) else {"$ne": "unregistered"})}}
-    # group by is performed using each of the fields requested
-    group = {"$group": {"_id": {field: "$" + field for field in fields}, "total": {"$sum": 1}}}
-    user_coll = util.coll('users')
-    # aggregate's pipelining is used to fetch the results from the user data
-    return {"statusCode": 200, "body": list(user_coll.aggregate([match, group]))}
+    # the counts are kept up to date as users change (see stats.py), so they needn't be aggregated here
+    return {"statusCode": 200, "body": stats.public_stats(event)}
 
 
 def user_read(event, context, user):
@@ -59,7 +142,7 @@ def user_read(event, context, user):
     if user['registration_status'] in ['unregistered', 'registered', 'rejected']:
         if 'travelling_from' in user and 'reimbursement' in user['travelling_from']:
             del user['travelling_from']['reimbursement']
-    return {"statusCode": 200, "body": [user]}
+    return {"statusCode": 200, "body": [dict(user)]}
 
 
 @ensure_admin_user(on_failure=lambda e, c, u, *a: user_read(e, c, u))
@@ -72,8 +155,8 @@ def organizer_read(event, context, user):
         return public_read(event, context)
 
     # otherwise, the organizer submitted query is ran on the database and results are returned
-    user_coll = util.coll('users')
-    return {"statusCode": 200, "body": tidy_results(list(user_coll.find(event['query'])))}
+    user_coll = util.coll('users', 'analytics')
+    return find_results(user_coll, event, context)
 
 
 @ensure_schema({
@@ -81,7 +164,11 @@ def organizer_read(event, context, user):
     "properties": {
         "token": {"type": "string"},
         "query": {"type": "object"},
-        "aggregate": {"type": "boolean"}
+        "aggregate": {"type": "boolean"},
+        "projection": {"type": "array", "items": {"type": "string"}, "uniqueItems": True},
+        "limit": {"type": "integer", "minimum": 1},
+        "after": {"type": "string"},
+        "stream": {"type": "boolean"}
     },
     "required": ["query"]
 })
@@ -94,9 +181,16 @@ def read_info(event, context, user=None):
     and otherwise "find_one."
     If the endpoint is called by a non-LCS user, falls back upon public_read
     If the endpoint is called by a non-director, falls back upon organizer_read
+    Finds can be paginated with "limit" (and the "next" token of a page as "after") or streamed with "stream";
+    a stream that runs out of time ends with an {"error": "timed out", "count": n} line.
+    Every query goes through querycost first, so ones that would scan every user, run too long or
+    return too much are refused.
     """
-    tests = util.coll('users')
+    tests = util.coll('users', 'analytics')
 
     if event.get('aggregate', False):
-        return {"statusCode": 200, "body": list(tests.aggregate(event['query']))}
-    return {"statusCode": 200, "body": tidy_results(list(tests.find(event['query'])))}
+        try:
+            return {"statusCode": 200, "body": querycost.aggregate(tests, event['query'])}
+        except querycost.QueryRejected as err:
+            return {"statusCode": err.status, "body": str(err)}
+    return find_results(tests, event, context)
@@ -1,3 +1,11 @@
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
 import requests as req
 from pymongo import UpdateOne
 from pymongo.errors import BulkWriteError
@@ -10,76 +18,202 @@ def chunker(seq, size):
     return (seq[pos:pos + size] for pos in range(0, len(seq), size))
 
 
-def req_matrix_and_clean(params):
+MATRIX_BASE_URL = "https://maps.googleapis.com/maps/api/distancematrix/json"
+# the Distance Matrix parameters for each mode of transportation
+MODES = {
+    "car": {"mode": "driving"},
+    "train": {"mode": "transit", "transit_mode": "train"},
+    "bus": {"mode": "transit", "transit_mode": "bus"},
+}
+# the most origins Google takes in one request
+ORIGINS_PER_REQUEST = 25
+# set on a user whenever their travel or registration changes (see validate.touches_reimbursement)
+UPDATED_AT = "travelling_from_updated_at"
+# the watermarks document of compute_all_reimburse's last run
+WATERMARK_ID = "reimburse"
+# the statuses (of the whole response) worth asking again for
+RETRY_STATUSES = {"OVER_QUERY_LIMIT", "UNKNOWN_ERROR"}
+# the statuses of users who shouldn't keep a reimbursement
+INELIGIBLE_STATUSES = ["unregistered", "rejected"]
+
+
+class RateLimiter:
     """
-    Function used to make a Google API call to fetch the distances
+    Spaces calls out to at most per_second, across threads
     """
-    def elem_to_dist(elem):
-        if elem['status'] != 'OK':
-            return 0
-        else:
-            return elem['distance']['value']
-    # Google API is called using the below link with the configured parameters for each mode of transportation
-    # and all the sources and destination
-    MATRIX_BASE_URL = "https://maps.googleapis.com/maps/api/distancematrix/json"
-    got = req.get(MATRIX_BASE_URL, params=params)
-    # raises an error is one occurred by calling the Google API
-    got.raise_for_status()
-    # otherwise, fetches the JSON received as response
-    mat = got.json()
-    # error checking to ensure request was successful
-    if mat['status'] != 'OK':
-        raise ValueError(mat)
-    # converts the results into a dictionary where the key is the address and the value is the distance, if it was
-    # successfully given from the Google API, otherwise it's defaulted to 0
-    return {val: elem_to_dist(mat['rows'][idx]['elements'][0]) for idx, val in enumerate(mat['origin_addresses'])}
-
-
-def req_distance_matrices(users):
+    def __init__(self, per_second):
+        self.interval = 1.0 / per_second if per_second else 0
+        self.next_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            wait_for = self.next_at - now
+            self.next_at = max(now, self.next_at) + self.interval
+        if wait_for > 0:
+            time.sleep(wait_for)
+
+
+class RetryableError(Exception):
     """
-    Function used to create distance matrices where one axis represents the mode of transportation: car, bus and train
-    while the other axis represents all the unique addresses of hackers
-    """
-    acc = {"car": dict(), "bus": dict(), "train": dict()}
-
-    # Google API calls are broken apart into 25 users at a time
-    for sub_users in chunker(users, 25):
-        # determines all the unique locations that this 25 size subset of users travelled from and concatenates them,
-        # separating each by a "|" (so that it can be sent along with the Google API request)
-        origins = "|".join(u['travelling_from']['formatted_addr'] for u in sub_users
-                           if u['travelling_from']['formatted_addr'] not in acc['car'])
-        destinations = config.TRAVEL.HACKRU_LOCATION
-        if origins == "":  # don't do a request if there are no unique origins
+    Raised for a Google API failure that may well go away if the request is made again
+    """
+
+
+def elem_to_dist(elem):
+    if elem['status'] != 'OK':
+        return 0
+    else:
+        return elem['distance']['value']
+
+
+def req_matrix_and_clean(params, origins, limiter=None):
+    """
+    Function used to make a Google API call to fetch the distances from the origins, retrying with exponential
+    backoff if Google is busy (or unreachable)
+    """
+    retries = getattr(config, 'MAPS_RETRIES', 4)
+    backoff = getattr(config, 'MAPS_BACKOFF_SECONDS', 0.5)
+    params = dict(params, origins="|".join(origins))
+    for attempt in range(retries + 1):
+        if limiter is not None:
+            limiter.wait()
+        try:
+            # Google API is called using the below link with the configured parameters
+            got = req.get(getattr(config, 'MAPS_API_URL', None) or MATRIX_BASE_URL, params=params, timeout=30)
+            if got.status_code == 429 or got.status_code >= 500:
+                raise RetryableError("HTTP {}".format(got.status_code))
+            # raises an error is one occurred by calling the Google API
+            got.raise_for_status()
+            # otherwise, fetches the JSON received as response
+            mat = got.json()
+            if mat['status'] in RETRY_STATUSES:
+                raise RetryableError(mat['status'])
+        except (RetryableError, req.ConnectionError, req.Timeout):
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2 ** attempt * (1 + random.random()))
             continue
+        # error checking to ensure request was successful
+        if mat['status'] != 'OK':
+            raise ValueError(mat)
+        # the rows come back in the order of the origins, and the distance is defaulted to 0 if Google couldn't
+        # give one
+        return {origin: elem_to_dist(row['elements'][0]) for origin, row in zip(origins, mat['rows'])}
+
+
+def distance_cache():
+    """
+    Where fetched distances are kept: "mongo" (the distances collection), a JSON file's path or None
+    """
+    return getattr(config, 'DISTANCE_CACHE', 'mongo')
+
+
+class DistanceCache:
+    """
+    The fetched distances to a destination, in the distances collection ("mongo"), a JSON file or nowhere (None).
+    Only the addresses asked about are read from the collection; a file is read at most once and only written back
+    by save, so a run's memory and I/O don't grow with every chunk
+    """
+    def __init__(self, destination):
+        self.destination = destination
+        self.where = distance_cache()
+        self.file = None
+        self.dirty = False
+
+    def contents(self):
+        if self.file is None:
+            self.file = dict()
+            if os.path.exists(self.where):
+                with open(self.where) as cached:
+                    self.file = json.load(cached)
+        return self.file
+
+    def load(self, addresses):
+        """
+        The cached distances to the given addresses, by mode and then address
+        """
+        acc = {mode: dict() for mode in MODES}
+        if self.where == 'mongo':
+            for found in util.coll('distances').find({'destination': self.destination,
+                                                      'addr': {'$in': list(addresses)}}):
+                acc[found['mode']][found['addr']] = found['distance']
+        elif self.where is not None:
+            wanted = set(addresses)
+            for mode, distances in self.contents().get(self.destination, {}).items():
+                acc[mode].update({addr: dist for addr, dist in distances.items() if addr in wanted})
+        return acc
+
+    def store(self, fetched):
+        """
+        Adds the newly fetched distances (by mode and then address) to the cache
+        """
+        if self.where == 'mongo':
+            ops = [UpdateOne({'destination': self.destination, 'mode': mode, 'addr': addr},
+                             {'$set': {'distance': distance, 'fetched_at': datetime.utcnow()}}, upsert=True)
+                   for mode, distances in fetched.items() for addr, distance in distances.items()]
+            if ops:
+                util.coll('distances').bulk_write(ops, ordered=False)
+        elif self.where is not None:
+            for mode, distances in fetched.items():
+                self.contents().setdefault(self.destination, dict()).setdefault(mode, dict()).update(distances)
+                self.dirty = self.dirty or bool(distances)
+
+    def save(self):
+        if not self.dirty:
+            return
+        # written aside and moved over so a crash can't leave half a file
+        with open(self.where + '.tmp', 'w') as out:
+            json.dump(self.file, out)
+        os.replace(self.where + '.tmp', self.where)
+        self.dirty = False
+
 
-        # Google API parameters are created using the relevant information for each mode of transportation
-        car_params = {
-            "origins": origins,
-            "destinations": destinations,
-            "mode": "driving",
-            "key": config.MAPS_API_KEY,
-        }
-        train_params = {
-            "origins": origins,
-            "destinations": destinations,
-            "mode": "transit",
-            "transit_mode": "train",
-            "key": config.MAPS_API_KEY,
-        }
-        bus_params = {
-            "origins": origins,
-            "destinations": destinations,
-            "mode": "transit",
-            "transit_mode": "bus",
-            "key": config.MAPS_API_KEY,
-        }
-
-        # the distance matrix is updated to include new addresses and their distances for each mode of transportation
-        # where the distance comes from making a call to Google API (see req_matrix_and_clean)
-        acc['car'].update(req_matrix_and_clean(car_params))
-        acc['train'].update(req_matrix_and_clean(train_params))
-        acc['bus'].update(req_matrix_and_clean(bus_params))
+def req_distance_matrices(users, cache=None):
+    """
+    Function used to create distance matrices where one axis represents the mode of transportation: car, bus and train
+    while the other axis represents all the unique addresses of hackers.
+    Distances already in the cache aren't asked for again, and the rest are fetched concurrently (for every
+    mode and chunk of 25 addresses) within the configured rate limit. Without a cache to share (and save) across
+    chunks, one is made and saved for just these users
+    """
+    destination = config.TRAVEL.HACKRU_LOCATION
+    own_cache = cache is None
+    if own_cache:
+        cache = DistanceCache(destination)
+    addresses = sorted({u['travelling_from']['formatted_addr'] for u in users})
+    acc = cache.load(addresses)
+
+    # Google API calls are broken apart into 25 addresses at a time, for each mode that's missing them
+    jobs = []
+    for mode, mode_params in MODES.items():
+        missing = [addr for addr in addresses if addr not in acc[mode]]
+        params = dict(mode_params, destinations=destination, key=config.MAPS_API_KEY)
+        jobs.extend((mode, params, origins) for origins in chunker(missing, ORIGINS_PER_REQUEST))
+    if not jobs:
+        return acc
 
+    limiter = RateLimiter(getattr(config, 'MAPS_REQUESTS_PER_SECOND', 10))
+    fetched = {mode: dict() for mode in MODES}
+    with ThreadPoolExecutor(max_workers=getattr(config, 'MAPS_CONCURRENCY', 4)) as pool:
+        futures = [(mode, pool.submit(req_matrix_and_clean, params, origins, limiter))
+                   for mode, params, origins in jobs]
+        failures = []
+        for mode, future in futures:
+            try:
+                fetched[mode].update(future.result())
+            except Exception as e:
+                failures.append(e)
+    # whatever was fetched is kept even if some requests failed, so a rerun only asks for the rest
+    cache.store(fetched)
+    if own_cache:
+        cache.save()
+    if failures:
+        raise failures[0]
+
+    for mode in MODES:
+        acc[mode].update(fetched[mode])
     # the entire distance matrix is returned after all the distances have been fetched
     return acc
 
@@ -115,42 +249,105 @@ def users_to_reimburse(lookup, users):
     return table, total
 
 
+def reimburse_query(since=None):
+    """
+    Function used to build the query for the users to reimburse: registered hackers with a ready address and,
+    for an incremental run, whose travel (or registration) changed since the last run
+    """
+    query = {"travelling_from": {"$exists": True}, "travelling_from.addr_ready": True,
+             "registration_status": "registered"}
+    if since is not None:
+        query[UPDATED_AT] = {"$gt": since}
+    return query
+
+
+def stale_query(since=None):
+    """
+    Function used to build the query for the users whose reimbursement no longer applies: they unregistered (or were
+    rejected) or their address isn't ready anymore. Like reimburse_query, an incremental run only looks at the users
+    that changed since the last run
+    """
+    query = {"travelling_from.reimbursement": {"$exists": True},
+             "$or": [{"registration_status": {"$in": INELIGIBLE_STATUSES}},
+                     {"travelling_from.addr_ready": {"$ne": True}}]}
+    if since is not None:
+        query[UPDATED_AT] = {"$gt": since}
+    return query
+
+
+def reimburse_chunk(user_coll, users, cache=None):
+    """
+    Function used to compute the reimbursements of a chunk of users and write the ones that changed, returning the
+    sum of the chunk's reimbursements and how many were written
+    """
+    lookup = req_distance_matrices(users, cache)
+    table, total = users_to_reimburse(lookup, users)
+    previous = {user['email']: user['travelling_from'].get('reimbursement') for user in users}
+    bulk_op = [UpdateOne({'email': email}, {'$set': {'travelling_from.reimbursement': table[email]}})
+               for email in table if previous.get(email) != table[email]]
+    if bulk_op:
+        user_coll.bulk_write(bulk_op, ordered=False)
+    return total, len(bulk_op)
+
+
 @ensure_schema({
     "type": "object",
     "properties": {
         "token": {"type": "string"},
-        "day-of": {"type": "boolean"}
+        "day-of": {"type": "boolean"},
+        "incremental": {"type": "boolean"}
     },
     "required": ["token"]
 })
-@ensure_logged_in_user()
+@ensure_logged_in_user(fields=["email", "is_admin", "role"])
 @ensure_role([['director']])
 def compute_all_reimburse(event, context, user=None):
     """
-    Function used by a director to compute reimbursements
+    Function used by a director to compute reimbursements. With "incremental", only the users whose travel changed
+    since the last run are recomputed. Users are read from the cursor a chunk at a time, and only reimbursements
+    that changed are written
     """
-    # all the relevant users are fetched by querying all hackers that are registered, have a travelling_from field and
-    # have the addr_ready boolean set to True within the travelling_from object
     user_coll = util.coll('users')
-    user_query = {"travelling_from": {"$exists": True}, "travelling_from.addr_ready": True,
-                  "registration_status": "registered"}
-    users = list(user_coll.find(user_query))
+    watermarks = util.coll('watermarks')
+    incremental = event.get('incremental', False)
+    # taken before reading, so changes made while this runs are picked up by the next run
+    started = datetime.utcnow()
+    since = None
+    if incremental:
+        last_run = watermarks.find_one({'_id': WATERMARK_ID})
+        since = last_run['watermark'] if last_run is not None else None
 
-    # tries to create the distance matrix and error's out in-case of any Google API errors
+    # all the relevant users are fetched by querying all hackers that are registered, have a travelling_from field and
+    # have the addr_ready boolean set to True within the travelling_from object
+    users = user_coll.find(reimburse_query(since), {'_id': False, 'email': True, 'travelling_from': True})
+    total, processed, written = 0, 0, 0
+    chunk = []
+    cache = DistanceCache(config.TRAVEL.HACKRU_LOCATION)
     try:
-        lookup = req_distance_matrices(users)
+        for user in users:
+            chunk.append(user)
+            if len(chunk) == getattr(config, 'REIMBURSE_CHUNK_SIZE', 500):
+                chunk_total, chunk_written = reimburse_chunk(user_coll, chunk, cache)
+                total, processed, written = total + chunk_total, processed + len(chunk), written + chunk_written
+                chunk = []
+        if chunk:
+            chunk_total, chunk_written = reimburse_chunk(user_coll, chunk, cache)
+            total, processed, written = total + chunk_total, processed + len(chunk), written + chunk_written
+        # the users who stopped being eligible aren't in the query above, so their reimbursements are dropped here
+        written += user_coll.update_many(stale_query(since),
+                                         {'$unset': {'travelling_from.reimbursement': True}}).modified_count
+    except BulkWriteError as bwe:
+        return {'statusCode': 512, 'body': bwe.details}
+    # errors out in-case of any Google API errors
     except Exception as e:
         return {'statusCode': 512, 'body': repr(e)}
-    # This line was purely for testing can be deleted if no more test are needed or have API key
-    #lookup = None
+    finally:
+        cache.save()
 
-    # uses the distance matrix to determine the reimbursements for each user and the sum total of all reimbursements
-    table, total = users_to_reimburse(lookup, users)
-    print(table)
-    # uses bulk write to set the calculated reimbursement for each user within the database
-    bulk_op = [UpdateOne({'email': email}, {'$set': {'travelling_from.reimbursement': table[email]}}) for email in table]
-    try:
-        data = user_coll.bulk_write(bulk_op, ordered=False)
-        return {'statusCode': 200, 'mongo_result': data.bulk_api_result, 'total': total}
-    except BulkWriteError as bwe:
-        return {'statusCode': 512, 'body': bwe.details}
+    watermarks.update_one({'_id': WATERMARK_ID}, {'$set': {'watermark': started}}, upsert=True)
+    if since is not None:
+        # the users left alone still count towards the sum total of all reimbursements
+        summed = list(user_coll.aggregate([{'$match': reimburse_query()},
+                                           {'$group': {'_id': None, 'total': {'$sum': '$travelling_from.reimbursement'}}}]))
+        total = summed[0]['total'] if summed else 0
+    return {'statusCode': 200, 'total': total, 'processed': processed, 'written': written}
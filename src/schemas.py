@@ -1,32 +1,116 @@
+import json
+from collections.abc import Mapping
+
 import jsonschema as js
-from src import util
+from src import util, tokens
 import jwt
 
 import config
 from functools import wraps
 
 
+# compiled validators, keyed by the canonical JSON of their schema so that the
+# many endpoints sharing a schema (ie. just a token) share a validator too
+_validators = dict()
+
+
+def compiled_validator(schema):
+    """
+    Checks the schema and builds a validator for it exactly once. js.validate
+    re-resolves the validator class and rebuilds the validator on every call, which
+    is pure overhead on every request since our schemas never change.
+    """
+    key = json.dumps(schema, sort_keys=True)
+    if key not in _validators:
+        js.Draft4Validator.check_schema(schema)
+        _validators[key] = js.Draft4Validator(schema)
+    return _validators[key]
+
+
 def ensure_schema(schema, on_failure=lambda e, c, err: {"statusCode": 400, "body": "Error in JSON: {}".format(err)}):
     """
     Wrapper function used to validate the schema and that the given JSON follows it
     """
-    js.Draft4Validator.check_schema(schema)
+    validator = compiled_validator(schema)
     def wrap(fn):
         @wraps(fn)
         def wrapt(event, context, *extras):
             try:
-                js.validate(event, schema)
+                validator.validate(event)
                 return util.add_cors_headers(fn(event, context, *extras))
             except js.exceptions.ValidationError as e:
                 return util.add_cors_headers(on_failure(event, context, e))
+        wrapt.validator = validator
         return wrapt
     return wrap
 
 
-def ensure_logged_in_user(token_key='token', on_failure=lambda e, c, m, *a: {"statusCode": 403, "body": m}):
+# what a user document looks like to a handler that did not ask for specific fields
+USER_PROJECTION = {'_id': False, 'password': False}
+
+
+def user_projection(fields=None):
+    """
+    The projection to fetch a user with, given the fields a handler needs. The email is always
+    included since it identifies the user and the password hash is never included.
+    """
+    if fields is None:
+        return USER_PROJECTION
+    projection = {field: True for field in fields if field != 'password'}
+    projection['email'] = True
+    projection['_id'] = False
+    return projection
+
+
+class UnknownUser(Exception):
+    """
+    Raised by a LazyUser whose user no longer exists (ie. was deleted after the token was issued).
+    """
+
+
+class LazyUser(Mapping):
+    """
+    The user passed to handlers in the stateless mode. We know the email from the token,
+    so the user document is only fetched if the handler looks at anything else.
+    """
+
+    def __init__(self, email, projection=USER_PROJECTION):
+        self.email = email
+        self.projection = projection
+        self._doc = None
+
+    def load(self):
+        if self._doc is None:
+            user = util.coll('users').find_one({'email': self.email}, self.projection)
+            if user is None:
+                raise UnknownUser(self.email)
+            self._doc = user
+        return self._doc
+
+    def __getitem__(self, key):
+        if key == 'email' and self._doc is None:
+            return self.email
+        return self.load()[key]
+
+    def __iter__(self):
+        return iter(self.load())
+
+    def __len__(self):
+        return len(self.load())
+
+
+def ensure_logged_in_user(token_key='token', on_failure=lambda e, c, m, *a: {"statusCode": 403, "body": m},
+                          fields=None):
     """
     Wrapper function used to authorize user using email and an auth token
+
+    The handler can declare the user fields it uses so only those are fetched,
+    otherwise it gets the whole user (minus the password).
+
+    If config.JWT_STATELESS is set, a valid signature on a token that has not been revoked
+    is enough and the handler gets a LazyUser, saving the user lookup on the hot path.
     """
+    projection = user_projection(fields)
     def rapper(fn):
         @wraps(fn)
         def wrapt(event, context, *args):
@@ -38,19 +122,19 @@ def ensure_logged_in_user(token_key='token', on_failure=lambda e, c, m, *a: {"st
                 return on_failure(event, context, str(err), *args)
 
             email = decoded_payload["email"]
-            users = util.coll('users')
+            if getattr(config, 'JWT_STATELESS', False):
+                if tokens.revocations.is_revoked(token):
+                    return on_failure(event, context, 'Unauthorized token', *args)
+                try:
+                    return fn(event, context, LazyUser(email, projection), *args)
+                except UnknownUser:
+                    # a deleted user's tokens are no good, even if we only find out once the handler looks
+                    return on_failure(event, context, 'Unauthorized token', *args)
 
-            # try to find user
-            user = users.find_one({'email': email})
+            # try to find the user the token was issued to
+            user = tokens.find_token_owner(email, token, projection)
             if user is None:
-                return on_failure(event, context, 'User Not found', *args)
-            
-            # look for token
-            tokens = list(filter(lambda tk: tk == token, user['token']))
-            if len(tokens) == 0:
                 return on_failure(event, context, 'Unauthorized token', *args)
-            del user['_id']
-            del user['password']
             return fn(event, context, user, *args)
         return wrapt
     return rapper
@@ -68,3 +152,27 @@ def ensure_admin_user(on_failure=lambda e, c, u, *a: {"statusCode": 403, "body":
             return on_failure(event, context, user, *args)
         return wrapt
     return ensure_auth_user
+
+
+def has_roles(user, roles):
+    """
+    Whether the user has at least 1 role within each subset of the set of roles
+    """
+    held = user.get('role') or {}
+    return all(any(held.get(role, False) for role in subset) for subset in roles)
+
+
+def ensure_role(roles, on_failure=lambda e, c, u, *a: {"statusCode": 403, "body": "User does not have privileges."}):
+    """
+    Wrapper function used to validate that a user has at least 1 role within each subset of the set of roles
+    (ie. [['director', 'organizer', 'volunteer']] lets any of the three through). Being an admin doesn't
+    count for any role. The user needs to have been fetched with the "role" field.
+    """
+    def ensure_user_roles(fn):
+        @wraps(fn)
+        def wrapt(event, context, user, *args):
+            if has_roles(user, roles):
+                return fn(event, context, user, *args)
+            return on_failure(event, context, user, *args)
+        return wrapt
+    return ensure_user_roles
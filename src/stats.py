@@ -0,0 +1,132 @@
+"""
+Materialized counts behind the public read.
+
+Rather than grouping every user on each anonymous dashboard hit, we keep one small document
+per distinct combination of the public fields (and registration status) with the number of
+users that have it. The endpoints that change those fields adjust the counts as they go and
+a public read only has to group this (much smaller) collection, with a short-lived
+in-memory cache in front.
+
+The counts have to be built once (and can be rebuilt if ever in doubt) with
+    python -m src.stats rebuild
+until then, public reads aggregate over the users as before.
+"""
+import json
+import sys
+import threading
+from datetime import datetime
+
+from cachetools import TTLCache
+from pymongo import UpdateOne
+
+import config
+from src import util, invalidation
+
+# the fields a public read may group on
+STAT_FIELDS = ["major", "shirt_size", "dietary_restrictions", "school", "grad_year",
+               "gender", "level_of_study", "ethnicity"]
+# what a user has to be fetched with for stat_key
+STAT_PROJECTION = dict({field: True for field in STAT_FIELDS}, registration_status=True, _id=False)
+
+BUILT_ID = 'built'
+
+_cache = TTLCache(maxsize=512, ttl=getattr(config, 'PUBLIC_STATS_TTL', 30))
+_cache_lock = threading.Lock()
+
+
+def clear_cache():
+    with _cache_lock:
+        _cache.clear()
+
+
+# any change to the counts makes the cached reads stale
+invalidation.subscribe('stats', lambda change: clear_cache())
+
+
+def stat_key(user):
+    """
+    The id of the count the user falls under, with the status and field values it stands for.
+    """
+    values = {field: user[field] for field in STAT_FIELDS if field in user}
+    status = user.get('registration_status')
+    return json.dumps([status, values], sort_keys=True, default=str), status, values
+
+
+def record_change(before, after):
+    """
+    Moves a user from the count for their old values to the one for their new ones.
+    before is None for a new user, after is None for a removed one.
+    """
+    old_key = stat_key(before)[0] if before is not None else None
+    ops = []
+    if after is not None:
+        key, status, values = stat_key(after)
+        if key == old_key:
+            return
+        ops.append(UpdateOne({'_id': key}, {'$inc': {'total': 1}, '$setOnInsert': {'status': status, 'values': values}},
+                             upsert=True))
+    if old_key is not None:
+        ops.append(UpdateOne({'_id': old_key}, {'$inc': {'total': -1}}))
+    if ops:
+        util.coll('stats').bulk_write(ops, ordered=False)
+        clear_cache()
+
+
+def rebuild():
+    """
+    Recounts everything from the users collection. The counts are built in a collection of their own
+    which then replaces the old ones in one rename, so reads never see them empty or half written.
+    """
+    group = {"$group": {"_id": dict({field: "$" + field for field in STAT_FIELDS},
+                                    registration_status="$registration_status"),
+                        "total": {"$sum": 1}}}
+    counts = []
+    for row in util.coll('users').aggregate([group]):
+        key, status, values = stat_key(row['_id'])
+        counts.append({'_id': key, 'status': status, 'values': values, 'total': row['total']})
+    building = util.get_db()[config.DB_COLLECTIONS['stats'] + '_rebuild']
+    building.drop()
+    building.insert_many(counts + [{'_id': BUILT_ID, 'built_at': datetime.utcnow()}])
+    building.rename(config.DB_COLLECTIONS['stats'], dropTarget=True)
+    # the rename is only seen on the new collection's old name, this tells the other processes' caches
+    util.coll('stats').update_one({'_id': BUILT_ID}, {'$set': {'built_at': datetime.utcnow()}})
+    clear_cache()
+    return len(counts)
+
+
+def stats_pipeline(fields, just_here):
+    """
+    The public read's aggregation, over the counts instead of the users.
+    """
+    match = {"$match": {"total": {"$gt": 0},
+                        "status": "checked-in" if just_here else {"$ne": "unregistered"}}}
+    group = {"$group": {"_id": {field: "$values." + field for field in fields}, "total": {"$sum": "$total"}}}
+    return [match, group]
+
+
+def public_stats(event):
+    """
+    The body of a public read: the number of users with each combination of the requested fields.
+    """
+    fields = event['fields']
+    just_here = event.get('just_here', False)
+    cache_key = (tuple(fields), just_here)
+    with _cache_lock:
+        counts = _cache.get(cache_key)
+    if counts is None:
+        stats = util.coll('stats', 'analytics')
+        if stats.find_one({'_id': BUILT_ID}) is not None:
+            counts = list(stats.aggregate(stats_pipeline(fields, just_here)))
+        else:
+            from src.read import public_pipeline
+            counts = list(util.coll('users', 'analytics').aggregate(public_pipeline(event)))
+        with _cache_lock:
+            _cache[cache_key] = counts
+    return counts
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ['rebuild']:
+        print('{} distinct combinations counted'.format(rebuild()))
+    else:
+        print(__doc__)
@@ -0,0 +1,189 @@
+import hashlib
+import threading
+import time
+from datetime import datetime
+
+import jwt
+
+import config
+from src import util, invalidation
+
+
+def token_hash(token):
+    """
+    We never need the token itself once it has been handed out, so we only keep its hash around.
+    """
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def uses_token_collection():
+    """
+    Tokens live either in an array on their user (the default) or, with TOKEN_STORE = "collection",
+    as hashes in their own indexed collection so that user documents stay small.
+    """
+    return getattr(config, 'TOKEN_STORE', 'user') == 'collection'
+
+
+def expired_tokens(token_list):
+    """
+    The tokens (from a user's token array) that can no longer be used.
+    """
+    expired = []
+    for token in token_list:
+        try:
+            jwt.decode(token, config.JWT_SECRET, algorithms=[config.JWT_ALGO])
+        except jwt.exceptions.InvalidTokenError:
+            expired.append(token)
+    return expired
+
+
+def revocation(email, token):
+    """
+    The revoked tokens entry for the token, or None if it's invalid or expired (and so never accepted anyway).
+    """
+    try:
+        payload = jwt.decode(token, config.JWT_SECRET, algorithms=[config.JWT_ALGO])
+    except jwt.exceptions.InvalidTokenError:
+        return None
+    return {'hash': token_hash(token), 'email': email, 'expires': datetime.utcfromtimestamp(payload['exp'])}
+
+
+def record_revocations(entries):
+    """
+    Records the revoked tokens entries, so stateless mode turns their tokens away.
+    """
+    entries = [entry for entry in entries if entry is not None]
+    if entries:
+        util.coll('revoked tokens').insert_many(entries)
+        for entry in entries:
+            revocations.revoked[entry['hash']] = entry['expires']
+
+
+def store_token(email, token, expires):
+    """
+    Records a newly issued token for the user. At most MAX_TOKENS_PER_USER tokens are kept
+    (the oldest are dropped first, and revoked since their signatures are still good) and
+    the user's expired tokens are pruned.
+    """
+    max_tokens = getattr(config, 'MAX_TOKENS_PER_USER', 10)
+    if uses_token_collection():
+        tokens_coll = util.coll('tokens')
+        tokens_coll.insert_one({'hash': token_hash(token), 'email': email, 'expires': expires})
+        # expired tokens are removed by the TTL index, so we only need to enforce the cap
+        newest_first = tokens_coll.find({'email': email}, {'hash': True, 'expires': True}).sort('expires', -1)
+        extra = list(newest_first.skip(max_tokens))
+        if extra:
+            tokens_coll.delete_many({'_id': {'$in': [doc['_id'] for doc in extra]}})
+            now = datetime.utcnow()
+            record_revocations([{'hash': doc['hash'], 'email': email, 'expires': doc['expires']}
+                                for doc in extra if doc['expires'] > now])
+        return
+
+    users = util.coll('users')
+    # the tokens from before the push tell us which ones the $slice dropped
+    before = users.find_one_and_update({'email': email},
+                                       {'$push': {'token': {'$each': [token], '$slice': -max_tokens}}},
+                                       projection={'_id': False, 'token': True})
+    stored = (before.get('token', []) if before is not None else []) + [token]
+    record_revocations([revocation(email, dropped) for dropped in stored[:-max_tokens]])
+    # mongo won't $push and $pull the same array in one update, so this is done separately
+    expired = expired_tokens(stored[-max_tokens:])
+    if expired:
+        users.update_one({'email': email}, {'$pull': {'token': {'$in': expired}}})
+
+
+def find_token_owner(email, token, projection=None):
+    """
+    The user with the given email, if the token was issued to them and is still stored.
+    """
+    users = util.coll('users')
+    if uses_token_collection():
+        found = util.coll('tokens').find_one({'hash': token_hash(token), 'email': email,
+                                              'expires': {'$gt': datetime.utcnow()}})
+        if found is None:
+            return None
+        return users.find_one({'email': email}, projection)
+    return users.find_one({'email': email, 'token': token}, projection)
+
+
+class RevocationCache:
+    """
+    An in-process set of revoked tokens, used when JWT_STATELESS is on so that a
+    valid signature and an absent hash are enough to let a request through.
+
+    The set is loaded from the "revoked tokens" collection on first use and then
+    refreshed in a background thread once it is older than refresh_seconds, so
+    requests never wait on Mongo after the first. Entries are evicted as their
+    tokens expire (at which point the signature check rejects them anyway).
+    """
+
+    def __init__(self, refresh_seconds=60):
+        self.refresh_seconds = refresh_seconds
+        self.revoked = dict()
+        self.refreshed_at = None
+        self.refreshing = threading.Lock()
+
+    def refresh(self):
+        now = datetime.utcnow()
+        revoked_coll = util.coll('revoked tokens')
+        self.revoked = {doc['hash']: doc['expires']
+                        for doc in revoked_coll.find({'expires': {'$gt': now}}, {'hash': True, 'expires': True})}
+        self.refreshed_at = time.monotonic()
+
+    def _refresh_in_background(self):
+        try:
+            self.refresh()
+        finally:
+            self.refreshing.release()
+
+    def maybe_refresh(self):
+        if self.refreshed_at is None:
+            # nothing to go off of yet, so the first request has to wait
+            with self.refreshing:
+                if self.refreshed_at is None:
+                    self.refresh()
+        elif time.monotonic() - self.refreshed_at > self.refresh_seconds and self.refreshing.acquire(blocking=False):
+            threading.Thread(target=self._refresh_in_background, daemon=True).start()
+
+    def add(self, token, expires):
+        self.revoked[token_hash(token)] = expires
+
+    def on_change(self, change):
+        """
+        Keeps the set in step with the revoked tokens collection, between refreshes.
+        """
+        if change['operation'] == 'insert' and change['document'] is not None:
+            self.revoked[change['document']['hash']] = change['document']['expires']
+        elif self.refreshed_at is not None:
+            # anything else can't be applied directly, so the next request refreshes the set
+            self.refreshed_at = float('-inf')
+
+    def is_revoked(self, token):
+        self.maybe_refresh()
+        key = token_hash(token)
+        expires = self.revoked.get(key)
+        if expires is None:
+            return False
+        if expires <= datetime.utcnow():
+            self.revoked.pop(key, None)
+            return False
+        return True
+
+
+revocations = RevocationCache(getattr(config, 'REVOCATION_REFRESH_SECONDS', 60))
+invalidation.subscribe('revoked tokens', revocations.on_change)
+
+
+def revoke_token(email, token):
+    """
+    Makes the token unusable in both the stateful mode (by dropping it from the user)
+    and the stateless one (by recording it in the revoked tokens collection).
+    """
+    entry = revocation(email, token)
+    if entry is None:
+        return
+    if uses_token_collection():
+        util.coll('tokens').delete_one({'hash': entry['hash']})
+    else:
+        util.coll('users').update_one({'email': email}, {'$pull': {'token': token}})
+    record_revocations([entry])
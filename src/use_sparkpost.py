@@ -1,11 +1,19 @@
-from sparkpost import SparkPost
-
 from src.schemas import *
 import config
 from src import util
 from src.read import read_info
 
-emails = SparkPost(config.SPARKPOST_KEY)
+_emails = None
+def get_sparkpost():
+    """
+    The SparkPost client, made on first use so that lambdas which never send emails
+    don't pay for importing and setting it up.
+    """
+    global _emails
+    if _emails is None:
+        from sparkpost import SparkPost
+        _emails = SparkPost(config.SPARKPOST_KEY)
+    return _emails
 
 
 @ensure_schema({
@@ -15,7 +23,7 @@ emails = SparkPost(config.SPARKPOST_KEY)
     },
     "required": ["token"]
 })
-@ensure_logged_in_user()
+@ensure_logged_in_user(fields=["email", "is_admin"])
 @ensure_admin_user()
 def list_all_templates(event, context, user):
     """
@@ -26,7 +34,7 @@ def list_all_templates(event, context, user):
     The template list is some sort of dictionary
     from sparkpost.
     """
-    templs = emails.templates.list()
+    templs = get_sparkpost().templates.list()
     return {'statusCode': 400, 'body': templs}
 
 
@@ -38,6 +46,7 @@ def do_substitutions(recs, links, template, usr):
 
     The shorter of recs and links is used for the matching.
     """
+    emails = get_sparkpost()
     # we use the uniqueness of emails to guarantee the uniqueness of these list_id's
     list_id = usr['email'] + '-emailing-people'
     # creates a list of dictionaries, each containing address which identifies the recipient and substitution data,
@@ -81,7 +90,7 @@ def do_substitutions(recs, links, template, usr):
     },
     "required": ["token", "template"]
 })
-@ensure_logged_in_user()
+@ensure_logged_in_user(fields=["email", "is_admin", "first_name"])
 def send_to_emails(event, context, usr):
     """
     If the user (validated via the email and token keys)
@@ -119,7 +128,7 @@ def send_to_emails(event, context, usr):
         # in case any recipients were specified (without links) or were assumed using the query, then email is sent to
         # these recipients with the provided template
         try:
-            resp = emails.transmissions.send(
+            resp = get_sparkpost().transmissions.send(
                     recipients=event['recipients'],
                     template=event['template']
             )
@@ -1,6 +1,9 @@
 import config
+import threading
+import time
 from functools import wraps
-from pymongo import MongoClient
+from pymongo import MongoClient, monitoring
+from pymongo.read_preferences import Primary, PrimaryPreferred, Secondary, SecondaryPreferred, Nearest
 import urllib.parse
 
 
@@ -30,6 +33,103 @@ def cors(f):
     return wrapper
 
 
+def db_uri():
+    """
+    The database URI with the credentials from the config filled in
+    """
+    username = urllib.parse.quote_plus(config.DB_USER)
+    password = urllib.parse.quote_plus(config.DB_PASSWORD)
+    return config.DB_URI.format(username, password)
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """
+    Counts what the connection pools do, so the pool options can be tuned against the
+    lambdas' concurrency and the cluster's connection limit.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # checkouts happen on the thread that needs the connection, so their start can be kept per thread
+        self.started = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counts = {'checkouts': 0, 'checkout_failures': 0, 'checked_out': 0, 'connections_created': 0,
+                           'connections_closed': 0, 'pools_cleared': 0, 'wait_ms_total': 0.0, 'wait_ms_max': 0.0}
+
+    def snapshot(self):
+        with self.lock:
+            counts = dict(self.counts)
+        counts['wait_ms_mean'] = counts['wait_ms_total'] / counts['checkouts'] if counts['checkouts'] else 0.0
+        return counts
+
+    def _count(self, key, amount=1):
+        with self.lock:
+            self.counts[key] += amount
+
+    def _waited(self):
+        started = getattr(self.started, 'at', None)
+        return 1000 * (time.perf_counter() - started) if started is not None else 0.0
+
+    def connection_check_out_started(self, event):
+        self.started.at = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        waited = self._waited()
+        with self.lock:
+            self.counts['checkouts'] += 1
+            self.counts['checked_out'] += 1
+            self.counts['wait_ms_total'] += waited
+            self.counts['wait_ms_max'] = max(self.counts['wait_ms_max'], waited)
+
+    def connection_check_out_failed(self, event):
+        self._count('checkout_failures')
+
+    def connection_checked_in(self, event):
+        self._count('checked_out', -1)
+
+    def connection_created(self, event):
+        self._count('connections_created')
+
+    def connection_closed(self, event):
+        self._count('connections_closed')
+
+    def pool_cleared(self, event):
+        self._count('pools_cleared')
+
+    def pool_created(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+
+_pool_metrics = PoolMetrics()
+
+
+def pool_metrics():
+    """
+    The connection pool counters of this process (see PoolMetrics), with the mean checkout wait
+    """
+    return _pool_metrics.snapshot()
+
+
+def client_options():
+    """
+    The MongoClient keyword arguments: config.DB_CLIENT_OPTIONS (ie. maxPoolSize, minPoolSize,
+    maxIdleTimeMS, serverSelectionTimeoutMS, compressors) and the pool metrics listener
+    """
+    return dict(getattr(config, 'DB_CLIENT_OPTIONS', {}), event_listeners=[_pool_metrics])
+
+
+def db_name():
+    return getattr(config, 'DB_NAME', 'test')
+
+
 _cached = None
 def get_db():
     """
@@ -38,12 +138,55 @@ def get_db():
     connection pooling
     """
     global _cached
-    if not _cached:
-        username = urllib.parse.quote_plus(config.DB_USER)
-        password = urllib.parse.quote_plus(config.DB_PASSWORD)
-        _cached = MongoClient(config.DB_URI.format(username, password)).test
+    if _cached is None:
+        _cached = MongoClient(db_uri(), **client_options())[db_name()]
     return _cached
 
 
-def coll(collname):
-    return get_db()[config.DB_COLLECTIONS[collname]]
+def reset_db():
+    """
+    Forgets the cached client, so that the next get_db opens a new one. Needed in forked
+    processes, which must not share their parent's connections.
+    """
+    global _cached
+    _cached = None
+    _pool_metrics.reset()
+
+
+READ_PREFERENCE_MODES = {
+    'primary': Primary,
+    'primaryPreferred': PrimaryPreferred,
+    'secondary': Secondary,
+    'secondaryPreferred': SecondaryPreferred,
+    'nearest': Nearest,
+}
+
+_read_preferences = dict()
+def read_preference(workload):
+    """
+    The read preference config.READ_PREFERENCES gives the workload (ie. "analytics"), or the primary
+    if it doesn't name the workload. Each entry has a "mode" and optionally "max_staleness" (in seconds,
+    at least 90) and "tag_sets".
+    """
+    if workload not in _read_preferences:
+        options = dict(getattr(config, 'READ_PREFERENCES', {}).get(workload, {}))
+        mode = READ_PREFERENCE_MODES[options.pop('mode', 'primary')]
+        if mode is Primary:
+            _read_preferences[workload] = Primary()
+        else:
+            _read_preferences[workload] = mode(tag_sets=options.get('tag_sets'),
+                                               max_staleness=options.get('max_staleness', -1))
+    return _read_preferences[workload]
+
+
+def coll(collname, workload=None):
+    """
+    The collection with the given key in config.DB_COLLECTIONS. Reads on it go to the primary unless
+    they're for a workload routed elsewhere, so heavy reporting can be kept off the check-in writes.
+    """
+    if getattr(config, 'DB_PROXY_URL', None):
+        from src import dbproxy
+        return dbproxy.collection(config.DB_COLLECTIONS[collname], workload)
+    if workload is None:
+        return get_db()[config.DB_COLLECTIONS[collname]]
+    return get_db().get_collection(config.DB_COLLECTIONS[collname], read_preference=read_preference(workload))
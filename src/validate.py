@@ -1,8 +1,20 @@
 import re
+from datetime import datetime
 
-import googlemaps as gm
+import pymongo
 
 from src.schemas import *
+from src import stats
+
+# the fields a reimbursement depends on, and what to set when they change so that incremental reimbursement
+# runs know whose to recompute
+REIMBURSE_FIELDS = ('travelling_from', 'registration_status')
+REIMBURSE_UPDATED_AT = 'travelling_from_updated_at'
+
+
+def touches_reimbursement(updates):
+    return any(key.split('.')[0] in REIMBURSE_FIELDS for fields in updates.values() for key in fields)
+
 
 @ensure_schema({
     "type": "object",
@@ -16,17 +28,18 @@ def validate(event, context, user=None):
     """
     Given a token, ensure that the token is an unexpired token of the user with the provided email.
     """
-    return {"statusCode": 200, "body": user, "isBase64Encoded": False}
+    return {"statusCode": 200, "body": dict(user), "isBase64Encoded": False}
 
 
-def validate_updates(user, updates):
+def validate_updates(user, updates, auth_usr=None):
     """
     Ensures that the user is being updated in a legal way. Invariants are explained at line 116 for most fields and
     65 for the registration_status in detail.
     """
 
     # if the user updating is not provided, we assume the user's updating themselves.
-    auth_usr = user
+    if auth_usr is None:
+        auth_usr = user
 
     # quick utilities
     # rejects all updates
@@ -133,7 +146,12 @@ def update(event, context, auth_user):
 
     # validate the updates, passing only the allowable ones through.
     updates = validate_updates(results, event['updates'], auth_user)
-
-    # update the user and report success.
-    user_coll.update_one({'email': event['user_email']}, updates)
+    if touches_reimbursement(updates):
+        updates.setdefault('$set', {})[REIMBURSE_UPDATED_AT] = datetime.utcnow()
+
+    # update the user, keeping the public counts in step, and report success.
+    updated = user_coll.find_one_and_update({'email': event['user_email']}, updates,
+                                            projection=stats.STAT_PROJECTION,
+                                            return_document=pymongo.ReturnDocument.AFTER)
+    stats.record_change(results, updated)
     return {"statusCode": 200, "body": "Successful request."}
@@ -0,0 +1,66 @@
+"""
+A stand-in for Google's Distance Matrix API, for testing reimbursements without a key (or a bill).
+
+Every origin is len(origin) kilometers away, and the first `busy` requests are answered with
+OVER_QUERY_LIMIT so retries get exercised. Run it on its own with
+    python tests/maps_stub.py [port]
+and point config.MAPS_API_URL at http://127.0.0.1:<port>/
+"""
+import json
+import socketserver
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+# ThreadingHTTPServer is only in python 3.7 onwards
+class MapsStub(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, busy=0):
+        super().__init__(address, StubHandler)
+        self.busy = busy
+        self.requests = []
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://{}:{}/'.format(*self.server_address)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        params = {key: values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
+        with self.server.lock:
+            self.server.requests.append(params)
+            busy = self.server.busy > 0
+            self.server.busy -= 1
+        if busy:
+            body = {'status': 'OVER_QUERY_LIMIT', 'rows': []}
+        else:
+            origins = params['origins'].split('|')
+            body = {'status': 'OK', 'origin_addresses': origins, 'destination_addresses': [params['destinations']],
+                    'rows': [{'elements': [{'status': 'OK', 'distance': {'value': 1000 * len(origin)}}]}
+                             for origin in origins]}
+        encoded = json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(encoded)))
+        self.end_headers()
+        self.wfile.write(encoded)
+
+    def log_message(self, *args):
+        pass
+
+
+def start(busy=0, port=0):
+    stub = MapsStub(('127.0.0.1', port), busy)
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    return stub
+
+
+if __name__ == "__main__":
+    stub = MapsStub(('127.0.0.1', int(sys.argv[1]) if len(sys.argv) > 1 else 8765))
+    print('stubbing the Distance Matrix API on {}'.format(stub.url))
+    stub.serve_forever()
@@ -0,0 +1,31 @@
+from testing_utils import *
+
+import asyncio
+import json
+
+import asgi
+
+import mock
+
+
+def call(app, path, body):
+    sent = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': json.dumps(body).encode('utf-8'), 'more_body': False}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(app({'type': 'http', 'method': 'POST', 'path': path}, receive, send))
+    return sent[0]['status'], json.loads(sent[1]['body'])
+
+
+def test_failing_handlers_answer_500():
+    async def broken(event, context):
+        raise RuntimeError('no database')
+
+    with mock.patch('asgi.serverless_functions', return_value=[('src/read.read_info', {'method': 'post', 'path': 'read'})]), \
+            mock.patch.dict('src.aio.HANDLERS', {'src/read.read_info': broken}):
+        app = asgi.create_app()
+    assert call(app, '/read', {'token': 't'}) == (500, 'Internal server error')
@@ -0,0 +1,35 @@
+from testing_utils import *
+
+from datetime import datetime
+
+import config
+from src import attendance
+
+import mock
+
+
+def test_rollup_update():
+    query, update = attendance.rollup_update('lunch', 3, 2)
+    assert query == {'_id': 'lunch'}
+    assert update['$inc'] == {'checkins': 3, 'attendees': 2}
+
+
+@mock.patch('src.attendance.util.coll')
+def test_counts_are_cached(mock_coll):
+    mock_coll.return_value.find.return_value = [{'_id': 'lunch', 'attendees': 2, 'checkins': 3,
+                                                 'updated_at': datetime(2021, 10, 9, 12)}]
+    expected = {'lunch': {'attendees': 2, 'checkins': 3, 'updated_at': '2021-10-09T12:00:00Z'}}
+    assert attendance.counts(['lunch']) == expected
+    assert attendance.counts(['lunch']) == expected
+    assert mock_coll.return_value.find.call_count == 1
+    mock_coll.return_value.find.assert_called_with({'_id': {'$in': ['lunch']}})
+
+
+@mock.patch('src.attendance.util.coll')
+def test_rebuild_replaces_the_rollups_at_once(mock_coll):
+    mock_coll.return_value.count_documents.return_value = 2
+    assert attendance.rebuild() == 2
+    pipeline = mock_coll.return_value.aggregate.call_args[0][0]
+    assert pipeline[-1] == {'$out': config.DB_COLLECTIONS['attendance']}
+    # nothing is deleted first, so there's no moment without rollups
+    assert not mock_coll.return_value.delete_many.called
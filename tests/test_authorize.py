@@ -1,9 +1,10 @@
 from testing_utils import *
 
 import config
-from src import validate, authorize
+from src import validate, authorize, tokens
 
 import pytest
+import mock
 from datetime import datetime, timedelta
 import time
 
@@ -114,3 +115,44 @@ def test_multi_tokens():
         # attempt to validate with new token
         val = validate.validate({'token': tokens[i]}, None)
         assert check_by_schema(schema_for_http(200, {"type": "object", "const": usr_dict}), val)
+
+
+@pytest.mark.run(order=5)
+def test_tokens_are_capped():
+    user_email = "creep@radiohead.ed"
+    passwd = "love"
+    usr_dict = {'email': user_email, 'password': passwd}
+
+    with mock.patch.object(config, 'MAX_TOKENS_PER_USER', 2, create=True):
+        for _ in range(4):
+            auth = authorize.authorize(usr_dict, None)
+            assert has_token_for(auth)
+
+    assert len(get_db_user(user_email)['token']) <= 2
+    # the latest token is the one that's kept
+    assert get_db_user(user_email)['token'][-1] == auth['body']['token']
+
+
+@mock.patch('src.authorize.tokens.store_token')
+@mock.patch('src.authorize.util.coll')
+def test_busy_pool_skips_the_rehash(coll, store_token):
+    coll.return_value.find_one.return_value = {'email': 'creep@radiohead.ed', 'password': b'$2b$04$hash'}
+    with mock.patch('src.authorize.passwords.check_password', return_value=True), \
+            mock.patch('src.authorize.passwords.needs_rehash', return_value=True), \
+            mock.patch('src.authorize.passwords.hash_password', side_effect=authorize.passwords.PoolFull):
+        auth = authorize.authorize({'email': 'creep@radiohead.ed', 'password': 'love'}, None)
+    assert has_token_for(auth)
+    assert not coll.return_value.update_one.called
+    assert 'headers' not in authorize.too_many_logins()
+
+
+@mock.patch('src.tokens.util.coll')
+def test_dropped_tokens_are_revoked(coll):
+    oldest, newer = authorize.issue_token('a@hackru.org')[0], 'expired'
+    coll.return_value.find_one_and_update.return_value = {'token': [oldest, newer]}
+    with mock.patch.object(config, 'MAX_TOKENS_PER_USER', 2, create=True), \
+            mock.patch.object(config, 'TOKEN_STORE', 'user', create=True):
+        tokens.store_token('a@hackru.org', 'newest', datetime.utcnow())
+    revoked = coll.return_value.insert_many.call_args[0][0]
+    assert [entry['hash'] for entry in revoked] == [tokens.token_hash(oldest)]
+    assert tokens.revocations.revoked[tokens.token_hash(oldest)] == revoked[0]['expires']
@@ -0,0 +1,162 @@
+from testing_utils import *
+
+import inspect
+from datetime import timedelta
+
+import pymongo
+import pytest
+
+from src import qrscan
+
+import mock
+
+
+def scan(key, qr, event='lunch', **extra):
+    return dict(key=key, qr=qr, event=event, **extra)
+
+
+def planned(key, qr, event='lunch', batch='b1', **extra):
+    return scan(key, qr, event, batch=batch, **extra)
+
+
+def test_plans_follow_scan_order():
+    resolved = {'creep@radiohead.ed': {'email': 'creep@radiohead.ed', 'day_of': {}},
+                'qr-1': {'email': 'karma@radiohead.ed', 'day_of': {'lunch': 1}}}
+    scans = [planned('a', 'creep@radiohead.ed'), planned('b', 'creep@radiohead.ed'),
+             planned('c', 'creep@radiohead.ed', again=True), planned('d', 'qr-1', again=True), planned('e', 'nobody')]
+    results, increments = qrscan.plan_checkins(scans, resolved)
+    assert [results[key]['statusCode'] for key in 'abcde'] == [200, 402, 200, 200, 404]
+    assert results['c']['body']['new_count'] == 2
+    assert increments == {('creep@radiohead.ed', 'lunch', 'b1'): {'by': 2, 'guarded': True, 'keys': ['a', 'c'], 'to': 2},
+                          ('karma@radiohead.ed', 'lunch', 'b1'): {'by': 1, 'guarded': False, 'keys': ['d'], 'to': 2}}
+
+
+def test_marked_batches_are_not_planned_again():
+    resolved = {'creep@radiohead.ed': {'email': 'creep@radiohead.ed', 'day_of': {'lunch': 1},
+                                       'checkin_marks': [qrscan.checkin_mark('b1', 'lunch')]}}
+    results, increments = qrscan.plan_checkins([planned('a', 'creep@radiohead.ed')], resolved)
+    assert results['a'] == {'statusCode': 200, 'body': {'email': 'creep@radiohead.ed', 'new_count': 1}}
+    assert increments == {}
+
+
+def test_increments_are_one_bulk_write():
+    users = mock.MagicMock()
+    users.bulk_write.return_value.matched_count = 2
+    increments = {('creep@radiohead.ed', 'lunch', 'b1'): {'by': 1, 'guarded': True, 'keys': ['a'], 'to': 1},
+                  ('karma@radiohead.ed', 'lunch', 'b1'): {'by': 2, 'guarded': False, 'keys': ['b', 'c'], 'to': 3}}
+    outcomes = qrscan.apply_increments(users, increments)
+    assert outcomes == {('creep@radiohead.ed', 'lunch', 'b1'): 1, ('karma@radiohead.ed', 'lunch', 'b1'): 3}
+    ops = users.bulk_write.call_args[0][0]
+    assert [op._filter for op in ops] == [
+        {'email': 'creep@radiohead.ed', 'checkin_marks': {'$ne': 'b1/lunch'}, 'day_of.lunch': {'$not': {'$gt': 0}}},
+        {'email': 'karma@radiohead.ed', 'checkin_marks': {'$ne': 'b1/lunch'}}]
+    # all of them matched, so nothing is read again
+    users.find.assert_not_called()
+
+
+def test_scan_times_are_utc():
+    parsed = qrscan.scan_time({'scanned_at': '2021-10-09T12:30:00-04:00'})
+    assert (parsed.hour, parsed.tzinfo) == (16, None)
+
+
+def test_check_in_is_one_conditional_update():
+    identity, match, update, projection = qrscan.checkin_update('qr-1', 'lunch')
+    assert match == {'$and': [identity, {'day_of.lunch': {'$not': {'$gt': 0}}}]}
+    assert update == {'$inc': {'day_of.lunch': 1}}
+    # scans that may repeat only need to find the user
+    assert qrscan.checkin_update('qr-1', 'lunch', again=True)[1] == identity
+
+
+def test_check_in_results():
+    updated = {'email': 'creep@radiohead.ed', 'day_of': {'lunch': 1}}
+    assert qrscan.checkin_result(updated, 'lunch', False)['body']['new_count'] == 1
+    assert qrscan.checkin_result(None, 'lunch', True)['statusCode'] == 402
+    assert qrscan.checkin_result(None, 'lunch', False)['statusCode'] == 404
+
+
+def batch(*scans):
+    return {'token': 't', 'scans': list(scans)}
+
+
+def claimed_mark(checkins, event):
+    return qrscan.checkin_mark(checkins.insert_many.call_args[0][0][0]['batch'], event)
+
+
+
+@mock.patch('src.qrscan.attendance.record_many')
+@mock.patch('src.qrscan.qrcodes.resolve_many', return_value={})
+@mock.patch('src.qrscan.coll')
+def test_beaten_scans_are_not_counted(coll, resolve_many, record_many):
+    users, checkins = mock.MagicMock(), mock.MagicMock()
+    coll.side_effect = lambda name: users if name == 'users' else checkins
+    checkins.find.return_value = []
+    # another scanner got creep in between the read and the write, so only karma carries the batch's mark
+    users.find.side_effect = lambda match, *a: [{'email': 'creep@radiohead.ed', 'day_of': {}},
+                                                {'email': 'karma@radiohead.ed', 'day_of': {}}] if '$or' in match else \
+        [{'email': 'creep@radiohead.ed', 'day_of': {'lunch': 1}, 'checkin_marks': []},
+         {'email': 'karma@radiohead.ed', 'day_of': {'lunch': 1}, 'checkin_marks': [claimed_mark(checkins, 'lunch')]}]
+    users.bulk_write.return_value.matched_count = 1
+
+    attend_events = inspect.unwrap(qrscan.attend_events)
+    results = attend_events(batch(scan('a', 'creep@radiohead.ed'), scan('b', 'karma@radiohead.ed')), None,
+                            {'email': 'scanner@hackru.org'})['body']
+    assert [result['statusCode'] for result in results] == [402, 200]
+    record_many.assert_called_with({'lunch': (1, 1)})
+    claimed = checkins.insert_many.call_args[0][0]
+    assert [claim['_id'] for claim in claimed] == [{'scanned_by': 'scanner@hackru.org', 'key': 'a'},
+                                                   {'scanned_by': 'scanner@hackru.org', 'key': 'b'}]
+
+
+@mock.patch('src.qrscan.attendance.record_many')
+@mock.patch('src.qrscan.qrcodes.resolve_many', return_value={})
+@mock.patch('src.qrscan.coll')
+def test_rollups_follow_the_writes(coll, resolve_many, record_many):
+    users, checkins = mock.MagicMock(), mock.MagicMock()
+    coll.side_effect = lambda name: users if name == 'users' else checkins
+    checkins.find.return_value = []
+    # read as new to dinner, but another scanner let them in again since
+    users.find.side_effect = lambda match, *a: [{'email': 'creep@radiohead.ed', 'day_of': {}}] if '$or' in match else \
+        [{'email': 'creep@radiohead.ed', 'day_of': {'dinner': 2}, 'checkin_marks': [claimed_mark(checkins, 'dinner')]}]
+    users.bulk_write.return_value.matched_count = 0
+
+    attend_events = inspect.unwrap(qrscan.attend_events)
+    results = attend_events(batch(scan('a', 'creep@radiohead.ed', 'dinner', again=True)), None,
+                            {'email': 'scanner@hackru.org'})['body']
+    assert results[0]['body']['new_count'] == 2
+    record_many.assert_called_with({'dinner': (1, 0)})
+
+
+@mock.patch('src.qrscan.attendance.record_many')
+@mock.patch('src.qrscan.qrcodes.resolve_many', return_value={})
+@mock.patch('src.qrscan.coll')
+def test_dead_batches_are_driven_again(coll, resolve_many, record_many):
+    users, checkins = mock.MagicMock(), mock.MagicMock()
+    coll.side_effect = lambda name: users if name == 'users' else checkins
+    checkins.find.return_value = []
+    users.find.return_value = [{'email': 'creep@radiohead.ed', 'day_of': {}}]
+    # the request dies once the keys are claimed
+    users.bulk_write.side_effect = pymongo.errors.AutoReconnect('gone')
+    attend_events = inspect.unwrap(qrscan.attend_events)
+    queue = batch(scan('a', 'creep@radiohead.ed', scanned_at='2021-10-09T12:30:00Z'))
+    with pytest.raises(pymongo.errors.AutoReconnect):
+        attend_events(queue, None, {'email': 'scanner@hackru.org'})
+    claim = dict(checkins.insert_many.call_args[0][0][0])
+    first = users.bulk_write.call_args[0][0][0]
+
+    # replayed while the claim's lease is up: it's still being processed
+    checkins.find.return_value = [claim]
+    results = attend_events(queue, None, {'email': 'scanner@hackru.org'})['body']
+    assert results[0]['statusCode'] == 409
+    checkins.update_one.assert_not_called()
+
+    # replayed after the lease, the same batch is driven again, so the user can't be counted twice
+    checkins.insert_many.reset_mock()
+    claim['claimed_at'] -= timedelta(minutes=5)
+    checkins.update_one.return_value.modified_count = 1
+    users.bulk_write.side_effect = None
+    users.bulk_write.return_value.matched_count = 1
+    results = attend_events(queue, None, {'email': 'scanner@hackru.org'})['body']
+    assert results[0]['statusCode'] == 200 and results[0]['body']['new_count'] == 1
+    assert users.bulk_write.call_args[0][0][0] == first
+    checkins.insert_many.assert_not_called()
+    record_many.assert_called_with({'lunch': (1, 1)})
@@ -0,0 +1,108 @@
+from testing_utils import *
+
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+import config
+from src import dbproxy
+
+import mock
+
+
+@pytest.fixture
+def proxied():
+    """
+    A proxy on a free local port whose operations run on a mock collection
+    """
+    backing = mock.MagicMock()
+    server = dbproxy.ProxyServer(('127.0.0.1', 0), dbproxy.ProxyHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = dbproxy.ProxyClient('tcp://127.0.0.1:{}'.format(server.server_address[1]))
+    with mock.patch.object(dbproxy, 'backing_collection', return_value=backing):
+        yield backing, dbproxy.ProxyCollection(client, 'users', 'analytics')
+    server.shutdown()
+    server.server_close()
+
+
+def test_finds_stream_in_batches(proxied):
+    backing, users = proxied
+    docs = [{'email': str(i)} for i in range(dbproxy.BATCH_SIZE + 3)]
+    backing.find.return_value.sort.return_value.limit.return_value = docs
+    assert list(users.find({'major': 'music'}, {'email': True}).sort('_id', 1).limit(600)) == docs
+    backing.find.assert_called_with({'major': 'music'}, {'email': True})
+    backing.find.return_value.sort.assert_called_with([('_id', 1)])
+
+
+def test_writes_and_errors(proxied):
+    backing, users = proxied
+    backing.update_one.return_value = SimpleNamespace(matched_count=1, modified_count=1, upserted_id=None)
+    assert users.update_one({'email': 'a'}, {'$set': {'major': 'music'}}).matched_count == 1
+
+    backing.bulk_write.return_value = SimpleNamespace(matched_count=0, modified_count=0, upserted_count=1,
+                                                      inserted_count=0, deleted_count=0, upserted_ids={0: 'a'})
+    assert users.bulk_write([UpdateOne({'_id': 'a'}, {'$inc': {'total': 1}}, upsert=True)]).upserted_count == 1
+    sent = backing.bulk_write.call_args[0][0][0]
+    assert (sent._filter, sent._doc, sent._upsert) == ({'_id': 'a'}, {'$inc': {'total': 1}}, True)
+
+    backing.insert_one.side_effect = DuplicateKeyError('E11000 duplicate key', 11000)
+    with pytest.raises(DuplicateKeyError):
+        users.insert_one({'email': 'a'})
+    # the connection is still good after a failure
+    backing.find_one.return_value = {'email': 'a'}
+    assert users.find_one({'email': 'a'}) == {'email': 'a'}
+
+
+def test_only_explains_are_run_as_commands(proxied):
+    backing, users = proxied
+    backing.name = 'users'
+    backing.database.command.return_value = {'ok': 1}
+    assert users.database.command('aggregate', 'users', pipeline=[{'$match': {}}], explain=True) == {'ok': 1}
+    backing.database.command.assert_called_with('aggregate', 'users', pipeline=[{'$match': {}}], explain=True)
+    with pytest.raises(dbproxy.ProxyError):
+        users.database.command('dropDatabase')
+
+
+def test_secrets(proxied):
+    backing, users = proxied
+    backing.find_one.return_value = {'email': 'a'}
+    with mock.patch.object(config, 'DB_PROXY_SECRET', 'hunter2', create=True):
+        assert users.find_one({'email': 'a'}) == {'email': 'a'}
+        sock, _ = users.client.connect()
+        dbproxy.send_doc(sock, {'auth': 1234, 'coll': 'users', 'op': 'find_one', 'args': {}})
+        assert dbproxy.recv_doc(sock)['error'] == 'ProxyError'
+        sock.close()
+        with mock.patch.object(dbproxy, 'ProxyServer') as server:
+            dbproxy.serve('0.0.0.0:0')
+            assert server.called
+    with mock.patch.object(config, 'DB_PROXY_SECRET', None, create=True):
+        with pytest.raises(SystemExit):
+            dbproxy.serve('0.0.0.0:0')
+
+
+def test_consume_through_the_proxy(proxied):
+    from src import consume
+    backing, users = proxied
+    backing.find_one.side_effect = [{'link': 'l', 'forgot': True, 'email': 'a'}, {'email': 'a'}]
+    backing.update_one.return_value = SimpleNamespace(matched_count=1, modified_count=1, upserted_id=None)
+    backing.delete_many.return_value = SimpleNamespace(deleted_count=1)
+    with mock.patch.object(config, 'DB_PROXY_URL', 'tcp://proxy', create=True), \
+            mock.patch.object(dbproxy, '_client', users.client):
+        result = consume.consume_url({'link': 'l', 'password': 'hunter2'}, None)
+    assert result['statusCode'] == 200
+    backing.delete_many.assert_called_with({'link': 'l'})
+
+
+def test_idle_connections_are_dropped_and_replaced(proxied):
+    backing, users = proxied
+    backing.find_one.return_value = {'email': 'a'}
+    with mock.patch.object(config, 'DB_PROXY_IDLE_TIMEOUT', 0.1, create=True):
+        assert users.find_one({'email': 'a'}) == {'email': 'a'}
+        # the proxy has closed the idle socket by now, so the next call goes again on a fresh one
+        time.sleep(0.3)
+        assert users.find_one({'email': 'a'}) == {'email': 'a'}
+    assert backing.find_one.call_count == 2
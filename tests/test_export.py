@@ -0,0 +1,79 @@
+from testing_utils import *
+
+import csv
+import gzip
+import inspect
+
+from src import export
+
+import mock
+
+
+def test_rows_are_chunked():
+    users = [{'email': str(i), 'travelling_from': {'mode': 'car'}} for i in range(5)]
+    with mock.patch.object(export, 'chunk_size', return_value=2):
+        chunks = list(export.rows(iter(users), ['email', 'travelling_from', 'major', 'travelling_from.mode']))
+    assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+    assert chunks[0][0] == ['0', '{"mode": "car"}', None, 'car']
+
+
+def test_subfields_are_projected_once():
+    projection = export.export_projection(['travelling_from', 'travelling_from.mode', 'day_of.lunch'])
+    assert projection == {'travelling_from': True, 'day_of.lunch': True, 'email': True, '_id': False}
+
+
+def test_csv_export(tmpdir):
+    path = str(tmpdir.join('users.csv.gz'))
+    assert export.write_csv(path, ['email', 'major'], [[['a', 'music']], [['b', None]]]) == 2
+    with gzip.open(path, 'rt') as written:
+        assert list(csv.reader(written)) == [['email', 'major'], ['a', 'music'], ['b', '']]
+
+
+def test_local_store(tmpdir):
+    written = tmpdir.join('written')
+    written.write('data')
+    with mock.patch.object(export, 'export_location', return_value=str(tmpdir.join('exports'))):
+        location = export.store(str(written), 'users.csv.gz')
+    assert open(location).read() == 'data'
+    assert not written.exists()
+
+
+def test_private_fields_are_not_exported():
+    export_users = inspect.unwrap(export.export_users)
+    with mock.patch('src.export.util.coll') as coll:
+        result = export_users({'token': 't', 'fields': ['email', 'password', 'token.hash']}, None, {'is_admin': True})
+    assert result['statusCode'] == 400
+    assert not coll.called
+
+
+def test_lambdas_only_export_to_s3():
+    export_users = inspect.unwrap(export.export_users)
+    with mock.patch('src.export.util.coll') as coll, mock.patch.dict('os.environ', {'AWS_LAMBDA_FUNCTION_NAME': 'export'}), \
+            mock.patch.object(export, 'export_location', return_value='/tmp/exports'):
+        result = export_users({'token': 't'}, object(), {'email': 'a@hackru.org', 'is_admin': True})
+    assert result['statusCode'] == 500
+    assert not coll.called
+
+
+@mock.patch('src.export.util.coll')
+def test_exports_are_queued_then_run(coll):
+    export_users = inspect.unwrap(export.export_users)
+    with mock.patch.object(export, 'start') as start:
+        result = export_users({'token': 't', 'query': {'major': {'$in': ['music']}}}, None,
+                              {'email': 'a@hackru.org', 'is_admin': True})
+    assert result['statusCode'] == 202
+    job = coll.return_value.insert_one.call_args[0][0]
+    assert (job['_id'], job['status'], job['query']) == (result['body']['job'], 'queued', '{"major": {"$in": ["music"]}}')
+    start.assert_called_with(job['_id'], None)
+
+    coll.return_value.find_one_and_update.return_value = job
+    with mock.patch.object(export, 'write_export', return_value=('/tmp/exports/users.csv.gz', 3)) as write_export:
+        export.run_job(job['_id'])
+    write_export.assert_called_with({'major': {'$in': ['music']}}, export.DEFAULT_FIELDS, 'csv')
+    assert coll.return_value.update_one.call_args[0][1]['$set']['status'] == 'done'
+
+    # a job something else already picked up isn't run again
+    coll.return_value.find_one_and_update.return_value = None
+    with mock.patch.object(export, 'write_export') as write_export:
+        export.run_job(job['_id'])
+    assert not write_export.called
@@ -0,0 +1,34 @@
+from testing_utils import *
+
+from src import indexes
+
+import mock
+
+
+def test_ensure_is_idempotent():
+    indexes.ensure_indexes()
+    for collkey in indexes.declared_collections():
+        assert indexes.missing_indexes(collkey) == []
+    # nothing left to create the second time around
+    assert indexes.ensure_indexes() == ([], [])
+
+
+def test_user_lookups_use_indexes():
+    indexes.ensure_indexes()
+    for collkey, query, stages, collscan in indexes.explain_queries():
+        if collkey == 'users':
+            assert not collscan, query
+
+
+def test_conflicts_are_skipped():
+    coll = mock.MagicMock()
+    # the unique email index exists, but isn't unique
+    coll.index_information.return_value = {'_id_': {'key': [('_id', 1)]}, 'email_1': {'key': [('email', 1)]}}
+    with mock.patch('src.indexes.util.coll', return_value=coll), \
+            mock.patch.object(indexes, 'declared_collections', return_value=['users']):
+        created, conflicts = indexes.ensure_indexes()
+        assert indexes.main(['indexes', 'verify']) == 1
+    assert conflicts == [('users', [('email', 1)], {'unique': True}, 'email_1', {})]
+    # the rest are still created
+    assert [call[0][0] for call in coll.create_index.call_args_list] == [[('qrcode', 1)],
+                                                                          [('travelling_from_updated_at', 1)]]
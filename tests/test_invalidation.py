@@ -0,0 +1,55 @@
+from testing_utils import *
+
+from pymongo.errors import OperationFailure
+
+import config
+from src import invalidation, qrcodes, tokens
+
+import mock
+
+
+def test_changes_reach_subscribers():
+    bus = invalidation.InvalidationBus()
+    seen = []
+    bus.subscribe('users', seen.append)
+    bus.subscribe('users', lambda change: 1 / 0)
+    # a failing subscriber doesn't keep the others from hearing of the change
+    bus.publish('users', 'update', 'some-id')
+    bus.publish('events', 'delete', 'other-id')
+    assert seen == [{'collection': 'users', 'operation': 'update', 'id': 'some-id', 'document': None}]
+
+
+@mock.patch.object(config, 'INVALIDATION_POLL', True, create=True)
+@mock.patch('src.invalidation.util.get_db')
+def test_standalone_servers_are_polled(mock_db):
+    bus = invalidation.InvalidationBus()
+    seen = []
+    bus.subscribe('users', seen.append)
+    mock_db.return_value.watch.side_effect = OperationFailure('replica sets only', 40573)
+    mock_db.return_value.command.side_effect = [{'collections': {'users': 'a'}}, {'collections': {'users': 'a'}},
+                                                {'collections': {'users': 'b'}}]
+    with mock.patch.object(bus.stopping, 'wait', side_effect=[False, False, True]):
+        bus.run()
+    assert [change['operation'] for change in seen] == ['reset']
+    # only the collections someone listens to are hashed
+    assert mock_db.return_value.command.call_args[1]['collections'] == [config.DB_COLLECTIONS['users']]
+
+
+@mock.patch('src.invalidation.util.get_db')
+def test_polling_is_opt_in(mock_db):
+    bus = invalidation.InvalidationBus()
+    bus.subscribe('users', lambda change: None)
+    mock_db.return_value.watch.side_effect = OperationFailure('replica sets only', 40573)
+    with mock.patch.object(config, 'INVALIDATION_POLL', False, create=True):
+        bus.run()
+    assert not mock_db.return_value.command.called
+
+
+def test_caches_follow_changes():
+    qrcodes.remember('qr-1', 'creep@radiohead.ed')
+    invalidation.bus.publish('qr codes', 'update', 'qr-1')
+    assert qrcodes.cached('qr-1') is None
+
+    revocations = tokens.RevocationCache()
+    revocations.on_change({'operation': 'insert', 'id': 1, 'document': {'hash': 'abc', 'expires': 'soon'}})
+    assert revocations.revoked == {'abc': 'soon'}
@@ -0,0 +1,49 @@
+from testing_utils import *
+
+import config
+from src import passwords
+
+import bcrypt
+import pytest
+import mock
+
+
+def test_hash_follows_policy():
+    with mock.patch.object(passwords, '_rounds', 5):
+        hashed = passwords.hash_password('love')
+        assert passwords.rounds_of(hashed) == 5
+        assert passwords.check_password('love', hashed)
+        assert not passwords.check_password('hate', hashed)
+        assert not passwords.needs_rehash(hashed)
+        assert passwords.needs_rehash(bcrypt.hashpw(b'love', bcrypt.gensalt(rounds=4)))
+        # a stronger hash than the policy's is left alone
+        assert not passwords.needs_rehash(bcrypt.hashpw(b'love', bcrypt.gensalt(rounds=6)))
+
+
+def test_calibration_is_bounded():
+    assert passwords.calibrate_rounds(0.0001) == passwords.MIN_ROUNDS
+    assert passwords.calibrate_rounds(10 ** 9) == passwords.MAX_ROUNDS
+
+
+def test_timing_stats():
+    passwords.hash_password('love')
+    stats = passwords.timing_stats()
+    assert stats['count'] > 0
+    assert stats['p50_ms'] <= stats['p99_ms']
+
+
+def test_pool_turns_away_overflow():
+    with mock.patch.object(config, 'BCRYPT_POOL_WORKERS', 1, create=True), \
+            mock.patch.object(config, 'BCRYPT_POOL_QUEUE', 0, create=True), \
+            mock.patch.object(passwords, '_pool', None), \
+            mock.patch.object(passwords, '_rounds', 4):
+        hashed = passwords.hash_password('love')
+        assert passwords.check_password('love', hashed)
+        # hold the only slot, as if a hash were in progress
+        passwords._pool_slots.acquire()
+        try:
+            with pytest.raises(passwords.PoolFull):
+                passwords.check_password('love', hashed)
+        finally:
+            passwords._pool_slots.release()
+        passwords._pool.shutdown()
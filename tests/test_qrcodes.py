@@ -0,0 +1,39 @@
+from testing_utils import *
+
+from src import qrcodes
+
+import mock
+
+
+@mock.patch('src.qrcodes.util.coll')
+def test_resolved_codes_are_cached(mock_coll):
+    qrcodes.forget()
+    mock_coll.return_value.find_one.return_value = {'_id': 'qr-1', 'email': 'creep@radiohead.ed'}
+    assert qrcodes.resolve('qr-1') == 'creep@radiohead.ed'
+    assert qrcodes.resolve('qr-1') == 'creep@radiohead.ed'
+    assert mock_coll.return_value.find_one.call_count == 1
+
+    # relinking the code drops it from the cache
+    qrcodes.link('qr-1', 'karma@radiohead.ed')
+    mock_coll.return_value.find_one.return_value = {'_id': 'qr-1', 'email': 'karma@radiohead.ed'}
+    assert qrcodes.resolve('qr-1') == 'karma@radiohead.ed'
+    qrcodes.forget()
+
+
+@mock.patch('src.qrcodes.util.coll')
+def test_unknown_codes_are_not_cached(mock_coll):
+    qrcodes.forget()
+    mock_coll.return_value.find_one.return_value = None
+    assert qrcodes.resolve('creep@radiohead.ed') is None
+    assert qrcodes.cached('creep@radiohead.ed') is None
+
+
+@mock.patch('src.qrcodes.util.coll')
+def test_batches_only_look_up_uncached_codes(mock_coll):
+    qrcodes.forget()
+    qrcodes.remember('qr-1', 'creep@radiohead.ed')
+    mock_coll.return_value.find.return_value = [{'_id': 'qr-2', 'email': 'karma@radiohead.ed'}]
+    assert qrcodes.resolve_many(['qr-1', 'qr-2', 'qr-3']) == {'qr-1': 'creep@radiohead.ed',
+                                                             'qr-2': 'karma@radiohead.ed'}
+    mock_coll.return_value.find.assert_called_with({'_id': {'$in': ['qr-2', 'qr-3']}})
+    qrcodes.forget()
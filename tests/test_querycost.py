@@ -0,0 +1,98 @@
+from testing_utils import *
+
+from pymongo.errors import ExecutionTimeout
+
+from src import querycost
+
+import mock
+import pytest
+
+
+def big_collection(stage):
+    users = mock.MagicMock()
+    users.name = 'users'
+    users.estimated_document_count.return_value = 10 ** 6
+    users.find.return_value.limit.return_value.explain.return_value = {
+        'queryPlanner': {'winningPlan': {'stage': 'PROJECTION', 'inputStage': {'stage': stage}},
+                         'rejectedPlans': [{'stage': 'COLLSCAN'}]}}
+    return users
+
+
+def test_shapes_hide_values():
+    query = {'$or': [{'email': 'creep@radiohead.ed'}, {'qrcode': {'$in': ['a', 'b']}}]}
+    assert querycost.query_shape(query) == {'$or': [{'email': '?'}, {'qrcode': {'$in': '?'}}]}
+
+
+def test_collection_scans_are_rejected():
+    with pytest.raises(querycost.QueryRejected):
+        querycost.find(big_collection('COLLSCAN'), {'major': 'music'}, {})
+
+    users = big_collection('IXSCAN')
+    users.find.return_value.max_time_ms.return_value.limit.return_value = [{'email': 'a'}]
+    assert querycost.find(users, {'email': 'a'}, {}) == [{'email': 'a'}]
+
+
+def test_small_collections_are_not_explained():
+    users = big_collection('COLLSCAN')
+    users.estimated_document_count.return_value = 10
+    users.find.return_value.max_time_ms.return_value.limit.return_value = []
+    assert querycost.find(users, {'major': 'music'}, {}) == []
+    assert not users.find.return_value.limit.return_value.explain.called
+
+
+def test_limits():
+    users = big_collection('IXSCAN')
+    cursor = users.find.return_value.max_time_ms.return_value
+    cursor.limit.return_value = [{}] * (querycost.max_results() + 1)
+    with pytest.raises(querycost.QueryRejected) as err:
+        querycost.find(users, {'email': 'a'}, {})
+    assert err.value.status == 413
+
+    cursor.limit.return_value = mock.MagicMock()
+    cursor.limit.return_value.__iter__.side_effect = ExecutionTimeout('too slow')
+    with pytest.raises(querycost.QueryRejected) as err:
+        querycost.find(users, {'email': 'a'}, {})
+    assert err.value.status == 408
+
+
+def test_pages_of_everyone_are_admitted():
+    # walking the _id index in order is fine, it's only the unordered scan that's refused
+    users = big_collection('COLLSCAN')
+    paged = users.find.return_value.sort.return_value.limit.return_value
+    paged.explain.return_value = {
+        'queryPlanner': {'winningPlan': {'stage': 'LIMIT', 'inputStage': {'stage': 'FETCH', 'inputStage': {
+            'stage': 'IXSCAN', 'indexName': '_id_'}}}}}
+    users.find.return_value.max_time_ms.return_value.sort.return_value.limit.return_value = [{'_id': 1}]
+    assert querycost.find(users, {}, {}, sort=querycost.ID_ORDER, limit=50) == [{'_id': 1}]
+    users.find.return_value.sort.assert_called_with(querycost.ID_ORDER)
+    users.find.return_value.sort.return_value.limit.assert_called_with(50)
+
+    with pytest.raises(querycost.QueryRejected):
+        querycost.find(users, {}, {})
+
+
+def test_unindexed_filters_in_id_order_are_scans():
+    # the sort lets an unindexed filter walk the _id index, which reads every user all the same
+    users = big_collection('COLLSCAN')
+    users.find.return_value.sort.return_value.limit.return_value.explain.return_value = {
+        'queryPlanner': {'winningPlan': {'stage': 'FETCH', 'filter': {'major': {'$eq': 'music'}}, 'inputStage': {
+            'stage': 'IXSCAN', 'indexName': '_id_'}}}}
+    with pytest.raises(querycost.QueryRejected):
+        querycost.find(users, {'$and': [{'major': 'music'}, {'_id': {'$gt': 1}}]}, {},
+                       sort=querycost.ID_ORDER, limit=50)
+    assert querycost.filters_on([{'$match': {'$or': [{'email': 'a'}, {'_id': 1}]}}, {'$limit': 1}]) == {'email', '_id'}
+
+
+def test_streams_say_when_they_time_out():
+    users = big_collection('IXSCAN')
+    users.estimated_document_count.return_value = 10
+    cursor = mock.MagicMock()
+    cursor.__iter__.return_value = iter([{'email': 'a'}])
+    users.find.return_value.max_time_ms.return_value.sort.return_value = cursor
+    assert list(querycost.stream(users, {}, {})) == [{'email': 'a'}]
+
+    def slow():
+        yield {'email': 'a'}
+        raise ExecutionTimeout('too slow')
+    cursor.__iter__.return_value = slow()
+    assert list(querycost.stream(users, {}, {})) == [{'email': 'a'}, {'error': 'timed out', 'count': 1}]
@@ -0,0 +1,46 @@
+from testing_utils import *
+
+from bson import ObjectId
+
+from src import read
+
+import mock
+
+
+def test_continuation_round_trips():
+    last = ObjectId()
+    assert read.decode_continuation(read.encode_continuation(last)) == last
+
+
+def small_collection():
+    users = mock.MagicMock()
+    users.estimated_document_count.return_value = 0
+    return users
+
+
+def test_pages_continue_after_the_last_id():
+    users = small_collection()
+    ids = [ObjectId() for _ in range(2)]
+    cursor = users.find.return_value.max_time_ms.return_value.sort.return_value
+    cursor.limit.return_value = [{'_id': i, 'email': 'a'} for i in ids]
+    page = read.find_results(users, {'query': {}, 'limit': 2, 'projection': ['email']}, None)['body']
+    assert page['results'] == [{'email': 'a'}, {'email': 'a'}]
+
+    cursor.limit.return_value = []
+    page = read.find_results(users, {'query': {}, 'limit': 2, 'after': page['next']}, None)['body']
+    assert users.find.call_args[0][0] == {'$and': [{}, {'_id': {'$gt': ids[-1]}}]}
+    assert page == {'results': [], 'next': None}
+
+
+def test_lambdas_cannot_stream():
+    users = small_collection()
+    assert read.find_results(users, {'query': {}, 'stream': True}, object())['statusCode'] == 400
+    users.find.return_value.max_time_ms.return_value.sort.return_value = iter([{'email': 'a'}])
+    assert list(read.find_results(users, {'query': {}, 'stream': True}, None)['body']) == [{'email': 'a'}]
+
+
+def test_tampered_continuations_are_refused():
+    users = small_collection()
+    for token in ('not base64!', 'AAAA', read.encode_continuation(ObjectId())[:-4], 'é'):
+        assert read.find_results(users, {'query': {}, 'after': token}, None) == \
+            {"statusCode": 400, "body": "invalid continuation"}
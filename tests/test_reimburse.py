@@ -0,0 +1,88 @@
+from testing_utils import *
+
+import config
+from src import reimburse
+
+import maps_stub
+import mock
+import pytest
+
+
+def traveller(addr):
+    return {'email': addr + '@hackru.org', 'travelling_from': {'formatted_addr': addr, 'mode': 'car'}}
+
+
+@pytest.fixture
+def stub(tmpdir):
+    stubbed = maps_stub.start(busy=2)
+    settings = {'MAPS_API_URL': stubbed.url, 'DISTANCE_CACHE': str(tmpdir.join('distances.json')),
+                'MAPS_BACKOFF_SECONDS': 0.01}
+    with mock.patch.multiple(config, create=True, **settings):
+        yield stubbed
+    stubbed.shutdown()
+    stubbed.server_close()
+
+
+def test_distances_are_fetched_and_cached(stub):
+    users = [traveller('address {}'.format(i)) for i in range(30)] + [traveller('address 0')]
+    lookup = reimburse.req_distance_matrices(users)
+    assert lookup['car']['address 7'] == 1000 * len('address 7')
+    assert set(lookup) == {'car', 'bus', 'train'}
+    # 30 distinct addresses are 2 requests per mode, plus the 2 turned away as busy
+    assert len(stub.requests) == 2 * 3 + 2
+
+    # a second run only asks for what's new
+    lookup = reimburse.req_distance_matrices(users + [traveller('somewhere else')])
+    assert lookup['bus']['somewhere else'] == 1000 * len('somewhere else')
+    assert len(stub.requests) == 2 * 3 + 2 + 3
+
+
+def test_giving_up_after_retries(stub):
+    stub.busy = 100
+    with mock.patch.object(config, 'MAPS_RETRIES', 2, create=True):
+        with pytest.raises(reimburse.RetryableError):
+            reimburse.req_distance_matrices([traveller('address 0')])
+
+
+def test_only_changed_reimbursements_are_written():
+    users = [traveller('here'), traveller('there')]
+    users[0]['travelling_from']['reimbursement'] = 0
+    user_coll = mock.MagicMock()
+    lookup = {'car': {'here': 0, 'there': 100000}, 'bus': {}, 'train': {}}
+    with mock.patch.object(reimburse, 'req_distance_matrices', return_value=lookup):
+        total, written = reimburse.reimburse_chunk(user_coll, users)
+    assert written == 1
+    assert user_coll.bulk_write.call_args[0][0][0]._filter == {'email': 'there@hackru.org'}
+
+
+def test_incremental_runs_use_the_watermark():
+    assert reimburse.UPDATED_AT not in reimburse.reimburse_query()
+    assert reimburse.reimburse_query('last run')[reimburse.UPDATED_AT] == {'$gt': 'last run'}
+
+
+def test_chunks_share_one_cache(stub, tmpdir):
+    cache = reimburse.DistanceCache(config.TRAVEL.HACKRU_LOCATION)
+    reimburse.req_distance_matrices([traveller('here')], cache)
+    lookup = reimburse.req_distance_matrices([traveller('there')], cache)
+    # each chunk only gets its own addresses, and the file is only written once the run is done
+    assert set(lookup['car']) == {'there'}
+    assert not tmpdir.join('distances.json').exists()
+    cache.save()
+    assert set(reimburse.DistanceCache(config.TRAVEL.HACKRU_LOCATION).load(['here', 'there'])['car']) == \
+        {'here', 'there'}
+
+
+@mock.patch('src.reimburse.util.coll')
+def test_only_the_chunks_addresses_are_read(coll):
+    coll.return_value.find.return_value = [{'mode': 'car', 'addr': 'here', 'distance': 5}]
+    with mock.patch.object(config, 'DISTANCE_CACHE', 'mongo', create=True):
+        lookup = reimburse.DistanceCache('hackru').load(['here'])
+    assert lookup['car'] == {'here': 5}
+    assert coll.return_value.find.call_args[0][0] == {'destination': 'hackru', 'addr': {'$in': ['here']}}
+
+
+def test_stale_reimbursements_are_found():
+    query = reimburse.stale_query('last run')
+    assert query[reimburse.UPDATED_AT] == {'$gt': 'last run'}
+    assert {'registration_status': {'$in': reimburse.INELIGIBLE_STATUSES}} in query['$or']
+    assert reimburse.UPDATED_AT not in reimburse.stale_query()
@@ -0,0 +1,76 @@
+from testing_utils import *
+
+import config
+from src import schemas, authorize
+
+import mock
+
+
+token_schema = {
+    "type": "object",
+    "properties": {
+        "token": {"type": "string"}
+    },
+    "required": ["token"]
+}
+
+
+def test_validators_are_shared():
+    # equal schemas (even if built separately) get the same compiled validator
+    assert schemas.compiled_validator(token_schema) is schemas.compiled_validator(dict(**token_schema))
+
+
+def test_compiled_schema_rejects():
+    @schemas.ensure_schema(token_schema)
+    def echo(event, context):
+        return {"statusCode": 200, "body": event['token']}
+
+    assert check_by_schema(schema_for_http(200, {"type": "string", "const": "tkn"}), echo({"token": "tkn"}, None))
+    assert check_by_schema(schema_for_http(400, {"type": "string"}), echo({"oken": "tkn"}, None))
+    assert check_by_schema(schema_for_http(400, {"type": "string"}), echo({"token": 42}, None))
+
+
+@mock.patch('src.schemas.util.coll')
+def test_lazy_user_only_fetches_when_needed(mock_coll):
+    mock_coll.return_value.find_one.return_value = {'email': 'creep@radiohead.ed', 'is_admin': False}
+    user = schemas.LazyUser('creep@radiohead.ed', schemas.user_projection(['is_admin']))
+    assert user['email'] == 'creep@radiohead.ed'
+    assert not mock_coll.called
+
+    assert user.get('is_admin') is False
+    assert dict(user) == {'email': 'creep@radiohead.ed', 'is_admin': False}
+    mock_coll.return_value.find_one.assert_called_once_with(
+        {'email': 'creep@radiohead.ed'}, {'is_admin': True, 'email': True, '_id': False})
+
+
+def test_user_projection_never_has_password():
+    assert schemas.user_projection(['password', 'first_name']) == {'first_name': True, 'email': True, '_id': False}
+    assert schemas.user_projection()['password'] is False
+
+
+@mock.patch('src.schemas.tokens.revocations.is_revoked', return_value=False)
+@mock.patch('src.schemas.util.coll')
+def test_deleted_users_are_not_authorized(mock_coll, is_revoked):
+    mock_coll.return_value.find_one.return_value = None
+    token, _ = authorize.issue_token('creep@radiohead.ed')
+
+    @schemas.ensure_logged_in_user(fields=['is_admin'])
+    def whoami(event, context, user):
+        return {"statusCode": 200, "body": user.get('is_admin')}
+
+    with mock.patch.object(config, 'JWT_STATELESS', True, create=True):
+        assert whoami({'token': token}, None)['statusCode'] == 403
+
+
+def test_roles():
+    @schemas.ensure_role([['director', 'organizer', 'volunteer']])
+    def scan(event, context, user):
+        return {"statusCode": 200, "body": user['email']}
+
+    volunteer = {'email': 'v@hackru.org', 'role': {'volunteer': True, 'hacker': False}}
+    hacker = {'email': 'h@hackru.org', 'role': {'hacker': True}}
+    assert scan({}, None, volunteer)['statusCode'] == 200
+    # being an admin isn't a role
+    assert scan({}, None, {'email': 'a@hackru.org', 'is_admin': True})['statusCode'] == 403
+    assert scan({}, None, hacker)['statusCode'] == 403
+    assert scan({}, None, {'email': 'n@hackru.org'})['statusCode'] == 403
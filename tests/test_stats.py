@@ -0,0 +1,50 @@
+from testing_utils import *
+
+import config
+from src import stats
+
+import mock
+
+
+@mock.patch('src.stats.util.coll')
+def test_unchanged_fields_write_nothing(mock_coll):
+    before = {'email': 'creep@radiohead.ed', 'major': 'music', 'registration_status': 'registered'}
+    stats.record_change(before, dict(before, votes=3))
+    assert not mock_coll.return_value.bulk_write.called
+
+
+@mock.patch('src.stats.util.coll')
+def test_changes_move_counts(mock_coll):
+    before = {'email': 'creep@radiohead.ed', 'major': 'music', 'registration_status': 'registered'}
+    stats.record_change(before, dict(before, registration_status='checked-in'))
+    ops = mock_coll.return_value.bulk_write.call_args[0][0]
+    assert [op._doc['$inc']['total'] for op in ops] == [1, -1]
+
+    stats.record_change(None, before)
+    ops = mock_coll.return_value.bulk_write.call_args[0][0]
+    assert len(ops) == 1
+
+
+@mock.patch('src.stats.util.coll')
+def test_reads_are_cached(mock_coll):
+    stats.clear_cache()
+    mock_coll.return_value.find_one.return_value = {'_id': stats.BUILT_ID}
+    mock_coll.return_value.aggregate.return_value = iter([{'_id': {'major': 'music'}, 'total': 5}])
+    event = {'fields': ['major']}
+    assert stats.public_stats(event) == [{'_id': {'major': 'music'}, 'total': 5}]
+    assert stats.public_stats(event) == [{'_id': {'major': 'music'}, 'total': 5}]
+    assert mock_coll.return_value.aggregate.call_count == 1
+    stats.clear_cache()
+
+
+@mock.patch('src.stats.util.get_db')
+@mock.patch('src.stats.util.coll')
+def test_rebuild_swaps_the_counts_in(mock_coll, get_db):
+    mock_coll.return_value.aggregate.return_value = [{'_id': {'major': 'music', 'registration_status': 'registered'},
+                                                      'total': 5}]
+    assert stats.rebuild() == 1
+    building = get_db.return_value.__getitem__.return_value
+    assert [doc['_id'] for doc in building.insert_many.call_args[0][0]][-1] == stats.BUILT_ID
+    building.rename.assert_called_with(config.DB_COLLECTIONS['stats'], dropTarget=True)
+    # the live counts are never emptied
+    assert not mock_coll.return_value.delete_many.called
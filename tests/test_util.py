@@ -0,0 +1,28 @@
+from testing_utils import *
+
+from pymongo.read_preferences import Primary, SecondaryPreferred
+
+import config
+from src import util
+
+import mock
+
+
+def test_workloads_route_reads():
+    preferences = {'analytics': {'mode': 'secondaryPreferred', 'max_staleness': 120}}
+    with mock.patch.object(config, 'READ_PREFERENCES', preferences, create=True), \
+            mock.patch.dict(util._read_preferences, clear=True):
+        assert util.read_preference('analytics') == SecondaryPreferred(max_staleness=120)
+        assert util.read_preference('auth') == Primary()
+
+
+def test_pool_metrics_count_checkouts():
+    metrics = util.PoolMetrics()
+    metrics.connection_created(None)
+    metrics.connection_check_out_started(None)
+    metrics.connection_checked_out(None)
+    assert metrics.snapshot()['checked_out'] == 1
+    metrics.connection_checked_in(None)
+    counts = metrics.snapshot()
+    assert (counts['checkouts'], counts['checked_out'], counts['connections_created']) == (1, 0, 1)
+    assert counts['wait_ms_max'] >= counts['wait_ms_mean'] >= 0
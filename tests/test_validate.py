@@ -48,3 +48,9 @@ def test_validate_token():
     
     # remove the token
     users.update_one({'email': user_email}, {'$pull': expired})
+
+
+def test_travel_changes_are_tracked():
+    assert validate.touches_reimbursement({'$set': {'travelling_from.formatted_addr': 'New Brunswick, NJ'}})
+    assert validate.touches_reimbursement({'$set': {'registration_status': 'registered'}})
+    assert not validate.touches_reimbursement({'$set': {'shirt_size': 'm'}, '$inc': {'votes': 1}})